@@ -0,0 +1,62 @@
+'''
+Parses the PLAY RECAP at the end of ansible-playbook's output, which is what
+AnsibleProvisioner.exec_playbook returns, to find the hosts a playbook failed on.
+
+A recap looks like:
+
+    PLAY RECAP *********************************************************************
+    10.0.0.1                   : ok=5    changed=3    unreachable=0    failed=0
+    10.0.0.2                   : ok=2    changed=0    unreachable=1    failed=0
+'''
+
+import re
+
+RECAP_HEADER_RE = re.compile(r'^PLAY RECAP\b')
+
+RECAP_LINE_RE = re.compile(r'^(\S+)\s*:\s*((?:\w+=\d+\s*)+)$')
+
+
+
+def parse_recap(output):
+    '''
+    Returns:
+        dict of host -> dict of counter name ('ok', 'changed', 'unreachable', 'failed', ...)
+        -> count, from the last PLAY RECAP in output. Empty if there's no recap.
+    '''
+    recap = {}
+    in_recap = False
+    for line in (output or '').splitlines():
+        line = line.strip()
+        if RECAP_HEADER_RE.match(line):
+            recap = {}
+            in_recap = True
+            continue
+        if not in_recap:
+            continue
+
+        m = RECAP_LINE_RE.match(line)
+        if m:
+            recap[m.group(1)] = dict((k, int(v)) for k, v in re.findall(r'(\w+)=(\d+)', m.group(2)))
+        elif line:
+            in_recap = False
+    return recap
+
+
+
+def failed_hosts(output, targets):
+    '''
+    Args:
+        - output : Output of ansible-playbook.
+        - targets : Hosts the playbook was run on.
+
+    Returns:
+        list of targets that failed or were unreachable. Targets missing from the recap,
+        like when the playbook could not run at all, are taken to have failed.
+    '''
+    recap = parse_recap(output)
+    failed = []
+    for host in targets:
+        counters = recap.get(host)
+        if counters is None or counters.get('failed', 0) or counters.get('unreachable', 0):
+            failed.append(host)
+    return failed
@@ -1,7 +1,19 @@
+import sys
+
 from cluster_plan import LinodeStaticInfo
 
-def app_init(): 
-    LinodeStaticInfo.load()
+def app_init(refresh = False): 
+    LinodeStaticInfo.load(refresh = refresh)
     
 if __name__ == '__main__':
-    app_init()
+    # $ python app.py [refresh | invalidate]
+    # refresh fetches Linode plans and datacenters from the API and caches them again.
+    # invalidate deletes the cache, so that the next command fetches them.
+    command = sys.argv[1] if len(sys.argv) > 1 else None
+    if command == 'invalidate':
+        LinodeStaticInfo.invalidate()
+    elif command in (None, 'refresh'):
+        app_init(refresh = command == 'refresh')
+    else:
+        print('Unknown command: %s' % (command))
+        sys.exit(1)
@@ -1,6 +1,15 @@
 import re
 import os
+import sys
+import time
+import threading
 import collections
+from multiprocessing.pool import ThreadPool
+
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
 
 import simplejson as json
 from simplejson.scanner import JSONDecodeError
@@ -14,9 +23,23 @@ from provisioners import AnsibleProvisioner
 import dpath.util as dp
 
 import logger
+import tracing
+from ansible_recap import failed_hosts
+from state_store import StateStore, FileLock
+from gluster_volume import VolumeProvisioner, plan_tuning_options, brick_path
 
 from pprint import pprint
 
+# Default maximum number of nodes created at the same time.
+DEFAULT_CREATE_PARALLELISM = 4
+
+# Default maximum number of plan groups provisioned at the same time.
+DEFAULT_PROVISION_PARALLELISM = 4
+
+# Default directory where Linode information is cached.
+DEFAULT_CACHE_DIR = 'glusterdata'
+
+
 class GlusterClusterPlan(object):
     
     
@@ -75,10 +98,95 @@ class GlusterClusterPlan(object):
             
             
     
-    def create(self):
-        #TODO assert self.validated
+    def create(self, parallelism = DEFAULT_CREATE_PARALLELISM, resume = False, warm_pool = None):
+        '''
+        Creates and provisions all the nodes of the cluster.
+        
+        Progress is checkpointed in cluster.json. Every node is saved as soon as it's
+        created, with the phases it has completed in its 'phases' list:
+            - 'created' : The node is created.
+            - 'bricks' : Filesystems of its bricks are created and mounted.
+            - 'volume' : The cluster's volume is created over its bricks, tuned and started.
+        If a build fails midway, running it again with resume skips completed work,
+        and only creates and provisions the remaining nodes.
         
+        Time taken by each phase is traced, and the trace is saved in the cluster's
+        directory as trace.json (Chrome trace event format) and trace-summary.txt.
+        
+        Args:
+            - parallelism : Maximum number of nodes created at the same time.
+            - resume : Complete an earlier build of this cluster that failed or was interrupted.
+            - warm_pool : Optional WarmPool. Nodes are claimed from it first, and created
+                only if its pool for their spec is empty. The build does not wait for claimed
+                nodes to be replaced. That's left to the pool's daemon or next refill.
+            
+        Returns:
+            True if all nodes were created and provisioned, and the volume was created.
+            False if some could not be, 
+            if the cluster is already being created by another process, or if it
+            has nodes from an earlier build and resume is not set.
+        '''
+        cluster_info_dir = self._cluster_info_dir()
+        if not os.path.isdir(cluster_info_dir):
+            os.makedirs(cluster_info_dir)
+            
         # Lock the plan to prevent concurrent modifications.
+        plan_lock = FileLock(os.path.join(cluster_info_dir, 'create.lock'))
+        if not plan_lock.acquire(blocking = False):
+            logger.error_msg('Cluster %s is being created by another process' % (self.cluster_label))
+            return False
+            
+        tracer = tracing.start('cluster %s' % (self.cluster_label))
+        try:
+            with tracer.span('create_cluster', cluster = self.cluster_label, resume = resume):
+                return self._create(parallelism, resume, warm_pool)
+        finally:
+            logger.msg(tracer.dump(cluster_info_dir))
+            plan_lock.release()
+            
+            
+    def _cluster_info_dir(self):
+        return os.path.join(self.app_ctx['conf-dir'], 'clusters', self.cluster_label)
+        
+        
+    def _cluster_store(self):
+        '''
+        Returns:
+            StateStore of cluster.json, which has details of created nodes grouped by plan ID.
+        '''
+        # Since Linode objects are not JSON serializable, their __dict__ attributes are serialized.
+        return StateStore(os.path.join(self._cluster_info_dir(), 'cluster.json'), 
+            json_default = lambda o:o.__dict__)
+        
+        
+    def _completed_nodes(self, store):
+        '''
+        Returns:
+            dict of global index -> (plan ID, node) of nodes saved by earlier builds.
+        '''
+        completed = {}
+        for plan_key, nodes_of_plan in store.load(collections.OrderedDict()).items():
+            for node_dict in nodes_of_plan:
+                node_info = linode_core.Linode()
+                node_info.__dict__.update(node_dict)
+                completed[node_info.global_index] = (int(plan_key), node_info)
+        return completed
+        
+        
+    def plan_nodes(self):
+        '''
+        Builds the Linode specs of all nodes of the plan.
+        
+        Returns:
+            (node_requests, brick_mounts) - Tuple. node_requests is a list of NodeRequest in plan 
+                order. brick_mounts is a dict of plan_id -> list of brick mounts of its nodes.
+        '''
+        # Indexes are assigned from the start in every build, so that they match 
+        # the indexes of nodes saved by an earlier build that's being resumed.
+        self.global_node_index = 1
+        for plan_id in self.plan_node_indexes:
+            self.plan_node_indexes[plan_id] = 1
+        
         
         dc = dp.get(self.plan, 'cluster-plan/datacenter')
         dc_id = LinodeStaticInfo.dc_id(dc)
@@ -147,7 +255,8 @@ class GlusterClusterPlan(object):
                     brick_mounts[plan_id].append({
                         'device' : '/dev/' + block_device_names[dev_idx],
                         'mount' : brick['mount'],
-                        'fs' : brick['type']
+                        'fs' : brick['type'],
+                        'size' : size_in_mb
                     })
                     dev_idx += 1
                     
@@ -157,12 +266,9 @@ class GlusterClusterPlan(object):
             storage_plans[plan_id] = disk_plan
         
             
-        core = linode_core.Core(self.app_ctx)
-        
-        # Store details of created Linodes in this list, with nodes grouped by plan_id
-        node_list = {}
-        
-        # Create nodes based on node plan.
+        # Build the specs of all nodes up front, so that every node gets its global and plan
+        # indexes in plan order, regardless of the order in which creations complete.
+        node_requests = []
         for item in cluster_plan['nodes']:
             
             # plan to plan id must already be cached earlier by validate
@@ -174,8 +280,6 @@ class GlusterClusterPlan(object):
             
             count = item['count']
             
-            node_list[plan_id] = []
-            
             for i in range(count):
                 
                 linode_spec = {
@@ -188,48 +292,168 @@ class GlusterClusterPlan(object):
                     'disks' :  storage_plans[plan_id]
                 }
                 
-                logger.msg('\nCreating node #%d in cluster, #%d in plan %d' % (self.global_node_index,
-                    self.plan_node_indexes[plan_id], plan_id))
-                    
-                node_info = core.create_linode(linode_spec)
-                if node_info:
-                    node_info.global_index = self.global_node_index
-                    node_info.plan_index = self.plan_node_indexes[plan_id]
-                    
-                    node_list[plan_id].append(node_info)
+                node_requests.append(NodeRequest(self.global_node_index, 
+                    self.plan_node_indexes[plan_id], plan_id, linode_spec))
                 
                 self.plan_node_indexes[plan_id] += 1
                 self.global_node_index += 1
+                
+        return node_requests, brick_mounts
         
-        # Store details of created nodes.
-        # TODO I think other details like brick mount on each node too should be saved here. Also, since objects are 
-        # not JSON serializable by default, look into replacing Linode object with plain dicts.
         
-        cluster_info_dir = os.path.join(self.app_ctx['conf-dir'], 'clusters', self.cluster_label)
-        os.makedirs(cluster_info_dir)
-        cluster_info_filename = os.path.join(cluster_info_dir, 'cluster.json')
-        with open(cluster_info_filename, 'w') as f:
-            # Since objects are not JSON serializable, we tell simplejson to extract their __dict__ attributes
-            # and serialize that.
-            json.dump(node_list, f, indent = 4 * ' ', default=lambda o:o.__dict__)
+    def _create(self, parallelism, resume, warm_pool):
+        #TODO assert self.validated
         
-        # TODO configure hostnames, FQDNs, DNS related stuff, etc.
+        node_requests, brick_mounts = self.plan_nodes()
         
-        # Create filesystems on nodes which have non-ext bricks.
+        # Create nodes concurrently. As soon as all nodes of a plan are created, 
+        # their bricks are provisioned while nodes of other plans are still being created.
         # TODO https://www.gluster.org/pipermail/gluster-users/2013-March/012697.html suggests creating XFS
         # with inode size to 512 .
-        brickfs_provisioner = BrickFilesystemsProvisioner()
-        brickfs_provisioner.provision_brick_filesystems(node_list, brick_mounts)
+        # Every node is journaled in cluster.json as soon as it's created, so that
+        # nodes created before a failure are not lost.
+        store = self._cluster_store()
+        
+        completed = self._completed_nodes(store)
+        if completed and not resume:
+            logger.error_msg('Cluster %s already has %d nodes from an earlier build. Resume it instead.' % (
+                self.cluster_label, len(completed)))
+            return False
+            
+        completed_nodes = {}
+        for request in node_requests:
+            if request.global_index in completed:
+                plan_id, node_info = completed[request.global_index]
+                if plan_id != request.plan_id:
+                    logger.error_msg('Node #%d was created with plan %d, but the plan now has %d. Cannot resume.' % (
+                        request.global_index, plan_id, request.plan_id))
+                    return False
+                completed_nodes[request.global_index] = node_info
+                
+        if completed_nodes:
+            logger.msg('Resuming: %d of %d nodes are already created' % (len(completed_nodes), len(node_requests)))
         
-        # Mount bricks on all nodes.
-        brickmounts_provisioner = BrickMountsProvisioner()
-        brickmounts_provisioner.provision_brick_mounts(node_list, brick_mounts)
+        brick_provisioner = BrickProvisioner(brick_mounts, store = store)
+        creator = NodeCreator(self.app_ctx, parallelism, store = store, warm_pool = warm_pool)
+        created_nodes = creator.create_nodes(node_requests, group_created = brick_provisioner.submit,
+            completed = completed_nodes)
         
-        # TODO volume provisioning
+        # Store details of created Linodes in this dict, with nodes grouped by plan_id
+        # and ordered by plan index.
+        node_list = collections.OrderedDict()
+        for request, node_info in zip(node_requests, created_nodes):
+            nodes_of_plan = node_list.setdefault(request.plan_id, [])
+            if node_info:
+                nodes_of_plan.append(node_info)
+        
+        # Store details of created nodes, ordered by plan index. This replaces the 
+        # journaled nodes, which are in order of creation.
+        # TODO I think other details like brick mount on each node too should be saved here. Also, since objects are 
+        # not JSON serializable by default, look into replacing Linode object with plain dicts.
+        with tracing.span('write_cluster_json'):
+            store.commit(node_list)
+        
+        # TODO configure hostnames, FQDNs, DNS related stuff, etc.
+        
+        # Wait for brick filesystems and mounts of all plans.
+        with tracing.span('wait_brick_provisioning'):
+            bricks_provisioned = brick_provisioner.wait()
+        
+        # Fold the journaled brick phases into cluster.json.
+        with tracing.span('write_cluster_json'):
+            store.commit(node_list)
+            
+        if not (all(created_nodes) and all(bricks_provisioned.values())):
+            logger.error_msg('Not creating volume of cluster %s, since some nodes were not provisioned' % (
+                self.cluster_label))
+            return False
+            
+        with tracing.span('provision_volume'):
+            volume_provisioned = self._provision_volume(node_requests, created_nodes, brick_mounts, store)
+            
+        with tracing.span('write_cluster_json'):
+            store.commit(node_list)
+        
+        return volume_provisioned
+        
+        
+    def _provision_volume(self, node_requests, created_nodes, brick_mounts, store):
+        '''
+        Creates the cluster's volume over bricks of all nodes, arranged by BrickLayout,
+        with options tuned for the smallest node plan. Options in the plan's optional
+        'volume' section override tuned ones:
+        
+            "volume" : {
+                "name" : "<volume name, cluster label by default>",
+                "replica" : <bricks in each replica set, 1 by default>,
+                "options" : { "<volume option>" : "<value>", ... }
+            }
+        '''
+        nodes = [(request.plan_id, node_info) for request, node_info in zip(node_requests, created_nodes)]
+        if all('volume' in getattr(n, 'phases', []) for plan_id, n in nodes):
+            return True
+        
+        volume_plan = self._volume_plan()
+        replica = volume_plan.get('replica', 1)
+        
+        node_list = collections.OrderedDict()
+        for plan_id, node_info in nodes:
+            node_list.setdefault(plan_id, []).append(node_info)
+        
+        try:
+            layout = BrickLayout(node_list, brick_mounts, replica)
+        except ValueError as e:
+            logger.error_msg('Cannot lay out bricks of volume: %s' % (e))
+            return False
+        logger.msg(layout.describe())
+        
+        plan_ids = set(request.plan_id for request in node_requests)
+        options = plan_tuning_options([LinodeStaticInfo.plan(plan_id) for plan_id in plan_ids])
+        for name, value in volume_plan.get('options', {}).items():
+            options[name] = str(value)
+        
+        provisioner = VolumeProvisioner(volume_plan.get('name', self.cluster_label), options, replica)
+        if not provisioner.provision([(b.node, b.path) for b in layout.bricks()]):
+            return False
+            
+        with store.lock():
+            for plan_id, n in nodes:
+                n.phases.append('volume')
+                store.update([str(plan_id)], {'global_index' : n.global_index}, {'phases' : n.phases})
+        return True
         
         
     
     
+    def _volume_plan(self):
+        return dp.get(self.plan, 'cluster-plan').get('volume', {})
+        
+        
+    def dry_run_volume(self):
+        '''
+        Lays out bricks of the planned nodes without creating anything.
+        
+        Returns:
+            (layout, command) - Tuple. layout is the BrickLayout over NodeRequests, and
+                command is the 'gluster volume create' command, with nodes shown as
+                'node<global index>' since their IPs are not known yet.
+        '''
+        volume_plan = self._volume_plan()
+        replica = volume_plan.get('replica', 1)
+        
+        node_requests, brick_mounts = self.plan_nodes()
+        node_list = collections.OrderedDict()
+        for request in node_requests:
+            node_list.setdefault(request.plan_id, []).append(request)
+            
+        layout = BrickLayout(node_list, brick_mounts, replica)
+        
+        args = VolumeProvisioner(volume_plan.get('name', self.cluster_label), replica = replica).volume_create_args()
+        command = 'gluster volume create %s %s %s' % (volume_plan.get('name', self.cluster_label), args,
+            ' '.join('node%d:%s' % (b.node.global_index, b.path) for b in layout.bricks()))
+        return layout, command
+        
+        
     def validate(self):
         '''
         Validate the cluster plan.
@@ -282,6 +506,10 @@ class GlusterClusterPlan(object):
             if count == 0:
                 dv.add_error("Error in nodes child #%d: count is missing or 0")
                 
+        replica = self._volume_plan().get('replica', 1)
+        if type(replica) is not int or replica < 1:
+            dv.add_error("'volume/replica' should be a positive integer")
+                
         # TODO Validate storage plan
         # TODO Validate that each node plan has corresponding storage plan
         # TODO Validate filesystems and sizes in storage plan
@@ -381,72 +609,515 @@ class GlusterClusterPlan(object):
             raise ValueError("Invalid disk size. Should be '<number> MB|GB|TB': '%s'" % (size))
 
 
-class BrickMountsProvisioner(object):
+# A node to be created. Indexes are assigned before creation starts, so they
+# are deterministic even though nodes are created concurrently.
+NodeRequest = collections.namedtuple('NodeRequest', 
+    ['global_index', 'plan_index', 'plan_id', 'linode_spec'])
+
+
+
+class NodeCreator(object):
+    '''
+    Creates Linodes concurrently, with at most 'parallelism' creations in progress
+    at any time. A failed creation is retried with exponential backoff.
     
-    def provision_brick_mounts(self, node_list, brick_mounts):
-        provisioner = AnsibleProvisioner()
+    Only failures that linode_core.Core reports by returning no Linode are retried. If
+    create_linode raises, like on a timeout, the API may have created the Linode anyway,
+    and retrying would create a duplicate that's never tracked. So the node is taken to
+    have failed, and its Linode group is logged to check for it.
+    '''
+    
+    def __init__(self, app_ctx, parallelism = DEFAULT_CREATE_PARALLELISM, retries = 2, backoff = 10,
+            store = None, warm_pool = None):
+        '''
+        Args:
+            - app_ctx : Application context passed to linode_core.Core
+            - parallelism : Maximum number of nodes created at the same time.
+            - retries : Number of times a failed creation is retried.
+            - backoff : Seconds to wait before the first retry. Doubled for every retry after that.
+            - store : Optional StateStore in which every created node is journaled under its plan ID.
+            - warm_pool : Optional WarmPool from which nodes are claimed before creating new ones.
+        '''
+        assert parallelism >= 1
+        self.app_ctx = app_ctx
+        self.parallelism = parallelism
+        self.retries = retries
+        self.backoff = backoff
+        self.store = store
+        self.warm_pool = warm_pool
         
-        # Since all nodes of same plan have the same mounts, we provision
-        # all nodes of same plan in a batch.
-        for plan_id, nodes_of_plan in node_list.iteritems():
-            mounts_for_plan = brick_mounts[plan_id]
+        
+    def create_nodes(self, node_requests, group_created = None, completed = None):
+        '''
+        Creates all requested nodes and waits till every creation has either 
+        succeeded or exhausted its retries.
+        
+        Args:
+            - node_requests : list of NodeRequest
+            - group_created : Optional function called with (plan_id, list of created Linode objects)
+                as soon as creation of all nodes of a plan has settled. It's called from a creation
+                thread, so it should return quickly.
+            - completed : Optional dict of global index -> Linode object of nodes that are
+                already created, like by an earlier build that's being resumed. They're not created again.
+            
+        Returns:
+            list of created Linode objects in the same order as node_requests. 
+            An entry is None if that node could not be created.
+        '''
+        if not node_requests:
+            return []
+        
+        completed = completed or {}
+        results = [completed.get(request.global_index) for request in node_requests]
+        pending = [i for i, request in enumerate(node_requests) if request.global_index not in completed]
+        remaining = collections.Counter(node_requests[i].plan_id for i in pending)
+        lock = threading.Lock()
+        
+        def nodes_of_plan(plan_id):
+            return [results[j] for j, r in enumerate(node_requests) if r.plan_id == plan_id and results[j]]
+        
+        def create(i):
+            request = node_requests[i]
+            node_info = self._create_node(request)
             
-            targets = [n.public_ip[0] for n in nodes_of_plan]
+            with lock:
+                results[i] = node_info
+                remaining[request.plan_id] -= 1
+                group_done = remaining[request.plan_id] == 0
+                if group_done:
+                    group_nodes = nodes_of_plan(request.plan_id)
+                    
+            if group_done and group_created:
+                group_created(request.plan_id, group_nodes)
+        
+        # Plans whose nodes are all already created are ready right away.
+        if group_created:
+            for plan_id in collections.OrderedDict.fromkeys(request.plan_id for request in node_requests):
+                if remaining[plan_id] == 0:
+                    group_created(plan_id, nodes_of_plan(plan_id))
+        
+        if not pending:
+            return results
             
-            logger.msg("Mounts: %s\nTargets: %s" % (mounts_for_plan, targets))
+        pool = ThreadPool(min(self.parallelism, len(pending)))
+        try:
+            pool.map(create, pending, chunksize = 1)
+        finally:
+            pool.close()
+            pool.join()
             
-            provisioner.exec_playbook(targets, 'ansible/mount_bricks.yaml', 
-                variables = {'mounts':mounts_for_plan})
-
- 
+        return results
+        
+    
+    def _create_node(self, request):
+        # Claim an idle node from the warm pool if there is one.
+        if self.warm_pool:
+            with tracing.span('claim_warm_node', node = request.global_index, plan = request.plan_id):
+                node_info = self.warm_pool.claim(request.linode_spec)
+            if node_info:
+                return self._node_ready(request, node_info)
+        
+        # Each worker uses its own Core, since a Core is not known to be thread safe.
+        core = linode_core.Core(self.app_ctx)
+        
+        delay = self.backoff
+        for attempt in range(self.retries + 1):
+            logger.msg('\nCreating node #%d in cluster, #%d in plan %d (attempt %d)' % (request.global_index,
+                request.plan_index, request.plan_id, attempt + 1))
                 
-class BrickFilesystemsProvisioner(object):
+            try:
+                with tracing.span('create_linode', node = request.global_index, plan = request.plan_id,
+                        attempt = attempt + 1):
+                    node_info = core.create_linode(dict(request.linode_spec))
+            except Exception as e:
+                logger.error_msg('Error creating node #%d: %s. Not retrying, since it may have been created. '
+                    'Check for it in group %s' % (request.global_index, e, request.linode_spec.get('group')))
+                return None
+                
+            if node_info:
+                return self._node_ready(request, node_info)
+                
+            if attempt < self.retries:
+                time.sleep(delay)
+                delay *= 2
+        
+        logger.error_msg('Could not create node #%d' % (request.global_index))
+        return None
+        
+        
+    def _node_ready(self, request, node_info):
+        node_info.global_index = request.global_index
+        node_info.plan_index = request.plan_index
+        node_info.phases = ['created']
+        if self.store:
+            self.store.append([str(request.plan_id)], node_info)
+        return node_info
+
+
+
+class BrickProvisioner(object):
+    '''
+    Creates brick filesystems and mounts bricks, one plan group at a time but with
+    multiple groups provisioned concurrently. Since all nodes of same plan have the
+    same bricks, all nodes of a plan are provisioned in a batch by a single 
+    playbook run that does both.
+    '''
     
-    def provision_brick_filesystems(self, node_list, brick_mounts):
+    def __init__(self, brick_mounts, parallelism = DEFAULT_PROVISION_PARALLELISM, store = None):
+        '''
+        Args:
+            - brick_mounts : dict of plan_id -> list of {'device', 'mount', 'fs'} dicts.
+            - parallelism : Maximum number of plan groups provisioned at the same time.
+            - store : Optional StateStore of cluster.json, in which 'bricks' phase of nodes 
+                is checkpointed once their bricks are provisioned. Nodes that already
+                have that phase are skipped. Nodes on which provisioning failed are not
+                checkpointed, so that they're provisioned again on resume.
+        '''
+        self.brick_mounts = brick_mounts
+        self.store = store
+        self.pool = ThreadPool(parallelism)
+        self.pending = collections.OrderedDict()
+        # Groups are submitted from node creation threads.
+        self.lock = threading.Lock()
+        
+        
+    def submit(self, plan_id, nodes_of_plan):
+        '''
+        Starts provisioning nodes of a plan in background, and returns immediately.
+        '''
+        nodes_of_plan = [n for n in nodes_of_plan if 'bricks' not in getattr(n, 'phases', [])]
+        if not nodes_of_plan or not self.brick_mounts.get(plan_id):
+            return
+        with self.lock:
+            self.pending[plan_id] = self.pool.apply_async(self.provision_group, (plan_id, nodes_of_plan))
+        
+        
+    def wait(self):
+        '''
+        Waits till all submitted groups are provisioned.
+        
+        Returns:
+            dict of plan_id -> True if its nodes were provisioned, False if there was an error.
+        '''
+        self.pool.close()
+        self.pool.join()
+        
+        results = {}
+        for plan_id, result in self.pending.items():
+            try:
+                results[plan_id] = result.get()
+            except Exception as e:
+                logger.error_msg('Error provisioning bricks of plan %d: %s' % (plan_id, e))
+                results[plan_id] = False
+        return results
+        
+        
+    def provision_bricks(self, node_list):
+        '''
+        Provisions all nodes in node_list, a dict of plan_id -> list of nodes, and
+        waits till done.
+        '''
+        for plan_id, nodes_of_plan in node_list.iteritems():
+            self.submit(plan_id, nodes_of_plan)
+        return self.wait()
+        
+        
+    def provision_group(self, plan_id, nodes_of_plan):
+        '''
+        Returns:
+            True if bricks of all nodes were provisioned.
+        '''
+        # Each group uses its own provisioner, since it's not known to be thread safe.
         provisioner = AnsibleProvisioner()
         
+        bricks_for_plan = self.brick_mounts[plan_id]
+        
         # Not all nodes need filesystem provisioning. Only nodes having
         # bricks with FS which are not ext4 require it.
         # We need to define an ansible variable "filesystems" as a list of 
         # {'fs':'<filesystem>,'device':'<blockdevice>'} dicts.
-        # for each set of nodes of same plan and requring non-ext4 filesystems.
-        for plan_id, bricks_for_plan in brick_mounts.iteritems():
-            filesystems = []
+        filesystems = []
+        for brick in bricks_for_plan:
+            if brick['fs'].lower() not in ['ext4', 'ext3']:
+                filesystems.append( {'fs':brick['fs'], 'device':brick['device'] } )
+        
+        targets = [n.public_ip[0] for n in nodes_of_plan]
+        
+        logger.msg("Filesystems: %s\nMounts: %s\nTargets: %s" % (filesystems, bricks_for_plan, targets))
+        
+        with tracing.span('exec_playbook', playbook = 'ansible/provision_bricks.yaml', plan = plan_id,
+                targets = len(targets)):
+            output = provisioner.exec_playbook(targets, 'ansible/provision_bricks.yaml', 
+                variables = {'filesystems':filesystems, 'mounts':bricks_for_plan})
             
-            for brick in bricks_for_plan:
-                if brick['fs'].lower() not in ['ext4', 'ext3']:
-                    filesystems.append( {'fs':brick['fs'], 'device':brick['device'] } )
+        failed = failed_hosts(output, targets)
+        if failed:
+            logger.error_msg('Provisioning bricks of plan %d failed on: %s' % (plan_id, ', '.join(failed)))
             
-            if len(filesystems) > 0:
-                nodes_of_plan = node_list[plan_id]
+        for n in nodes_of_plan:
+            if n.public_ip[0] in failed:
+                continue
+            if not hasattr(n, 'phases'):
+                n.phases = ['created']
+            if self.store:
+                with self.store.lock():
+                    n.phases.append('bricks')
+                    self.store.update([str(plan_id)], {'global_index' : n.global_index}, {'phases' : n.phases})
+            else:
+                n.phases.append('bricks')
                 
-                targets = [n.public_ip[0] for n in nodes_of_plan]
+        return not failed
 
-                logger.msg("Filesystems: %s\nTargets: %s" % (filesystems, targets))
-                
-                provisioner.exec_playbook(targets, 'ansible/create_filesystems.yaml', 
-                    variables = {'filesystems':filesystems})
+    
 
+# A brick in a volume layout. 'node' is a Linode object, or a NodeRequest for a layout
+# of nodes that are not yet created. 'size' is in MB.
+Brick = collections.namedtuple('Brick', ['node', 'plan_id', 'path', 'size'])
+
+
+
+class BrickLayout(object):
+    '''
+    Arranges bricks of a cluster into replica sets, and orders them for 
+    'gluster volume create', which makes every 'replica' consecutive bricks a set.
+    
+    - Failure domain separation: Bricks of a replica set are always on different nodes,
+      so losing a node loses at most one copy of any file.
+    - Capacity: A replica set can only hold as much as its smallest brick. Sets are 
+      formed from bricks of similar sizes, largest first, so little space is stranded 
+      when plans have different brick sizes.
+    - Parallelism: Every brick is used, and among bricks of similar size, those on 
+      nodes with more unassigned bricks are picked first. That spreads each node's 
+      bricks over as many sets as possible, so load on a set is shared by many nodes.
+    '''
     
+    def __init__(self, node_list, brick_mounts, replica = 1):
+        '''
+        Args:
+            - node_list : dict of plan_id -> list of nodes of that plan.
+            - brick_mounts : dict of plan_id -> list of {'mount', 'size', ...} brick dicts.
+            - replica : Number of bricks in each replica set.
+            
+        Raises:
+            ValueError if bricks can't be arranged into replica sets on distinct nodes.
+        '''
+        self.replica = replica
+        
+        # Bricks of each node, largest first.
+        node_bricks = []
+        for plan_id, nodes_of_plan in node_list.items():
+            for node in nodes_of_plan:
+                bricks = [Brick(node, plan_id, brick_path(m), m.get('size', 0)) 
+                    for m in brick_mounts.get(plan_id, [])]
+                if bricks:
+                    node_bricks.append(sorted(bricks, key = lambda b: -b.size))
+                    
+        self.sets = self._arrange(node_bricks, replica)
+        
+        
+    def _arrange(self, node_bricks, replica):
+        total = sum(len(b) for b in node_bricks)
+        if total == 0:
+            raise ValueError('There are no bricks')
+        if total % replica != 0:
+            raise ValueError('%d bricks cannot be split into replica sets of %d' % (total, replica))
+        if len(node_bricks) < replica:
+            raise ValueError('Replica %d needs bricks on at least %d nodes, but only %d nodes have bricks' % (
+                replica, replica, len(node_bricks)))
+            
+        num_sets = total // replica
+        if max(len(b) for b in node_bricks) > num_sets:
+            raise ValueError('A node has more than %d bricks, so 2 of its bricks would be in the same replica set' % (
+                num_sets))
+        
+        sets = []
+        for sets_left in range(num_sets, 0, -1):
+            # A node with a brick for every remaining set must be in this set, or 
+            # it would end up with 2 bricks in a later one.
+            required = [bricks for bricks in node_bricks if len(bricks) == sets_left]
+            others = sorted((bricks for bricks in node_bricks if 0 < len(bricks) < sets_left), 
+                key = lambda bricks: (-bricks[0].size, -len(bricks)))
+            chosen = required + others[:replica - len(required)]
+            sets.append(sorted([bricks.pop(0) for bricks in chosen], key = lambda b: -b.size))
+            
+        return sets
+        
+        
+    def bricks(self):
+        '''
+        Returns:
+            list of Brick in volume order.
+        '''
+        return [b for replica_set in self.sets for b in replica_set]
+        
+        
+    def usable_capacity(self):
+        '''
+        Returns:
+            Usable capacity of the volume in MB.
+        '''
+        return sum(min(b.size for b in replica_set) for replica_set in self.sets)
+        
+        
+    def describe(self):
+        '''
+        Returns:
+            A table of replica sets with their bricks, as a string.
+        '''
+        def node_name(node):
+            # NodeRequests have no IPs yet.
+            if hasattr(node, 'private_ip'):
+                return node.private_ip
+            return 'node%d' % (node.global_index)
+            
+        total = sum(b.size for b in self.bricks())
+        lines = ['Replica %d, %d sets. Raw capacity %d MB, usable %d MB' % (self.replica, len(self.sets),
+            total, self.usable_capacity())]
+        for i, replica_set in enumerate(self.sets):
+            lines.append('  set %d (%d MB): %s' % (i + 1, min(b.size for b in replica_set), 
+                ', '.join('%s:%s (%d MB)' % (node_name(b.node), b.path, b.size) for b in replica_set)))
+        return '\n'.join(lines)
+    
+    
+
+class FrozenDict(Mapping):
+    '''
+    Read-only dict, for indexes shared by all threads that must not be changed by callers.
+    '''
+
+    def __init__(self, *args, **kwargs):
+        self._dict = dict(*args, **kwargs)
+
+    def __getitem__(self, key):
+        return self._dict[key]
+
+    def __iter__(self):
+        return iter(self._dict)
+
+    def __len__(self):
+        return len(self._dict)
+
+    def __repr__(self):
+        return 'FrozenDict(%r)' % (self._dict)
+
+
 
 class LinodeStaticInfo(object):
+    '''
+    Linode plans and datacenters, which rarely change. They're cached on disk 
+    so that starting a command does not require any API calls when the cache is fresh.
+
+    The indexes are frozen, and are only replaced as a whole by load(). Plans are
+    frozen too, since plan() hands them out to callers.
+    '''
+    
+    plans = None
+    dcs = None
+    ids = None
     
+    CACHE_FILENAME = 'linode_static_info.json'
+    
+    # Cached information older than this many seconds is fetched again.
+    DEFAULT_TTL = 24 * 60 * 60
+    
+    @classmethod
+    def load(cls, cache_dir = DEFAULT_CACHE_DIR, ttl = DEFAULT_TTL, refresh = False):
+        '''
+        Loads plans and datacenters from the cache if it's fresh, else from
+        the Linode API and updates the cache.
+        
+        Args:
+            - cache_dir : Directory where the cache file is stored.
+            - ttl : Max age of the cache in seconds.
+            - refresh : If True, ignore the cache and fetch from the API.
+        '''
+        cached = None if refresh else cls._read_cache(cache_dir, ttl)
+        if cached:
+            plans = cached['plans']
+            dcs = cached['dcs']
+        else:
+            plans = lin.get_plans()
+            dcs = lin.get_datacenters()
+            cls._write_cache(cache_dir, plans, dcs)
+        
+        cls._build_indexes(plans, dcs)
+        
+        
     @classmethod
-    def load(cls):
-        cls.plans = lin.get_plans()
-        cls.dcs = lin.get_datacenters()
-        
-        cls.labels_to_ids = {}
-        cls.storage_to_ids = {}
-        cls.ids = []
-        for plan in cls.plans:
+    def invalidate(cls, cache_dir = DEFAULT_CACHE_DIR):
+        '''
+        Deletes the cache so that the next load() fetches from the API.
+        '''
+        cache_file = os.path.join(cache_dir, cls.CACHE_FILENAME)
+        if os.path.isfile(cache_file):
+            os.remove(cache_file)
+    
+    
+    @classmethod
+    def _read_cache(cls, cache_dir, ttl):
+        cache_file = os.path.join(cache_dir, cls.CACHE_FILENAME)
+        if not os.path.isfile(cache_file):
+            return None
+        
+        try:
+            with open(cache_file, 'r') as f:
+                cached = json.load(f)
+        except (IOError, JSONDecodeError) as e:
+            logger.error_msg('Ignoring unreadable cache %s: %s' % (cache_file, e))
+            return None
+        
+        age = time.time() - cached.get('timestamp', 0)
+        if age < 0 or age > ttl:
+            return None
+            
+        return cached
+        
+        
+    @classmethod
+    def _write_cache(cls, cache_dir, plans, dcs):
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        
+        # Write to a temporary file and rename it, so that a concurrently starting
+        # command never sees a partially written cache.
+        cache_file = os.path.join(cache_dir, cls.CACHE_FILENAME)
+        temp_file = '%s.%d.tmp' % (cache_file, os.getpid())
+        with open(temp_file, 'w') as f:
+            json.dump({'timestamp' : time.time(), 'plans' : plans, 'dcs' : dcs}, f)
+        os.rename(temp_file, cache_file)
+        
+        
+    @classmethod
+    def _build_indexes(cls, plans, dcs):
+        labels_to_ids = {}
+        storage_to_ids = {}
+        for plan in plans:
             label = plan['LABEL']
             storage = plan['DISK'] # Just an integer in GB
             id = plan['PLANID']
             
-            cls.ids.append(id)
-            cls.labels_to_ids[label] = id
-            cls.storage_to_ids[storage] = id
+            labels_to_ids[label] = id
+            storage_to_ids[storage] = id
+        
+        # A datacenter can be specified by its ID, abbreviation like 'newark' or 
+        # location like 'Newark, NJ, USA'.
+        dc_names_to_ids = {}
+        for dc in dcs:
+            id = dc['DATACENTERID']
+            dc_names_to_ids[str(id)] = id
+            for key in ('ABBR', 'LOCATION'):
+                if dc.get(key):
+                    dc_names_to_ids[dc[key].lower()] = id
+                    
+        plans = tuple(FrozenDict(plan) for plan in plans)
+        cls.plans = plans
+        cls.plans_by_id = FrozenDict((plan['PLANID'], plan) for plan in plans)
+        cls.dcs = tuple(FrozenDict(dc) for dc in dcs)
+        cls.ids = frozenset(plan['PLANID'] for plan in plans)
+        cls.labels_to_ids = FrozenDict(labels_to_ids)
+        cls.storage_to_ids = FrozenDict(storage_to_ids)
+        cls.dc_names_to_ids = FrozenDict(dc_names_to_ids)
+            
             
     @classmethod
     def is_valid_id(cls, id):
@@ -454,6 +1125,15 @@ class LinodeStaticInfo(object):
         assert cls.ids is not None
         return id in cls.ids
         
+    @classmethod
+    def plan(cls, id):
+        '''
+        Returns:
+            The plan dict, with keys like 'RAM' in MB, 'CORES' and 'DISK' in GB.
+        '''
+        assert cls.plans is not None
+        return cls.plans_by_id[id]
+        
     @classmethod
     def id_from_label(cls, label):
         assert cls.plans is not None
@@ -469,7 +1149,16 @@ class LinodeStaticInfo(object):
     @classmethod
     def dc_id(cls, datacenter):
         assert cls.dcs is not None
-        dc_id = lin.get_datacenter(datacenter, cls.dcs)
+        name = str(datacenter).strip().lower()
+        dc_id = cls.dc_names_to_ids.get(name)
+        if dc_id is None:
+            # Not a name we know of. Let the API resolve it, and remember the answer
+            # in a new index, since the current one may be in use by other threads.
+            dc_id = lin.get_datacenter(datacenter, cls.dcs)
+            if dc_id is not None:
+                names_to_ids = dict(cls.dc_names_to_ids)
+                names_to_ids[name] = dc_id
+                cls.dc_names_to_ids = FrozenDict(names_to_ids)
         return dc_id
         
 
@@ -519,3 +1208,21 @@ class DictValidator(object):
         
     def add_error(self, errormsg):
         self.errors.append(errormsg)
+
+
+
+if __name__ == '__main__':
+    # Prints the brick layout and volume create command of a cluster plan, without creating anything.
+    # $ python cluster_plan.py [--refresh] <CLUSTER-PLAN-FILE>
+    # --refresh fetches Linode plans and datacenters from the API, even if their cache is fresh.
+    args = [arg for arg in sys.argv[1:] if arg != '--refresh']
+    LinodeStaticInfo.load(refresh = '--refresh' in sys.argv[1:])
+    
+    plan = GlusterClusterPlan({'conf-dir' : DEFAULT_CACHE_DIR}, 'dry-run')
+    if plan.load_from_json(args[0]):
+        try:
+            layout, command = plan.dry_run_volume()
+            print(layout.describe())
+            print(command)
+        except ValueError as e:
+            logger.error_msg('Cannot lay out bricks of volume: %s' % (e))
@@ -1,38 +1,251 @@
+'''
+Builds Gluster images in layers, each of which is a playbook run on top of the
+image built by the previous layer.
+
+Every layer has a fingerprint, which is a hash of:
+    - the fingerprint of the previous layer, or the image spec for the first layer.
+    - contents of the layer's playbook and of the task files it includes.
+
+Built layers are recorded in <conf-dir>/image_layers.json with their fingerprints.
+When an image is built, the first layer whose fingerprint has no image yet, and all 
+layers after it, are built on top of the image of the layer before it. So if nothing 
+changed, nothing is built, and if only a later playbook changed, only the later layers
+are built.
+
+Usage:
+-----
+$ python gluster_images.py <IMAGE-LABEL> [--force]
+'''
+
 from image_manager import Image, ImageManager
 from provisioners import AnsibleProvisioner
+from ansible_recap import failed_hosts
 import linode_core
 
+import os
+import re
 import sys
+import json
+import time
+import hashlib
+import collections
 
 import logger
+import tracing
+from state_store import StateStore
+
+
+ImageLayer = collections.namedtuple('ImageLayer', ['name', 'playbook'])
+
+# Layers in build order. Layers that change more often should come later.
+IMAGE_LAYERS = [
+    ImageLayer('gluster', 'ansible/gluster_install.yaml'),
+    ImageLayer('utilities', 'ansible/image_utilities.yaml')
+]
+
+# Matches task files and playbooks included by a playbook.
+INCLUDE_RE = re.compile(r'^\s*-?\s*(?:include|include_tasks|import_tasks|import_playbook)\s*:\s*[\'"]?([^\s\'"]+)')
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+
+def playbook_files(playbook):
+    '''
+    Returns:
+        list of paths of playbook and all task files it includes, directly or 
+        through other included files. Paths are relative to this directory, like playbook.
+    '''
+    files = []
+    pending = [playbook]
+    while pending:
+        path = os.path.normpath(pending.pop(0))
+        if path in files:
+            continue
+        files.append(path)
+        
+        with open(os.path.join(ROOT_DIR, path), 'r') as f:
+            for line in f:
+                m = INCLUDE_RE.match(line)
+                # Included files with variables in their names can't be resolved here.
+                if m and '{{' not in m.group(1):
+                    pending.append(os.path.join(os.path.dirname(path), m.group(1)))
+    return files
+
+
+
+def layer_fingerprints(image_spec, layers = IMAGE_LAYERS):
+    '''
+    Returns:
+        list of fingerprints of layers, in order.
+    '''
+    fingerprints = []
+    previous = json.dumps(image_spec, sort_keys = True)
+    for layer in layers:
+        h = hashlib.sha256()
+        h.update(previous.encode('utf-8'))
+        h.update(layer.name.encode('utf-8'))
+        for path in playbook_files(layer.playbook):
+            with open(os.path.join(ROOT_DIR, path), 'rb') as f:
+                h.update(path.encode('utf-8'))
+                h.update(f.read())
+        previous = h.hexdigest()
+        fingerprints.append(previous)
+    return fingerprints
+
+
 
 class GlusterImages(object):
     
     def __init__(self, app_ctx):
         self.app_ctx = app_ctx
         
+        # Fingerprints of built layers, as
+        #   {'images' : {<IMAGE-LABEL> : {'layer' : ..., 'fingerprint' : ..., 'base' : ...}}}
+        self.layers_store = StateStore(os.path.join(app_ctx['conf-dir'], 'image_layers.json'))
+        
         
         
-    def create_gluster_image(self, image_label, image_spec, delete_on_error = True):
+    def create_gluster_image(self, image_label, image_spec, delete_on_error = True, force = False):
+        '''
+        Builds image_label, skipping layers that are already built with the same inputs.
         
+        Args:
+            - image_label : Label of the image. Images of layers before the last one
+                are labelled <image_label>-<layer name>.
+            - image_spec : Spec of the Linode on which the first layer is built.
+            - force : If True, all layers are built even if they're unchanged.
+        
+        Returns:
+            True if any layer was built, False if the image was up to date, and None
+            if a layer could not be built. Layers after a failed one are not built.
+        '''
         img_mgr = ImageManager(self.app_ctx)
         
-        # TODO these should be read from a JSON file.
-        img = Image(image_label, 'linode', image_spec)
+        # Trace is saved in <conf-dir>/traces/image-<label>.json and image-<label>-summary.txt
+        tracer = tracing.start('image %s' % (image_label))
+        try:
+            with tracer.span('create_image', image = image_label):
+                fingerprints = layer_fingerprints(image_spec)
+                labels = ['%s-%s' % (image_label, layer.name) for layer in IMAGE_LAYERS[:-1]] + [image_label]
+                
+                first_layer = 0 if force else self._first_unbuilt_layer(img_mgr, labels, fingerprints)
+                if first_layer == len(IMAGE_LAYERS):
+                    logger.msg('Image %s is up to date' % (image_label))
+                    return False
+                
+                for i in range(first_layer, len(IMAGE_LAYERS)):
+                    layer = IMAGE_LAYERS[i]
+                    
+                    # First layer is built on a fresh Linode, and the rest on the image 
+                    # of the previous layer.
+                    spec = dict(image_spec)
+                    base_label = None
+                    if i > 0:
+                        base_label = self._built_image(img_mgr, fingerprints[i - 1])
+                        spec.pop('distribution', None)
+                        spec['image'] = base_label
+                    
+                    logger.msg('Building layer %s of image %s on %s' % (layer.name, image_label, 
+                        base_label or image_spec.get('distribution')))
+                    with tracer.span('build_layer', layer = layer.name):
+                        img = Image(labels[i], 'linode', spec)
+                        gluster_image_provisioner = GlusterImageProvisioner([layer.playbook])
+                        created = img_mgr.create_image(img, gluster_image_provisioner, delete_on_error)
+                    
+                    # The fingerprint is saved only for a successful build, so that a failed
+                    # layer is built again next time instead of being taken as up to date.
+                    if not created:
+                        logger.error_msg('Could not build layer %s of image %s' % (layer.name, image_label))
+                        return None
+                    
+                    self.layers_store.set(['images', labels[i]], {
+                        'layer' : layer.name,
+                        'fingerprint' : fingerprints[i],
+                        'base' : base_label,
+                        'created' : int(time.time())
+                    })
+                
+                return True
+        finally:
+            logger.msg(tracer.dump(os.path.join(self.app_ctx['conf-dir'], 'traces'), 
+                'image-%s' % (image_label)))
+    
+    
+    
+    def _first_unbuilt_layer(self, img_mgr, labels, fingerprints):
+        '''
+        Returns:
+            Index of the first layer that has to be built, or number of layers if
+            the image is up to date.
+        '''
+        # Last layer is up to date only if it's built under the requested label.
+        images = self.layers_store.load({}).get('images', {})
+        last = images.get(labels[-1])
+        if last and last['fingerprint'] == fingerprints[-1] and self._image_exists(img_mgr, labels[-1]):
+            return len(fingerprints)
+        
+        # Earlier layers can be reused from any image with the same fingerprint.
+        # Layers after an unbuilt layer are unbuilt too, since their fingerprints
+        # depend on it.
+        for i in range(len(fingerprints) - 1):
+            if not self._built_image(img_mgr, fingerprints[i]):
+                return i
+        return len(fingerprints) - 1
+        
+        
+        
+    def _built_image(self, img_mgr, fingerprint):
+        '''
+        Returns:
+            Label of an existing image with the fingerprint, or None.
+        '''
+        images = self.layers_store.load({}).get('images', {})
+        for label, entry in images.items():
+            if entry['fingerprint'] == fingerprint and self._image_exists(img_mgr, label):
+                return label
+        return None
+        
         
-        gluster_image_provisioner = GlusterImageProvisioner()
-        img_mgr.create_image(img, gluster_image_provisioner, delete_on_error)
+        
+    def _image_exists(self, img_mgr, label):
+        try:
+            return img_mgr.load_image(label) is not None
+        except Exception:
+            return False
         
 
 
 class  GlusterImageProvisioner(AnsibleProvisioner):
     
-    def provision(self, linode):
+    def __init__(self, playbooks = None):
+        '''
+        Args:
+            - playbooks : Playbooks to run, in order. By default, all layers' playbooks.
+        '''
+        super(GlusterImageProvisioner, self).__init__()
+        self.playbooks = playbooks or [layer.playbook for layer in IMAGE_LAYERS]
+        
         
-        logger.msg('Provisioning Gluster on %s' % (linode.public_ip[0]))
-        output = self.exec_playbook(linode.public_ip[0], 'ansible/gluster_install.yaml')
+    def wait_for_ping(self, *args, **kwargs):
+        with tracing.span('wait_for_ping'):
+            return super(GlusterImageProvisioner, self).wait_for_ping(*args, **kwargs)
         
-        # TODO Detect if provisioning failed and return False on error
+        
+    def provision(self, linode):
+        '''
+        Returns:
+            True if all playbooks succeeded. Playbooks after a failed one are not run.
+        '''
+        ip = linode.public_ip[0]
+        logger.msg('Provisioning Gluster on %s' % (ip))
+        for playbook in self.playbooks:
+            with tracing.span('exec_playbook', playbook = playbook):
+                output = self.exec_playbook(ip, playbook)
+            
+            if failed_hosts(output, [ip]):
+                logger.error_msg('Playbook %s failed on %s' % (playbook, ip))
+                return False
         
         return True
     
@@ -40,10 +253,11 @@ class  GlusterImageProvisioner(AnsibleProvisioner):
 if __name__ == '__main__':
     
     image_label = sys.argv[1]
+    force = '--force' in sys.argv[2:]
     
     gluser_img = GlusterImages({'conf-dir' : 'glusterdata'})
     
-    gluser_img.create_gluster_image(image_label, 
+    built = gluser_img.create_gluster_image(image_label, 
         {
             'datacenter' : 'singapore',
             'distribution' : 'Ubuntu 14.04 LTS',
@@ -51,7 +265,9 @@ if __name__ == '__main__':
             'type' : 'linode-image',
             'cluster-type' : 'gluster'
                 
-        }, delete_on_error = True)
+        }, delete_on_error = True, force = force)
+    if built is None:
+        sys.exit(1)
 
     
     #provisioner = AnsibleProvisioner()
@@ -0,0 +1,163 @@
+'''
+Creates the Gluster volume of a cluster over the bricks of its nodes, and sets
+volume options tuned for the hardware of the nodes.
+
+Gluster's defaults are sized for small machines. For example, 16 I/O threads and
+2 event threads per brick process, and a 32MB cache per client. On nodes with more
+cores and RAM, those defaults leave most of the hardware idle. tuning_options()
+scales them with the RAM and cores of the node plans the volume runs on.
+
+Since volume options apply to all bricks of a volume, a volume over nodes of different
+plans is tuned for the smallest of them.
+'''
+
+import collections
+
+from provisioners import AnsibleProvisioner
+
+import logger
+import tracing
+from ansible_recap import failed_hosts
+
+# Bricks are created in this directory under each brick's mount point, since Gluster
+# refuses to use the root of a mount point as a brick.
+BRICK_DIR_NAME = 'brick'
+
+VOLUME_PLAYBOOK = 'ansible/provision_volume.yaml'
+
+
+
+def _clamp(value, lowest, highest):
+    return max(lowest, min(value, highest))
+
+
+
+def tuning_options(ram_mb, cores):
+    '''
+    Derives performance options of a volume from the hardware of its nodes.
+
+    Args:
+        - ram_mb : RAM of a node in MB.
+        - cores : Number of CPU cores of a node.
+
+    Returns:
+        OrderedDict of Gluster volume option -> value, as strings.
+    '''
+    options = collections.OrderedDict()
+
+    # Event threads handle network I/O of brick processes and clients. One per core,
+    # but not less than Gluster's default of 2.
+    options['server.event-threads'] = str(_clamp(cores, 2, 16))
+    options['client.event-threads'] = str(_clamp(cores, 2, 16))
+
+    # I/O threads of a brick do the disk I/O. They mostly wait on disks, so several per core.
+    options['performance.io-thread-count'] = str(_clamp(cores * 8, 16, 64))
+
+    # Client side read cache, 1/8th of RAM.
+    options['performance.cache-size'] = '%dMB' % (_clamp(ram_mb // 8, 32, 4096))
+
+    # Pages read ahead per file. Gluster allows 1 to 16.
+    options['performance.read-ahead-page-count'] = str(_clamp(ram_mb // 1024, 4, 16))
+
+    # Writes buffered per file before they're sent to bricks.
+    options['performance.write-behind-window-size'] = '%dMB' % (_clamp(ram_mb // 512, 1, 64))
+
+    return options
+
+
+
+def plan_tuning_options(linode_plans):
+    '''
+    Args:
+        - linode_plans : Linode plan dicts, with 'RAM' in MB and 'CORES', of the nodes
+            in the volume.
+
+    Returns:
+        OrderedDict of volume option -> value for the smallest of the plans.
+    '''
+    ram_mb = min(int(p['RAM']) for p in linode_plans)
+    cores = min(int(p['CORES']) for p in linode_plans)
+    return tuning_options(ram_mb, cores)
+
+
+
+def brick_path(brick_mount):
+    return '%s/%s' % (brick_mount['mount'].rstrip('/'), BRICK_DIR_NAME)
+
+
+
+class VolumeProvisioner(object):
+    '''
+    Creates, tunes and starts a volume by running a single playbook on the nodes.
+    '''
+
+    def __init__(self, volume_name, options = None, replica = 1):
+        '''
+        Args:
+            - volume_name : Name of the volume.
+            - options : dict of volume option -> value to set on the volume.
+            - replica : Number of bricks in each replica set. 1 for a distribute volume.
+        '''
+        self.volume_name = volume_name
+        self.options = options or {}
+        self.replica = replica
+
+
+    def volume_create_args(self):
+        '''
+        Returns:
+            Arguments of 'gluster volume create' that come before the bricks.
+        '''
+        if self.replica > 1:
+            return 'replica %d transport tcp' % (self.replica)
+        return 'transport tcp'
+
+
+    def provision(self, bricks):
+        '''
+        Creates the volume over bricks if it does not exist, sets its options,
+        and starts it.
+
+        Args:
+            - bricks : list of (Linode object, brick path) in volume order. Gluster makes 
+                every 'replica' consecutive bricks a replica set. The node of the first 
+                brick probes the others into its trusted pool and creates the volume.
+
+        Returns:
+            True if the volume was created and started on all nodes. False if there
+            are no bricks, or the playbook failed on any node.
+        '''
+        if not bricks:
+            logger.error_msg('No bricks for volume %s' % (self.volume_name))
+            return False
+
+        # Nodes talk to each other over private IPs, which don't count towards
+        # transfer quota.
+        brick_dirs = collections.OrderedDict()
+        nodes = []
+        for node, path in bricks:
+            if node.public_ip[0] not in brick_dirs:
+                nodes.append(node)
+            brick_dirs.setdefault(node.public_ip[0], []).append(path)
+
+        variables = {
+            'volume' : self.volume_name,
+            'volume_args' : self.volume_create_args(),
+            'peers' : [n.private_ip for n in nodes[1:]],
+            'brick_dirs' : brick_dirs,
+            'bricks' : ['%s:%s' % (node.private_ip, path) for node, path in bricks],
+            'options' : [{'name' : k, 'value' : v} for k, v in self.options.items()]
+        }
+
+        logger.msg('Creating volume %s with %d bricks. Options: %s' % (self.volume_name, len(bricks),
+            dict(self.options)))
+
+        targets = [n.public_ip[0] for n in nodes]
+        with tracing.span('exec_playbook', playbook = VOLUME_PLAYBOOK, targets = len(targets)):
+            output = AnsibleProvisioner().exec_playbook(targets, VOLUME_PLAYBOOK, variables = variables)
+
+        failed = failed_hosts(output, targets)
+        if failed:
+            logger.error_msg('Creating volume %s failed on: %s' % (self.volume_name, ', '.join(failed)))
+            return False
+        return True
@@ -0,0 +1,125 @@
+'''
+Checks how NodeCreator scales, against a fake linode_core.Core that takes a fixed time
+to create a Linode and never calls the Linode API.
+
+With N nodes, creation latency L and parallelism P, creating all nodes should take about
+ceil(N / P) * L seconds. Every run also checks the retry policy: creations that the
+fake Core fails by returning None are retried, and creations that raise are not retried,
+so no duplicate Linodes are created.
+
+Usage:
+-----
+$ python node_creator_check.py [--nodes 24] [--latency 0.2] [--parallelism 1,4,8]
+
+Exit code is 0 if every run took at most 'tolerance' times the expected time plus one
+round for the retry, and created every node exactly once.
+'''
+
+import sys
+import math
+import time
+import argparse
+import threading
+
+import linode_core
+import cluster_plan
+from cluster_plan import NodeCreator, NodeRequest
+
+
+
+class FakeCore(object):
+    '''
+    Stands in for linode_core.Core. Creation of the node with global index in
+    'fail_once' returns None on its first attempt, and of one in 'raise_after_create'
+    raises after the Linode is counted as created.
+    '''
+
+    latency = 0.2
+    fail_once = set()
+    raise_after_create = set()
+
+    lock = threading.Lock()
+    created = []
+    attempts = []
+
+    def __init__(self, app_ctx):
+        self.app_ctx = app_ctx
+
+
+    def create_linode(self, linode_spec):
+        index = linode_spec['global_index']
+        time.sleep(self.latency)
+
+        with self.lock:
+            first_attempt = index not in FakeCore.attempts
+            FakeCore.attempts.append(index)
+            if index in self.fail_once and first_attempt:
+                return None
+            FakeCore.created.append(index)
+            linode_id = len(FakeCore.created)
+
+        if index in self.raise_after_create:
+            raise IOError('Timed out waiting for API response')
+
+        node_info = linode_core.Linode()
+        node_info.id = linode_id
+        node_info.public_ip = ['10.0.%d.%d' % (linode_id // 256, linode_id % 256)]
+        return node_info
+
+
+
+def check(num_nodes, parallelism, tolerance):
+    '''
+    Returns:
+        True if creation took at most tolerance times the expected time, and
+        every node was created exactly once.
+    '''
+    del FakeCore.created[:]
+    del FakeCore.attempts[:]
+    FakeCore.fail_once = set([1])
+    FakeCore.raise_after_create = set([2]) if num_nodes > 1 else set()
+
+    # Global index is put in the spec, so that the fake Core knows which node it's creating.
+    requests = [NodeRequest(i, i, 1, {'plan_id' : 1, 'group' : 'node-creator-check', 'global_index' : i})
+        for i in range(1, num_nodes + 1)]
+    creator = NodeCreator({'conf-dir' : ''}, parallelism, retries = 2, backoff = 0)
+
+    start = time.time()
+    results = creator.create_nodes(requests)
+    elapsed = time.time() - start
+
+    # Node 1 takes an extra attempt, so one more round is allowed.
+    expected = math.ceil(float(num_nodes) / parallelism) * FakeCore.latency
+    allowed = (expected + FakeCore.latency) * tolerance
+    duplicates = len(FakeCore.created) != len(set(FakeCore.created))
+    missing = [r.global_index for r, node in zip(requests, results) if node is None]
+
+    ok = elapsed <= allowed and not duplicates and missing == sorted(FakeCore.raise_after_create)
+    print('parallelism=%-3d nodes=%d  %.2fs (expected %.2fs)  created=%d attempts=%d  %s' % (
+        parallelism, num_nodes, elapsed, expected, len(FakeCore.created), len(FakeCore.attempts),
+        'OK' if ok else 'FAILED'))
+    return ok
+
+
+
+def parse_options():
+    parser = argparse.ArgumentParser(description = 'Check NodeCreator scaling against a fake linode_core.Core')
+    parser.add_argument('--nodes', type = int, default = 24, help = 'Number of nodes to create. Default: 24')
+    parser.add_argument('--latency', type = float, default = 0.2,
+        help = 'Seconds the fake Core takes to create a node. Default: 0.2')
+    parser.add_argument('--parallelism', default = '1,4,8',
+        help = 'Comma separated parallelisms to check. Default: 1,4,8')
+    parser.add_argument('--tolerance', type = float, default = 1.5,
+        help = 'Allowed ratio of actual to expected time. Default: 1.5')
+    return parser.parse_args()
+
+
+
+if __name__ == '__main__':
+    opts = parse_options()
+
+    FakeCore.latency = opts.latency
+    cluster_plan.linode_core.Core = FakeCore
+
+    results = [check(opts.nodes, int(p), opts.tolerance) for p in opts.parallelism.split(',')]
+    sys.exit(0 if all(results) else 1)
@@ -0,0 +1,463 @@
+'''
+Module to run a file size x block size sweep adaptively, instead of running every
+combination, which can take days for large ranges of sizes.
+
+1. A coarse grid of file sizes and block sizes, every 'coarse-step' powers of 2 apart,
+   is run first.
+2. Every cell is repeated till the 95% confidence interval of its mean throughput is
+   within 'ci' of the mean for every test, or it has been run 'max-reps' times.
+3. Between adjacent cells of the same file size or block size whose throughput differs
+   by more than 'change', like across a cache size cliff or a record size knee, the cell
+   at the midpoint in log scale is added and run. This repeats till no adjacent cells
+   differ that much, they are adjacent powers of 2, or 'max-cells' have been run.
+
+Tests are run by iozone_tests.sh in MULTI mode, with one filesize and blocksize per run,
+or by fio_tests.py. Throughput of a run is the geometric mean of all throughputs in
+its report. iozone reports are in kB/sec or ops/sec, and fio reports in KB/s of reads
+and writes.
+
+Results of all cells are saved in <REPORTS-DIRECTORY>/adaptive_sweep.json after every
+run, and an interrupted sweep continues from them when started again.
+
+Usage:
+-----
+$ python adaptive_sweep.py <TARGET-PATH> <REPORTS-DIRECTORY> --filesizes 64m-16g --blocksizes 4k-16m
+        [--runner iozone|fio] [--labels m-thru-reg,m-thru-dir] [--numprocs 4] [--dryrun]
+'''
+
+from __future__ import print_function
+
+import os
+import re
+import sys
+import json
+import math
+import argparse
+import subprocess
+import collections
+
+from fio_tests import parse_size_kb, run_fio, parse_fio_json
+
+STATE_FILENAME = 'adaptive_sweep.json'
+
+# Two sided 95% critical values of Student's t distribution, for 1 to 10 degrees of freedom.
+T_95 = [12.706, 4.303, 3.182, 2.776, 2.571, 2.447, 2.365, 2.306, 2.262, 2.228]
+
+# Matches lines of iozone throughput mode reports, like
+#   'Children see throughput for  4 initial writers  =  123456.78 kB/sec'
+THROUGHPUT_RE = re.compile('Children see throughput for\s+([0-9]+)\s+(.+?)\s*=\s*([0-9.]+)')
+
+# Matches report file names written by iozone_tests.sh, capturing the label.
+IOZONE_REPORT_RE = re.compile('^ioz-(.+)-[0-9]{4}-[0-9]{2}-[0-9]{2}-[0-9]{2}-[0-9]{2}-[0-9]{2}\.out$')
+
+IOZONE_LABELS = ['m-thru-reg', 'm-thru-sync', 'm-thru-dsync', 'm-thru-dir',
+    'm-ops-reg', 'm-ops-sync', 'm-ops-dsync', 'm-ops-dir']
+
+
+
+def geometric_mean(values):
+    values = [v for v in values if v > 0]
+    if not values:
+        return 0.0
+    return math.exp(sum(math.log(v) for v in values) / len(values))
+
+
+
+def relative_ci(values):
+    '''
+    Returns:
+        Half width of the 95% confidence interval of the mean of values, relative
+        to the mean. None if there are less than 2 values.
+    '''
+    n = len(values)
+    if n < 2:
+        return None
+    mean = sum(values) / float(n)
+    if mean == 0:
+        return 0.0
+    stddev = math.sqrt(sum((v - mean) ** 2 for v in values) / (n - 1))
+    t = T_95[n - 2] if n - 2 < len(T_95) else 1.96
+    return t * stddev / math.sqrt(n) / mean
+
+
+
+def log2_grid(min_kb, max_kb, step):
+    '''
+    Returns:
+        list of sizes in KB that are powers of 2 from min_kb to max_kb, 'step' powers apart.
+        max_kb is always included.
+    '''
+    low = int(math.ceil(math.log(min_kb, 2)))
+    high = int(math.floor(math.log(max_kb, 2)))
+    exponents = list(range(low, high + 1, step))
+    if exponents[-1] != high:
+        exponents.append(high)
+    return [2 ** e for e in exponents]
+
+
+
+def size_label(kb):
+    for unit, factor in (('g', 1024 * 1024), ('m', 1024)):
+        if kb % factor == 0:
+            return '%d%s' % (kb // factor, unit)
+    return '%dk' % (kb)
+
+
+
+class IozoneRunner(object):
+    '''
+    Runs a cell with iozone_tests.sh in MULTI mode.
+    '''
+
+    def __init__(self, target_path, labels=None, numprocs='1', parameters=None):
+        '''
+        Args:
+            - labels : Labels of tests to run, like 'm-thru-reg'. All multi stream tests by default.
+            - numprocs : numprocs flag of iozone_tests.sh, like '4' or '1-4'.
+            - parameters : Other flags passed verbatim to iozone_tests.sh.
+        '''
+        self.script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'iozone_tests.sh')
+        self.target_path = target_path
+        self.labels = labels or IOZONE_LABELS
+        self.numprocs = numprocs
+        self.parameters = parameters or []
+
+
+    def commands(self, filesize, blocksize, reports_dir):
+        return [[self.script, self.target_path, reports_dir, 'MULTI', 'noconfirm', 'numruns=1',
+            'filesizes=%s' % (size_label(filesize)), 'blocksizes=%s' % (size_label(blocksize)),
+            'numprocs=%s' % (self.numprocs), 'labels=%s' % (','.join(self.labels))] + self.parameters]
+
+
+    def run(self, filesize, blocksize, reports_dir):
+        '''
+        Returns:
+            dict of label -> throughput of the run.
+        '''
+        subprocess.call(['bash'] + self.commands(filesize, blocksize, reports_dir)[0])
+
+        # With numruns=1, reports are in the '1' run directory.
+        results = {}
+        run_dir = os.path.join(reports_dir, '1')
+        for filename in sorted(os.listdir(run_dir)) if os.path.isdir(run_dir) else []:
+            m = IOZONE_REPORT_RE.match(filename)
+            if not m:
+                continue
+            with open(os.path.join(run_dir, filename), 'r') as f:
+                values = [float(t.group(3)) for t in (THROUGHPUT_RE.search(line) for line in f) if t]
+            if values:
+                results[m.group(1)] = geometric_mean(values)
+        return results
+
+
+
+class FioRunner(object):
+    '''
+    Runs a cell with fio_tests.py.
+    '''
+
+    def __init__(self, target_path, labels=None, numprocs='1'):
+        '''
+        Args:
+            - labels : '<test>-<mode>' labels of tests to run, like 'randread-dir'.
+            - numprocs : Number of processes, like '4'.
+        '''
+        self.target_path = target_path
+        self.labels = labels or ['write-reg', 'read-reg']
+        self.numprocs = int(numprocs)
+
+
+    def matrix(self, filesize, blocksize):
+        return {'filesizes' : [size_label(filesize)], 'blocksizes' : [size_label(blocksize)],
+            'numprocs' : [self.numprocs], 'iodepths' : [1], 'rwmixes' : [70]}
+
+
+    def commands(self, filesize, blocksize, reports_dir):
+        return [['fio_tests.py', 'run', self.target_path, reports_dir, '--tests', label.rsplit('-', 1)[0],
+            '--modes', label.rsplit('-', 1)[1], '--filesizes', size_label(filesize), '--blocksizes',
+            size_label(blocksize), '--numprocs', str(self.numprocs)] for label in self.labels]
+
+
+    def run(self, filesize, blocksize, reports_dir):
+        if not os.path.isdir(reports_dir):
+            os.makedirs(reports_dir)
+
+        results = {}
+        for label in self.labels:
+            test, mode = label.rsplit('-', 1)
+            report = run_fio(test, mode, self.target_path, reports_dir, self.matrix(filesize, blocksize))
+            if not report:
+                continue
+            with open(report, 'r') as f:
+                columns = parse_fio_json(json.load(f))
+            results[label] = geometric_mean([r + w for r, w in zip(columns['read_bw'], columns['write_bw'])])
+        return results
+
+
+
+class AdaptiveSweep(object):
+
+    def __init__(self, runner, reports_dir, filesizes, blocksizes, coarse_step=2, min_reps=2,
+            max_reps=5, ci=0.05, change=0.25, max_cells=64):
+        '''
+        Args:
+            - runner : IozoneRunner or FioRunner.
+            - filesizes, blocksizes : (min KB, max KB) ranges.
+            - coarse_step : Powers of 2 between adjacent cells of the coarse grid.
+            - min_reps, max_reps : Minimum and maximum runs of a cell. At least 2 runs are
+                needed for a confidence interval.
+            - ci : Target relative half width of 95% confidence intervals.
+            - change : Relative throughput change between adjacent cells above which
+                the cell between them is run.
+            - max_cells : Maximum number of cells to run.
+        '''
+        if min_reps < 2 or max_reps < min_reps:
+            raise ValueError('Need 2 <= min_reps <= max_reps, got %d and %d' % (min_reps, max_reps))
+
+        self.runner = runner
+        self.reports_dir = reports_dir
+        self.filesizes = filesizes
+        self.blocksizes = blocksizes
+        self.coarse_step = coarse_step
+        self.min_reps = min_reps
+        self.max_reps = max_reps
+        self.ci = ci
+        self.change = change
+        self.max_cells = max_cells
+
+        # (filesize, blocksize) -> {label : list of throughputs of each run}
+        self.cells = collections.OrderedDict()
+
+        # (filesize, blocksize) -> number of runs of the cell. A test that failed in a run
+        # has fewer throughputs than that.
+        self.reps = {}
+        self.load()
+
+
+    def state_file(self):
+        return os.path.join(self.reports_dir, STATE_FILENAME)
+
+
+    def load(self):
+        if not os.path.isfile(self.state_file()):
+            return
+        with open(self.state_file(), 'r') as f:
+            for cell in json.load(f)['cells']:
+                key = (cell['filesize'], cell['blocksize'])
+                self.cells[key] = cell['values']
+                self.reps[key] = cell.get('reps', max([len(v) for v in cell['values'].values()] or [0]))
+
+
+    def save(self):
+        if not os.path.isdir(self.reports_dir):
+            os.makedirs(self.reports_dir)
+        temp_file = '%s.%d.tmp' % (self.state_file(), os.getpid())
+        with open(temp_file, 'w') as f:
+            json.dump({'cells' : [{'filesize' : k[0], 'blocksize' : k[1], 'reps' : self.reps.get(k, 0),
+                'values' : v} for k, v in self.cells.items()]}, f, indent=4)
+        os.rename(temp_file, self.state_file())
+
+
+    def coarse_cells(self):
+        return [(f, b) for f in log2_grid(self.filesizes[0], self.filesizes[1], self.coarse_step)
+            for b in log2_grid(self.blocksizes[0], self.blocksizes[1], self.coarse_step)
+            # Like iozone, block sizes larger than the file are not tested.
+            if b <= f]
+
+
+    def full_grid_size(self):
+        return len([(f, b) for f in log2_grid(self.filesizes[0], self.filesizes[1], 1)
+            for b in log2_grid(self.blocksizes[0], self.blocksizes[1], 1) if b <= f])
+
+
+    def is_converged(self, cell):
+        '''
+        Returns:
+            True if the cell has been run max_reps times, or at least min_reps times with
+            confidence intervals within target for all tests. A test that failed in some
+            runs has fewer throughputs, so its interval is wider, or unknown with less than 2.
+        '''
+        reps = self.reps.get(cell, 0)
+        if reps >= self.max_reps:
+            return True
+        if reps < self.min_reps or not self.cells.get(cell):
+            return False
+        cis = [relative_ci(v) for v in self.cells[cell].values()]
+        return all(ci is not None and ci <= self.ci for ci in cis)
+
+
+    def mean(self, cell):
+        '''
+        Returns:
+            dict of label -> mean throughput of the cell.
+        '''
+        return dict((label, sum(v) / len(v)) for label, v in self.cells[cell].items() if v)
+
+
+    def measure(self, cell):
+        '''
+        Runs a cell till it converges.
+        '''
+        while not self.is_converged(cell):
+            rep = self.reps.get(cell, 0) + 1
+            reports_dir = os.path.join(self.reports_dir, '%s-%s' % (size_label(cell[0]), size_label(cell[1])),
+                str(rep))
+            print('\nCELL file %s, block %s: run #%d' % (size_label(cell[0]), size_label(cell[1]), rep))
+
+            results = self.runner.run(cell[0], cell[1], reports_dir)
+            self.reps[cell] = rep
+            values = self.cells.setdefault(cell, {})
+            if not results:
+                print('No results for cell, not repeating it')
+                self.save()
+                return
+
+            for label, value in results.items():
+                values.setdefault(label, []).append(value)
+            self.save()
+
+
+    def refinements(self):
+        '''
+        Returns:
+            list of (score, cell) of unmeasured cells between adjacent measured cells whose
+            throughput changes more than 'change', highest score first.
+        '''
+        measured = [c for c in self.cells if self.cells[c]]
+        candidates = {}
+
+        # axis 0 varies file size with block size fixed, and axis 1 the other way.
+        for axis in (0, 1):
+            lines = collections.defaultdict(list)
+            for cell in measured:
+                lines[cell[1 - axis]].append(cell)
+
+            for fixed, cells in lines.items():
+                cells.sort(key=lambda c: c[axis])
+                for c1, c2 in zip(cells, cells[1:]):
+                    e1, e2 = int(math.log(c1[axis], 2)), int(math.log(c2[axis], 2))
+                    if e2 - e1 < 2:
+                        continue
+
+                    m1, m2 = self.mean(c1), self.mean(c2)
+                    changes = [abs(math.log(m2[l] / m1[l])) for l in m1 if l in m2 and m1[l] > 0 and m2[l] > 0]
+                    score = max(changes or [0])
+                    if score <= math.log(1 + self.change):
+                        continue
+
+                    mid = 2 ** ((e1 + e2) // 2)
+                    cell = (mid, fixed) if axis == 0 else (fixed, mid)
+                    if cell not in self.cells and cell[1] <= cell[0]:
+                        candidates[cell] = max(score, candidates.get(cell, 0))
+
+        return sorted(((s, c) for c, s in candidates.items()), reverse=True)
+
+
+    def run(self):
+        for cell in self.coarse_cells():
+            if len(self.cells) >= self.max_cells and cell not in self.cells:
+                print('Reached maximum of %d cells' % (self.max_cells))
+                return
+            self.measure(cell)
+
+        while True:
+            refinements = self.refinements()
+            if not refinements:
+                break
+            if len(self.cells) >= self.max_cells:
+                print('Reached maximum of %d cells' % (self.max_cells))
+                break
+
+            score, cell = refinements[0]
+            print('\nRefining at file %s, block %s: adjacent cells differ by %.0f%%' % (size_label(cell[0]),
+                size_label(cell[1]), 100 * (math.exp(score) - 1)))
+            self.measure(cell)
+
+
+    def print_plan(self):
+        coarse = self.coarse_cells()
+        print('Coarse grid: %d of %d cells, each run %d to %d times till the 95%% CI is within %.0f%%' % (
+            len(coarse), self.full_grid_size(), self.min_reps, self.max_reps, 100 * self.ci))
+        print('Cells between adjacent cells that differ by more than %.0f%% are added, up to %d cells in all\n' % (
+            100 * self.change, self.max_cells))
+        for cell in coarse:
+            status = ' (done)' if self.is_converged(cell) else ''
+            for cmdline in self.runner.commands(cell[0], cell[1], os.path.join(self.reports_dir,
+                    '%s-%s' % (size_label(cell[0]), size_label(cell[1])), '<RUN>')):
+                print(' '.join(cmdline) + status)
+
+
+    def print_summary(self):
+        runs = sum(self.reps.get(cell, 0) for cell in self.cells)
+        print('\nRan %d cells of %d in the full grid, with %d runs. A full sweep with %d runs per cell is %d runs.' % (
+            len(self.cells), self.full_grid_size(), runs, self.max_reps, self.full_grid_size() * self.max_reps))
+
+        labels = sorted(set(l for values in self.cells.values() for l in values))
+        print('\n%-8s %-8s %5s  %s' % ('file', 'block', 'runs', '  '.join('%14s' % (l) for l in labels)))
+        for cell in sorted(self.cells):
+            values = self.cells[cell]
+            means = self.mean(cell) if values else {}
+            print('%-8s %-8s %5d  %s' % (size_label(cell[0]), size_label(cell[1]), self.reps.get(cell, 0),
+                '  '.join('%14.0f' % (means[l]) if l in means else '%14s' % ('-') for l in labels)))
+
+
+
+def parse_size_range(value):
+    low, sep, high = value.partition('-')
+    return (parse_size_kb(low), parse_size_kb(high or low))
+
+
+
+def parse_options():
+    parser = argparse.ArgumentParser(description='Run a file size x block size sweep adaptively')
+    parser.add_argument('target_path', metavar='TARGET-PATH',
+        help='Directory on target device where test files are created')
+    parser.add_argument('reports_dir', metavar='REPORTS-DIRECTORY')
+    parser.add_argument('--filesizes', required=True, help='File size range MIN-MAX, like 64m-16g')
+    parser.add_argument('--blocksizes', required=True, help='Block size range MIN-MAX, like 4k-16m')
+    parser.add_argument('--runner', choices=['iozone', 'fio'], default='iozone',
+        help='Run cells with iozone_tests.sh or fio_tests.py. Default: iozone')
+    parser.add_argument('--labels',
+        help='Comma separated tests. iozone_tests.sh labels like m-thru-reg, or <test>-<mode> for fio')
+    parser.add_argument('--numprocs', default='1', help='Processes per run. Default: 1')
+    parser.add_argument('--coarse-step', type=int, default=2,
+        help='Powers of 2 between adjacent cells of the coarse grid. Default: 2')
+    parser.add_argument('--min-reps', type=int, default=2, help='Minimum runs of a cell. Default: 2')
+    parser.add_argument('--max-reps', type=int, default=5, help='Maximum runs of a cell. Default: 5')
+    parser.add_argument('--ci', type=float, default=0.05,
+        help='Stop repeating a cell when its 95%% CI is within this fraction of the mean. Default: 0.05')
+    parser.add_argument('--change', type=float, default=0.25,
+        help='Refine between adjacent cells whose throughput differs by more than this fraction. Default: 0.25')
+    parser.add_argument('--max-cells', type=int, default=64, help='Maximum number of cells to run. Default: 64')
+    parser.add_argument('--dryrun', action='store_true', help='Print the coarse plan without running it')
+    parser.add_argument('parameters', nargs='*', metavar='FLAG',
+        help='Other flags passed to iozone_tests.sh, like unmount=/mnt/gluster')
+
+    opts = parser.parse_args()
+    if opts.min_reps < 2:
+        parser.error('--min-reps should be at least 2, to have a confidence interval')
+    if opts.max_reps < opts.min_reps:
+        parser.error('--max-reps should be at least --min-reps')
+    return opts
+
+
+
+if __name__ == '__main__':
+    opts = parse_options()
+
+    labels = opts.labels.split(',') if opts.labels else None
+    if opts.runner == 'iozone':
+        runner = IozoneRunner(opts.target_path, labels, opts.numprocs, opts.parameters)
+    else:
+        runner = FioRunner(opts.target_path, labels, opts.numprocs)
+
+    sweep = AdaptiveSweep(runner, opts.reports_dir, parse_size_range(opts.filesizes),
+        parse_size_range(opts.blocksizes), opts.coarse_step, opts.min_reps, opts.max_reps,
+        opts.ci, opts.change, opts.max_cells)
+
+    if opts.dryrun:
+        sweep.print_plan()
+        sys.exit(0)
+
+    sweep.run()
+    sweep.print_summary()
@@ -0,0 +1,318 @@
+'''
+Module to reset caches between benchmark runs, and verify that they are cold.
+
+Dropping the page cache of the client alone is not enough for a Gluster volume. Reads can
+still be served from memory by:
+    - The io-cache and quick-read translators in the client's FUSE process.
+    - The page caches of the servers' brick file systems.
+So a reset:
+    1. Drops the page cache, dentries and inodes of the client.
+    2. Drops them on every server, over SSH, when servers are given. The client should have
+       passwordless public key SSH access to them, like in DIST mode of iozone_tests.sh.
+    3. Unmounts and mounts the volume again, when a mount point is given, which restarts the
+       FUSE process and empties its translator caches.
+
+In local mode, without servers and mount point, only the client's cache is dropped, which is
+all there is for a plain file system. If caches can't be dropped because this is not run as
+root, files in TARGET-PATH are evicted from the page cache with posix_fadvise instead, so
+that it can be tried without root on a local directory. On python 2, posix_fadvise is
+called from libc with ctypes.
+
+Verification reads a probe file in TARGET-PATH once before the reset to cache it, and measures
+a second, cached read. The probe is read again after the reset, and caches are taken to be cold
+if that read is slower than 'threshold' times the cached read.
+
+Usage:
+-----
+$ python cache_control.py <TARGET-PATH> [--servers [user1@]IP1,[user2@]IP2] [--remount MOUNT-POINT]
+        [--mount-source SERVER:/VOLUME] [--probe-size 64m] [--threshold 0.5] [--noverify]
+
+Exit code is 0 if caches were reset and verified cold, 1 if the reset failed and 2 if caches
+are still warm.
+'''
+
+from __future__ import print_function
+
+import os
+import sys
+import ctypes
+import socket
+import timeit
+import argparse
+import subprocess
+import ctypes.util
+
+from fio_tests import parse_size_kb
+
+# Persisted SSH connections, like iozone_tests.sh uses in DIST mode.
+FAST_SSH_OPTIONS = ['-o', 'ControlMaster=auto', '-o', 'ControlPath=/tmp/ssh%r@%h-%p',
+    '-o', 'ControlPersist=3600', '-o', 'BatchMode=yes']
+
+DROP_CACHES_CMD = 'sync && echo 3 > /proc/sys/vm/drop_caches'
+
+PROBE_CHUNK = 1024 * 1024
+
+# Value of POSIX_FADV_DONTNEED on Linux, for python 2 which doesn't have os.posix_fadvise.
+POSIX_FADV_DONTNEED = 4
+
+# Like time.time on python 2 and time.perf_counter on python 3.
+timer = timeit.default_timer
+
+
+
+def drop_local_caches(target_path=None):
+    '''
+    Drops the page cache, dentries and inodes of this machine. If that's not permitted,
+    evicts the files in target_path from the page cache instead.
+
+    Returns:
+        True if caches were dropped.
+    '''
+    subprocess.call(['sync'])
+    try:
+        with open('/proc/sys/vm/drop_caches', 'w') as f:
+            f.write('3\n')
+        return True
+    except (IOError, OSError) as e:
+        if target_path is None:
+            print('Could not drop caches: %s' % (e))
+            return False
+
+    print('Could not drop caches without root, evicting files in %s instead' % (target_path))
+    return evict_files(target_path)
+
+
+
+def fadvise_dontneed(fd):
+    '''
+    Evicts all pages of an open file from the page cache.
+    '''
+    if hasattr(os, 'posix_fadvise'):
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        return
+
+    # Python 2 has no os.posix_fadvise, so it's called from libc. posix_fadvise64 takes
+    # 64 bit offsets on 32 bit systems too. It returns an error number instead of setting errno.
+    libc = ctypes.CDLL(ctypes.util.find_library('c'))
+    fadvise = getattr(libc, 'posix_fadvise64', None) or libc.posix_fadvise
+    fadvise.argtypes = [ctypes.c_int, ctypes.c_longlong, ctypes.c_longlong, ctypes.c_int]
+    error = fadvise(fd, 0, 0, POSIX_FADV_DONTNEED)
+    if error:
+        raise OSError(error, os.strerror(error))
+
+
+
+def evict_files(target_path):
+    '''
+    Evicts all files under target_path from the page cache with posix_fadvise.
+
+    Returns:
+        True if all files were evicted.
+    '''
+    evicted = True
+    for dirpath, dirnames, filenames in os.walk(target_path):
+        for filename in filenames:
+            try:
+                fd = os.open(os.path.join(dirpath, filename), os.O_RDONLY)
+            except (IOError, OSError):
+                continue
+            try:
+                # Dirty pages can't be evicted, so they're written first.
+                os.fdatasync(fd)
+                fadvise_dontneed(fd)
+            except (IOError, OSError) as e:
+                print('Could not evict %s: %s' % (filename, e))
+                evicted = False
+            finally:
+                os.close(fd)
+    return evicted
+
+
+
+def drop_server_caches(servers):
+    '''
+    Drops caches on all servers in parallel over SSH.
+
+    Args:
+        - servers : list of [user@]host.
+
+    Returns:
+        list of servers where it failed.
+    '''
+    processes = [(server, subprocess.Popen(['ssh'] + FAST_SSH_OPTIONS + [server, DROP_CACHES_CMD]))
+        for server in servers]
+
+    failed = []
+    for server, process in processes:
+        if process.wait() != 0:
+            print('Could not drop caches on %s' % (server))
+            failed.append(server)
+    return failed
+
+
+
+def remount(mount_point, mount_source=None):
+    '''
+    Unmounts and mounts a file system again. Without mount_source, it's mounted by its
+    entry in /etc/fstab.
+
+    Args:
+        - mount_source : Gluster volume like SERVER:/VOLUME.
+
+    Returns:
+        True if it was mounted again.
+    '''
+    if subprocess.call(['umount', mount_point]) != 0:
+        print('Could not unmount %s' % (mount_point))
+        return False
+
+    if mount_source:
+        cmdline = ['mount', '-t', 'glusterfs', mount_source, mount_point]
+    else:
+        cmdline = ['mount', mount_point]
+    if subprocess.call(cmdline) != 0:
+        print('Could not mount %s' % (mount_point))
+        return False
+    return True
+
+
+
+def probe_path(target_path):
+    # Each machine testing a shared mount gets its own probe.
+    return os.path.join(target_path, '.cache_probe-%s' % (socket.gethostname()))
+
+
+
+def write_probe(path, size):
+    '''
+    Writes a probe file of size bytes, if it doesn't already exist with that size.
+    '''
+    if os.path.isfile(path) and os.path.getsize(path) == size:
+        return
+
+    # Random data, so that no layer can compress or deduplicate it.
+    with open(path, 'wb') as f:
+        written = 0
+        while written < size:
+            chunk = os.urandom(min(PROBE_CHUNK, size - written))
+            f.write(chunk)
+            written += len(chunk)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+
+def read_probe(path):
+    '''
+    Returns:
+        Throughput of reading the whole file, in KB/sec.
+    '''
+    start = timer()
+    size = 0
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(PROBE_CHUNK)
+            if not data:
+                break
+            size += len(data)
+    elapsed = timer() - start
+    return size / 1024.0 / max(elapsed, 1e-9)
+
+
+
+class CacheReset(object):
+
+    def __init__(self, target_path, servers=None, mount_point=None, mount_source=None):
+        '''
+        Args:
+            - target_path : Directory on the file system under test.
+            - servers : list of [user@]host whose caches are dropped over SSH.
+            - mount_point : Mount point of the volume, unmounted and mounted again on reset.
+            - mount_source : Gluster volume like SERVER:/VOLUME, to mount it without fstab.
+        '''
+        self.target_path = target_path
+        self.servers = servers or []
+        self.mount_point = mount_point
+        self.mount_source = mount_source
+
+
+    def is_local(self):
+        return not self.servers and not self.mount_point
+
+
+    def reset(self):
+        '''
+        Returns:
+            True if all caches were reset.
+        '''
+        ok = True
+        failed = drop_server_caches(self.servers)
+        if failed:
+            ok = False
+
+        # The remount comes before the client's caches are dropped, since unmounting
+        # flushes the client's dirty pages.
+        if self.mount_point and not remount(self.mount_point, self.mount_source):
+            ok = False
+
+        if not drop_local_caches(self.target_path if self.is_local() else None):
+            ok = False
+        return ok
+
+
+    def reset_and_verify(self, probe_size, threshold):
+        '''
+        Caches a probe file, resets caches and reads the probe again.
+
+        Args:
+            - probe_size : Size of the probe file in bytes.
+            - threshold : Caches are cold if the read after the reset is slower than
+                this fraction of a cached read.
+
+        Returns:
+            (reset succeeded, caches are cold, cached KB/sec, read after reset KB/sec)
+        '''
+        path = probe_path(self.target_path)
+        write_probe(path, probe_size)
+
+        # The first read caches the probe, in case it wasn't, and the second is from caches.
+        read_probe(path)
+        warm = read_probe(path)
+
+        ok = self.reset()
+        cold = read_probe(path)
+        return (ok, cold < warm * threshold, warm, cold)
+
+
+
+def parse_options():
+    parser = argparse.ArgumentParser(description='Reset client and server caches, and verify they are cold')
+    parser.add_argument('target_path', metavar='TARGET-PATH',
+        help='Directory on the file system under test, where the probe file is created')
+    parser.add_argument('--servers', help='Comma separated [user@]host of servers whose caches are dropped over SSH')
+    parser.add_argument('--remount', metavar='MOUNT-POINT', help='Unmount and mount this mount point again')
+    parser.add_argument('--mount-source', metavar='SERVER:/VOLUME',
+        help='Gluster volume to mount at MOUNT-POINT. Default: mount by its /etc/fstab entry')
+    parser.add_argument('--probe-size', default='64m', help='Size of probe file. Default: 64m')
+    parser.add_argument('--threshold', type=float, default=0.5,
+        help='Caches are cold if the probe is read slower than this fraction of a cached read. Default: 0.5')
+    parser.add_argument('--noverify', action='store_true', help='Reset caches without verifying them')
+    return parser.parse_args()
+
+
+
+if __name__ == '__main__':
+    opts = parse_options()
+
+    servers = opts.servers.split(',') if opts.servers else []
+    cache_reset = CacheReset(opts.target_path, servers, opts.remount, opts.mount_source)
+
+    if opts.noverify:
+        sys.exit(0 if cache_reset.reset() else 1)
+
+    ok, cold, warm, after = cache_reset.reset_and_verify(parse_size_kb(opts.probe_size) * 1024, opts.threshold)
+    print('Probe read: %.0f KB/sec cached, %.0f KB/sec after reset (%.0f%%). Caches are %s' % (warm, after,
+        100.0 * after / warm if warm else 0, 'cold' if cold else 'WARM'))
+    if not ok:
+        sys.exit(1)
+    sys.exit(0 if cold else 2)
@@ -6,9 +6,292 @@
 #
 # For throughput write tests, use count=1 so that just 1 single block is read and writtem,
 # and test block sizes from 64K to >RAM.
-dd_out=$(dd if="$1" of="$2" bs=$3 count=$4 iflag=fullblock oflag=sync 2>&1|grep copied|cut -d ',' -f2,3)
-ts=$(date +%H:%M:%S)
-record="$ts,$dd_out"
+#
+# For every run, flag, block size and count, a file of (block size x count) is written
+# to TARGET-PATH with dd, caches are dropped, and the file is read back.
+# Results of each run and flag are saved as a CSV in <REPORTS-DIRECTORY>/<RUN-NUMBER>/,
+# with a .conf file like iozone_tests.sh saves:
+#
+#   dd-<FLAG>-<TIMESTAMP>.csv :
+#       time,test,flag,block_size,count,bytes,seconds,kb_per_sec,usec_per_block
+#       'block_size' is in KB, like iozone record sizes. 'test' is write or read.
+#
+# Store them with 'python iozone_store.py ingest <STORE-DIR> <REPORTS-DIRECTORY>', to
+# compare sets of runs with 'iozone_postproc.py --compare --store <STORE-DIR>'.
+
+
+print_usage() {
+    echo
+    echo 'Usage:'
+    echo
+    echo 'dd_tests.sh <TARGET-PATH> <REPORTS-DIRECTORY> [OPTIONAL FLAGS]'
+    echo
+    echo '  <TARGET-PATH> -> A directory on target device where temp file is created for testing.'
+    echo '  <REPORTS-DIRECTORY> -> Directory where CSV and conf files should be stored.'
+    echo
+    echo 'OPTIONAL FLAGS:'
+    echo '  blocksizes=s1,s2,... -> Block sizes, comma separated. Default: 64k,256k,1m,4m,16m,64m,256m,1g'
+    echo '  counts=c1,c2,... -> Number of blocks per test, comma separated. Default: 1'
+    echo '  flags=f1,f2,... -> Any of direct,dsync,sync,fsync,fdatasync,none. Default: all except none'
+    echo '      direct -> O_DIRECT writes and reads.'
+    echo '      dsync, sync -> Writes with O_DSYNC or O_SYNC.'
+    echo '      fsync, fdatasync -> Buffered writes, followed by fsync or fdatasync before dd exits.'
+    echo '      none -> Buffered writes.'
+    echo '  numruns=NUMBER-OF-RUNS -> Repeat all tests # times, to measure variance. Default: 3'
+    echo '  runwait=SECONDS -> Interval between runs, in seconds. Default: 0'
+    echo '  input=FILE -> Source of written data. Default: /dev/zero'
+    echo '  nodropcache -> Do not drop caches before reads. Caches can be dropped only as root.'
+    echo '  dryrun -> Print dd command lines without running them.'
+}
+
+
+# $@ -> Args received by script
+parse_args() {
+    if [ "x$1" == "x" ]; then
+        echo "TARGET-PATH not given."
+        print_usage
+        exit 1
+    fi
+
+    if [ "x$2" == "x" ]; then
+        echo "REPORTS-DIR not given."
+        print_usage
+        exit 1
+    fi
+
+    target_path="$1"
+
+    reports_dir="$2"
+    mkdir -p "$reports_dir"
+
+    for arg in "${@:3}"
+    do
+        argname=$(echo "$arg" | cut -d '=' -f1)
+        argval="$(echo "$arg" | cut -d '=' -f2)"
+        case "$argname" in
+            blocksizes )
+                blocksize_set=($(echo "$argval"|tr ',' ' '))
+                ;;
+
+            counts )
+                count_set=($(echo "$argval"|tr ',' ' '))
+                ;;
+
+            flags )
+                flag_set=($(echo "$argval"|tr ',' ' '))
+                ;;
+
+            numruns )
+                numruns=$argval
+                ;;
+
+            runwait )
+                runwait=$argval
+                ;;
+
+            input )
+                input_file="$argval"
+                ;;
+
+            nodropcache )
+                nodropcache=true
+                ;;
+
+            dryrun )
+                dryrun=true
+                ;;
+
+            * )
+                echo "Ignoring unknown argument: $argname"
+                ;;
+        esac
+    done
+
+    # Set defaults for all variables.
+    if [ -z "$blocksize_set" ]; then
+        blocksize_set=(64k 256k 1m 4m 16m 64m 256m 1g)
+    fi
+
+    if [ -z "$count_set" ]; then
+        count_set=(1)
+    fi
+
+    if [ -z "$flag_set" ]; then
+        flag_set=(direct dsync sync fsync fdatasync)
+    fi
+
+    for flag in "${flag_set[@]}"; do
+        if [ -z "$(write_flags $flag)" -a "$flag" != "none" ]; then
+            echo "Invalid flag: $flag"
+            exit 1
+        fi
+    done
+
+    if [ -z $numruns ]; then
+        numruns=3
+    fi
+
+    if [ -z $runwait ]; then
+        runwait=0
+    fi
+
+    if [ -z "$input_file" ]; then
+        input_file=/dev/zero
+    fi
+
+    test_file="$target_path/ddtest.tmp"
+}
+
+
+# Prints dd options for writing with a flag.
+# $1: flag
+write_flags() {
+    case "$1" in
+        direct ) echo "oflag=direct" ;;
+        dsync ) echo "oflag=dsync" ;;
+        sync ) echo "oflag=sync" ;;
+        fsync ) echo "conv=fsync" ;;
+        fdatasync ) echo "conv=fdatasync" ;;
+    esac
+}
+
+
+# Prints dd options for reading with a flag. Only direct I/O changes how reads are done.
+# $1: flag
+read_flags() {
+    if [ "$1" == "direct" ]; then
+        echo "iflag=direct,fullblock"
+    else
+        echo "iflag=fullblock"
+    fi
+}
+
+
+# Prints a size like 64k, 16m or 1g in KB. A number without units is in bytes, like in dd.
+# $1: size
+size_in_kb() {
+    local num=$(echo "$1" | sed 's/[^0-9]//g')
+    case "$(echo "$1" | tr -d '0-9' | tr [:upper:] [:lower:])" in
+        k ) echo $num ;;
+        m ) echo $((num * 1024)) ;;
+        g ) echo $((num * 1024 * 1024)) ;;
+        * ) echo $((num / 1024)) ;;
+    esac
+}
+
+
+drop_cache() {
+    if [ ! -z "$nodropcache" ]; then
+        return
+    fi
+    if [ ! -z "$dryrun" ]; then
+        echo "Dry run: drop caches"
+        return
+    fi
+    sync
+    if ! echo 3 > /proc/sys/vm/drop_caches 2> /dev/null; then
+        echo "Could not drop caches. Run as root, or give nodropcache flag."
+        exit 1
+    fi
+}
+
+
+# Runs dd and appends a CSV record of its result to the report.
+# $1: test type, write or read
+# $2: flag
+# $3: block size
+# $4: count
+# $@: dd arguments from 5th onwards
+run_dd() {
+    local dd_args="${@:5}"
+
+    if [ ! -z "$dryrun" ]; then
+        echo "Dry run: dd $dd_args"
+        return
+    fi
+
+    # Last line of dd's output is like
+    #   "1048576 bytes (1.0 MB, 1.0 MiB) copied, 0.00123 s, 852 MB/s"
+    # Throughput is calculated from bytes and seconds, since dd reports it in varying units.
+    # WARN: Don't put $dd_args in double quotes, so that it's sent as separate arguments.
+    local dd_out=$(dd $dd_args 2>&1 | tail -1)
+    local bytes=$(echo "$dd_out" | awk '{print $1}')
+    local secs=$(echo "$dd_out" | awk -F ', ' '{print $(NF-1)}' | awk '{print $1}')
+
+    if ! [[ "$bytes" =~ ^[0-9]+$ ]]; then
+        echo "dd failed: $dd_out"
+        return
+    fi
+
+    local kbps=$(awk "BEGIN{ if ($secs > 0) printf \"%.1f\", $bytes / 1024 / $secs; else print 0 }")
+    local usec=$(awk "BEGIN{ printf \"%.1f\", $secs * 1000000 / $4 }")
+    local record="$(date +%H:%M:%S),$1,$2,$(size_in_kb $3),$4,$bytes,$secs,$kbps,$usec"
+    echo "$record" >> "$report_file"
+    echo "$1 $2 bs=$3 count=$4: $kbps KB/s, $usec usec/block"
+}
+
+
+# Runs write and read tests of all block sizes and counts with a flag.
+# In a dry run, only the commands are printed, and no reports are written.
+# $1: flag
+flag_tests() {
+    local flag=$1
+    local start_ts=$(date +%Y-%m-%d-%H-%M-%S)
+    report_file="$reports_dir/$current_run/dd-$flag-$start_ts.csv"
+    local test_info_file="$reports_dir/$current_run/dd-$flag-$start_ts.conf"
+
+    if [ -z "$dryrun" ]; then
+        echo "time,test,flag,block_size,count,bytes,seconds,kb_per_sec,usec_per_block" > "$report_file"
+    fi
+
+    for bs in "${blocksize_set[@]}"; do
+        for count in "${count_set[@]}"; do
+            # dd takes K, M and G suffixes in upper case.
+            local dd_bs=$(echo "$bs" | tr [:lower:] [:upper:])
+
+            run_dd write $flag $bs $count if="$input_file" of="$test_file" bs=$dd_bs count=$count \
+                iflag=fullblock $(write_flags $flag)
+
+            # Without dropping caches, the read would be served from memory.
+            drop_cache
+
+            run_dd read $flag $bs $count if="$test_file" of=/dev/null bs=$dd_bs count=$count \
+                $(read_flags $flag)
+
+            rm -f "$test_file"
+        done
+    done
+
+    if [ ! -z "$dryrun" ]; then
+        return
+    fi
+
+    local end_ts=$(date +%Y-%m-%d-%H-%M-%S)
+    echo "path=$target_path" > "$test_info_file"
+    echo "start=$start_ts" >> "$test_info_file"
+    echo "end=$end_ts" >> "$test_info_file"
+    echo "flag=$flag" >> "$test_info_file"
+}
+
+
+run_tests() {
+    for current_run in $(seq $numruns); do
+        printf "\n\nRUN #$current_run ******\n\n"
+        if [ -z "$dryrun" ]; then
+            mkdir -p "$reports_dir/$current_run"
+        fi
+
+        for flag in "${flag_set[@]}"; do
+            flag_tests $flag
+        done
+
+        if [ $current_run -lt $numruns -a -z "$dryrun" ]; then
+            echo "Waiting for $runwait seconds before next run"
+            sleep $runwait
+        fi
+    done
+}
+
 
-# For read tests, first drop cached data.
-echo 3 > /proc/sys/vm/drop_caches
+parse_args "$@"
+run_tests
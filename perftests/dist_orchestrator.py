@@ -0,0 +1,620 @@
+'''
+Module to run iozone_tests.sh MULTI tests on multiple machines at the same time
+and collect their reports. It's an alternative to the DIST mode of iozone_tests.sh.
+
+DIST mode launches workers one after another, and then checks every machine in turn
+over SSH every 'checkperiod' seconds to see if its tests have completed. Instead, this
+orchestrator:
+    - copies the script to and launches tests on all machines concurrently.
+    - keeps a waiter per machine that blocks until the tests on that machine complete,
+      so completion is noticed as soon as it happens instead of at the next check.
+    - downloads reports of a machine as soon as it completes, while others are still running.
+
+SSH connections are multiplexed with ControlMaster, so the many short SSH sessions
+reuse a single connection per machine.
+
+Workers are started together by a start barrier instead of a start time estimated from
+number of machines. The orchestrator listens on a TCP port, and before every test each
+worker connects to it and blocks until all workers have connected. Then all of them are
+released at the same moment. Since tests on different machines can take different
+times, this keeps them overlapping throughout a long sweep, not just at the start.
+Every worker records its start skew, the delay between the release and the moment it
+was actually released, in the .conf file of the test. The skew includes any clock
+difference between the worker and the orchestrator, so keep clocks synchronized with NTP.
+Barrier releases are logged in REPORTS-DIRECTORY/barrier.log.
+
+For testing without a cluster, machines can be local directories with --local-machines.
+Each such machine runs the script as a local process in its own directory.
+
+Reports of each machine are downloaded to REPORTS-DIRECTORY/<MACHINE>, where <MACHINE> is
+its address, or its directory path with '/' replaced by '_' for local machines.
+
+Usage:
+-----
+$ python dist_orchestrator.py <TARGET-PATH> <REPORTS-DIRECTORY> --machines [user1@]IP1,[user2@]IP2,...
+    [--remote-reports DIR] [--nolocal] [--barrier-host HOST|--no-barrier]
+    [-- OPTIONAL FLAGS OF iozone_tests.sh]
+
+example:
+$ python dist_orchestrator.py /mnt/gluster ./reports --machines root@10.0.0.2,root@10.0.0.3 \\
+    -- numprocs=4 filesizes=1g blocksizes=1m
+'''
+
+from __future__ import print_function
+
+import os
+import re
+import sys
+import time
+import shutil
+import socket
+import argparse
+import threading
+import subprocess
+from multiprocessing.pool import ThreadPool
+
+try:
+    import Queue as queue
+    import SocketServer as socketserver
+except ImportError:
+    import queue
+    import socketserver
+
+# Persist SSH connections for upto 1 hour, same as iozone_tests.sh.
+SSH_OPTIONS = ['-o', 'ControlMaster=auto', '-o', 'ControlPath=/tmp/ssh%r@%h-%p',
+    '-o', 'ControlPersist=3600', '-o', 'ServerAliveInterval=60']
+
+DEFAULT_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'iozone_tests.sh')
+
+# Started by the script when 'sample' flag is given, so it's copied along with the script.
+SAMPLER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'io_sampler.py')
+
+# Run by the script to reset caches when any of CACHE_FLAGS is given. It imports fio_tests.py.
+CACHE_SCRIPTS = [os.path.join(os.path.dirname(os.path.abspath(__file__)), name)
+    for name in ('cache_control.py', 'fio_tests.py')]
+CACHE_FLAGS = ['cacheservers', 'remount', 'verifycache']
+
+# Same file that iozone_tests.sh looks for to terminate itself.
+TERMINATE_FILE = './.iostests_terminate'
+
+# Seconds between launching the workers and the time at which they start testing.
+# Since all workers are launched concurrently, this does not depend on number of machines.
+DEFAULT_START_DELAY = 15
+
+# Seconds a worker waits at the barrier for other workers, before starting anyway.
+DEFAULT_BARRIER_TIMEOUT = 3600
+
+
+
+def reports_subdir(machine):
+    '''
+    Returns:
+        Name of the subdirectory of the reports directory in which reports of a machine
+        are saved. Machine names can be addresses or absolute paths of local machines,
+        so anything other than a plain file name character is replaced.
+    '''
+    return re.sub('[^A-Za-z0-9@.-]+', '_', machine.name.strip('/')) or 'machine'
+
+
+
+class SshMachine(object):
+    '''
+    A remote machine reachable over passwordless public key SSH.
+    '''
+
+    def __init__(self, address):
+        self.address = address
+        self.name = address
+
+
+    def reports_path(self, reports_dir):
+        return reports_dir
+
+
+    def copy_script(self, script):
+        subprocess.check_call(['scp'] + SSH_OPTIONS + [script, '%s:.' % (self.address)])
+
+
+    def launch(self, cmdline, reports_dir):
+        '''
+        Starts cmdline in background on the machine with nohup, so that it does not
+        depend on any SSH session staying connected.
+
+        Returns:
+            PID of the remote process.
+        '''
+        remote_cmd = 'mkdir -p %s; nohup %s < /dev/null > %s/iozone_tests.log 2> /dev/null & echo $!' % (
+            reports_dir, cmdline, reports_dir)
+        output = subprocess.check_output(['ssh'] + SSH_OPTIONS + [self.address, remote_cmd])
+        return int(output.strip())
+
+
+    def wait(self, pid):
+        '''
+        Blocks until the remote process exits. tail --pid exits as soon as the process does.
+        If the SSH session breaks, it's reopened and waiting continues.
+        '''
+        while True:
+            status = subprocess.call(['ssh'] + SSH_OPTIONS + [self.address,
+                'tail --pid=%d -f /dev/null' % (pid)])
+
+            # ssh exits with 255 on connection errors.
+            if status != 255:
+                return
+
+            print('Lost connection to %s while waiting. Reconnecting...' % (self.address))
+            time.sleep(10)
+
+
+    def terminate(self):
+        subprocess.call(['ssh'] + SSH_OPTIONS + [self.address, './iozone_tests.sh terminate'])
+
+
+    def fetch_reports(self, remote_reports_dir, local_dir):
+        if not os.path.isdir(local_dir):
+            os.makedirs(local_dir)
+        subprocess.check_call(['rsync', '-a', '-e', 'ssh ' + ' '.join(SSH_OPTIONS),
+            '%s:%s/' % (self.address, remote_reports_dir), local_dir])
+
+
+
+class LocalMachine(object):
+    '''
+    A "machine" that is a local directory, in which the script runs as a local process.
+    Used for the local machine itself, and for testing the orchestrator without a cluster.
+    '''
+
+    def __init__(self, workdir, name = None):
+        self.workdir = workdir
+        self.name = name or workdir
+
+
+    def reports_path(self, reports_dir):
+        '''
+        Returns:
+            reports_dir relative to the machine's directory, like a remote machine would have
+            it under its own root, so that local machines don't share a reports directory.
+        '''
+        return reports_dir.lstrip(os.sep) or '.'
+
+
+    def copy_script(self, script):
+        if not os.path.isdir(self.workdir):
+            os.makedirs(self.workdir)
+        dest = os.path.join(self.workdir, os.path.basename(script))
+        if os.path.abspath(script) != os.path.abspath(dest):
+            shutil.copy(script, dest)
+
+
+    def launch(self, cmdline, reports_dir):
+        '''
+        Returns:
+            The Popen of the local process.
+        '''
+        reports_path = os.path.join(self.workdir, reports_dir)
+        if not os.path.isdir(reports_path):
+            os.makedirs(reports_path)
+        log = open(os.path.join(reports_path, 'iozone_tests.log'), 'w')
+        return subprocess.Popen(['bash', '-c', cmdline], cwd = self.workdir,
+            stdin = open(os.devnull, 'r'), stdout = log, stderr = subprocess.STDOUT)
+
+
+    def wait(self, process):
+        process.wait()
+
+
+    def terminate(self):
+        open(os.path.join(self.workdir, TERMINATE_FILE), 'a').close()
+
+
+    def fetch_reports(self, remote_reports_dir, local_dir):
+        src_dir = os.path.join(self.workdir, remote_reports_dir)
+        if os.path.abspath(src_dir) == os.path.abspath(local_dir):
+            return
+
+        for dirpath, dirnames, filenames in os.walk(src_dir):
+            dest_dir = os.path.join(local_dir, os.path.relpath(dirpath, src_dir))
+            if not os.path.isdir(dest_dir):
+                os.makedirs(dest_dir)
+            for filename in filenames:
+                shutil.copy2(os.path.join(dirpath, filename), dest_dir)
+
+
+
+class StartBarrier(object):
+    '''
+    A reusable barrier. Every time all parties have arrived for the same test, they're
+    released together and the barrier resets for the next run of that test.
+
+    Arrivals are counted per test label, so workers at different tests never release each
+    other. A machine is at one test at a time, so when it arrives, its earlier arrival
+    for any test is replaced, like one left behind when the worker gave up waiting.
+    '''
+
+    def __init__(self, parties, log_file = None):
+        self.parties = parties
+        self.log_file = log_file
+
+        self.cond = threading.Condition()
+        # Test label -> number of times it was released.
+        self.generations = {}
+        # Test label -> {machine index -> (arrival token, arrival time)}
+        self.arrivals = {}
+        # (test label, generation) -> release time
+        self.release_times = {}
+
+
+    def wait(self, machine, label, timeout):
+        '''
+        Blocks till all parties have arrived for label, or timeout seconds have passed.
+
+        Args:
+            - machine : Index of the arriving machine.
+            - label : Label of the test it's going to start.
+
+        Returns:
+            Epoch time at which the barrier was released, or None on timeout, or if
+            the machine arrived again before it was released.
+        '''
+        with self.cond:
+            # The waiter of an earlier arrival is woken up to give up.
+            for arrivals in self.arrivals.values():
+                if arrivals.pop(machine, None):
+                    self.cond.notify_all()
+
+            generation = self.generations.get(label, 0)
+            token = object()
+            arrivals = self.arrivals.setdefault(label, {})
+            arrivals[machine] = (token, time.time())
+
+            if len(arrivals) >= self.parties:
+                self._release(label)
+            else:
+                deadline = time.time() + timeout
+                while self.generations.get(label, 0) == generation:
+                    if self.arrivals.get(label, {}).get(machine, (None,))[0] is not token:
+                        return None
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        del self.arrivals[label][machine]
+                        return None
+                    self.cond.wait(remaining)
+
+            return self.release_times[(label, generation)]
+
+
+    def remove_party(self, machine = None):
+        '''
+        Called when a party will not arrive any more, like when its tests have completed,
+        so that others don't wait for it.
+
+        Args:
+            - machine : Index of the machine, whose earlier arrival is discarded.
+        '''
+        with self.cond:
+            self.parties -= 1
+            for label, arrivals in list(self.arrivals.items()):
+                arrivals.pop(machine, None)
+                if arrivals and len(arrivals) >= self.parties:
+                    self._release(label)
+            self.cond.notify_all()
+
+
+    def _release(self, label):
+        arrivals = self.arrivals.pop(label)
+        generation = self.generations.get(label, 0)
+        release_time = time.time()
+        first_arrival = min(a[1] for a in arrivals.values())
+        if self.log_file:
+            with open(self.log_file, 'a') as f:
+                f.write('release=%s:%d time=%.6f waited=%.3f arrivals=%s\n' % (label, generation,
+                    release_time, release_time - first_arrival,
+                    ','.join(str(m) for m in sorted(arrivals))))
+
+        self.release_times[(label, generation)] = release_time
+        self.generations[label] = generation + 1
+        self.cond.notify_all()
+
+
+class BarrierServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    '''
+    TCP rendezvous for StartBarrier. A worker sends a line "READY <MACHINE-INDEX> <TEST-LABEL>"
+    and blocks reading the reply. When all workers are ready, each receives "GO <RELEASE-EPOCH>".
+    '''
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, barrier, port = 0, timeout = DEFAULT_BARRIER_TIMEOUT):
+        socketserver.TCPServer.__init__(self, ('', port), BarrierRequestHandler)
+        self.barrier = barrier
+        self.barrier_timeout = timeout
+
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+
+    def start(self):
+        thread = threading.Thread(target = self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+
+
+class BarrierRequestHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        tokens = self.rfile.readline().split()
+        if len(tokens) < 2 or tokens[0] != b'READY':
+            return
+
+        machine = tokens[1].decode()
+        label = ' '.join(t.decode() for t in tokens[2:])
+        release_time = self.server.barrier.wait(machine, label, self.server.barrier_timeout)
+        if release_time is not None:
+            try:
+                self.wfile.write(('GO %.6f\n' % (release_time)).encode())
+            except socket.error:
+                # The worker gave up waiting.
+                pass
+
+
+
+def default_barrier_host(machines):
+    '''
+    Returns the local IP address which machines can use to reach this machine.
+    '''
+    remote = [m for m in machines if isinstance(m, SshMachine)]
+    if not remote:
+        return '127.0.0.1'
+
+    # Connecting a UDP socket sends nothing, but selects the local address
+    # used to route to the machine.
+    host = remote[0].address.split('@')[-1]
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        s.connect((host, 22))
+        return s.getsockname()[0]
+    finally:
+        s.close()
+
+
+
+class Orchestrator(object):
+    '''
+    Runs iozone_tests.sh in MULTI mode on a set of machines and collects their reports
+    in '<REPORTS-DIRECTORY>/<MACHINE-NAME>'.
+    '''
+
+    def __init__(self, machines, target_path, reports_dir, remote_reports_dir = None,
+            parameters = None, local_machine = None, script = DEFAULT_SCRIPT,
+            start_delay = DEFAULT_START_DELAY, barrier_host = None, barrier_port = 0):
+        '''
+        Args:
+            - machines : list of SshMachine or LocalMachine objects to run tests on.
+            - target_path : TARGET-PATH for the tests.
+            - reports_dir : Local directory where reports of all machines are collected.
+            - remote_reports_dir : Directory where the machines save their reports. Same as
+                reports_dir if not specified.
+            - parameters : list of optional flags passed verbatim to iozone_tests.sh
+            - local_machine : If given, a LocalMachine on which tests are also run, with
+                reports saved directly in reports_dir.
+            - script : Path of iozone_tests.sh
+            - start_delay : Seconds after launch at which all machines start testing. Used only
+                if there is no start barrier.
+            - barrier_host : Address at which workers can reach this machine. If None, no
+                start barrier is used.
+            - barrier_port : Port of the start barrier. By default, any free port.
+        '''
+        self.machines = machines
+        self.target_path = target_path
+        self.reports_dir = reports_dir
+        self.remote_reports_dir = remote_reports_dir or reports_dir
+        self.parameters = parameters or []
+        self.local_machine = local_machine
+        self.script = script
+        self.start_delay = start_delay
+        self.barrier_host = barrier_host
+        self.barrier_port = barrier_port
+
+        self.events = queue.Queue()
+        self.barrier = None
+
+
+    def cmdline(self, reports_dir, machine_index, startat, leader = True):
+        '''
+        Args:
+            - leader : False for all but the first worker. Only the leader drops caches of
+                cacheservers, so that they're dropped once before every test.
+        '''
+        if self.barrier:
+            start_flag = 'barrier=%s:%d' % (self.barrier_host, self.barrier_server.port)
+        else:
+            start_flag = 'startat=%d' % (startat)
+        parameters = [p for p in self.parameters if leader or not p.startswith('cacheservers=')]
+        return ' '.join(['./%s' % (os.path.basename(self.script)), self.target_path, reports_dir,
+            'MULTI', 'noconfirm'] + parameters +
+            [start_flag, 'machineindex=%d' % (machine_index)])
+
+
+    def barrier_timeout(self):
+        '''
+        Returns:
+            Seconds to wait at the barrier, from the barriertimeout= flag of the workers,
+            so that the barrier gives up on a test at the same time as they do.
+        '''
+        for p in self.parameters:
+            if p.startswith('barriertimeout='):
+                return int(p.split('=', 1)[1])
+        return DEFAULT_BARRIER_TIMEOUT
+
+
+    def run(self):
+        '''
+        Runs the tests on all machines and waits till all have completed and
+        their reports are downloaded.
+
+        Returns:
+            True if tests completed on all machines and all reports were downloaded.
+        '''
+        # Machine index 0 is reserved for local machine, like in iozone_tests.sh.
+        workers = []
+        if self.local_machine:
+            workers.append((0, self.local_machine, self.reports_dir, None))
+        for i, machine in enumerate(self.machines):
+            workers.append((i + 1, machine, machine.reports_path(self.remote_reports_dir),
+                os.path.join(self.reports_dir, reports_subdir(machine))))
+
+        if not workers:
+            print('No machines to run tests on')
+            return False
+
+        if self.barrier_host:
+            if not os.path.isdir(self.reports_dir):
+                os.makedirs(self.reports_dir)
+            self.barrier = StartBarrier(len(workers), os.path.join(self.reports_dir, 'barrier.log'))
+            self.barrier_server = BarrierServer(self.barrier, self.barrier_port, self.barrier_timeout())
+            self.barrier_server.start()
+            print('Start barrier listening at %s:%d' % (self.barrier_host, self.barrier_server.port))
+
+        pool = ThreadPool(len(workers))
+        try:
+            scripts = [self.script]
+            if 'sample' in self.parameters:
+                scripts.append(SAMPLER_SCRIPT)
+            if any(p.split('=')[0] in CACHE_FLAGS for p in self.parameters):
+                scripts.extend(CACHE_SCRIPTS)
+
+            print('Copying script to all machines')
+            pool.map(lambda worker: [worker[1].copy_script(script) for script in scripts], workers)
+
+            startat = int(time.time()) + self.start_delay
+
+            print('Starting tests on all machines')
+            handles = pool.map(lambda worker: worker[1].launch(
+                self.cmdline(worker[2], worker[0], startat, worker is workers[0]), worker[2]), workers)
+        finally:
+            pool.close()
+            pool.join()
+
+        for worker, handle in zip(workers, handles):
+            print('Running on %s: %s' % (worker[1].name, handle if type(handle) is int else handle.pid))
+            thread = threading.Thread(target = self._wait_and_fetch, args = worker + (handle,))
+            thread.daemon = True
+            thread.start()
+
+        print('Tests started on all machines')
+
+        success = True
+        terminated = False
+        pending = set(worker[1].name for worker in workers)
+        while pending:
+            # Wake up periodically only to check for termination. Completions are
+            # received as soon as they happen.
+            try:
+                name, error = self.events.get(timeout = 5)
+            except queue.Empty:
+                if not terminated and os.path.isfile(TERMINATE_FILE):
+                    terminated = True
+                    print('Informing all machines to terminate')
+                    for worker in workers:
+                        if worker[1].name in pending:
+                            worker[1].terminate()
+                continue
+
+            pending.discard(name)
+            if error:
+                success = False
+                print('Failed on %s: %s' % (name, error))
+            else:
+                print('Completed on %s' % (name))
+            if pending:
+                print('Still running on: %s' % (', '.join(sorted(pending))))
+
+        if self.barrier:
+            self.barrier_server.shutdown()
+            self.barrier_server.server_close()
+
+        print('\n\n\nDISTRIBUTED TESTS COMPLETED ****\n\n\n')
+        return success
+
+
+    def _wait_and_fetch(self, machine_index, machine, reports_dir, local_dir, handle):
+        error = None
+        try:
+            machine.wait(handle)
+
+            # Tests on this machine will not arrive at the barrier any more.
+            if self.barrier:
+                self.barrier.remove_party(str(machine_index))
+
+            if local_dir:
+                print('Downloading reports of %s to %s' % (machine.name, local_dir))
+                machine.fetch_reports(reports_dir, local_dir)
+        except Exception as e:
+            error = str(e)
+        self.events.put((machine.name, error))
+
+
+
+def parse_options():
+    parser = argparse.ArgumentParser(description = 'Run iozone_tests.sh MULTI tests on multiple machines')
+
+    parser.add_argument('target_path', metavar = 'TARGET-PATH',
+        help = 'A directory on target device where temp files are created for testing')
+    parser.add_argument('reports_dir', metavar = 'REPORTS-DIRECTORY',
+        help = 'Directory where reports of all machines are collected')
+    parser.add_argument('parameters', metavar = 'FLAG', nargs = '*',
+        help = 'Optional flags passed to iozone_tests.sh, like numprocs=4 filesizes=1g')
+
+    parser.add_argument('--machines', default = '',
+        help = 'Comma separated list of [user@]IP of machines to run tests on over SSH')
+    parser.add_argument('--local-machines', default = '',
+        help = 'Comma separated list of local directories, each of which acts as a machine. For testing')
+    parser.add_argument('--remote-reports',
+        help = 'Directory where the machines should save their reports. Default: REPORTS-DIRECTORY')
+    parser.add_argument('--nolocal', action = 'store_true',
+        help = 'Do not run tests on local machine')
+    parser.add_argument('--script', default = DEFAULT_SCRIPT,
+        help = 'Path of iozone_tests.sh')
+    parser.add_argument('--start-delay', type = int, default = DEFAULT_START_DELAY,
+        help = 'With --no-barrier, seconds after launch at which all machines start testing')
+    parser.add_argument('--barrier-host',
+        help = 'Address of this machine that the machines use to reach the start barrier. '
+            'Default: address of the interface that routes to the first machine')
+    parser.add_argument('--barrier-port', type = int, default = 0,
+        help = 'Port of the start barrier. Default: any free port')
+    parser.add_argument('--no-barrier', action = 'store_true',
+        help = 'Start all machines at an estimated start time instead of using a start barrier')
+
+    # Flags of iozone_tests.sh may come after the options, which argparse
+    # does not assign to the positional FLAG arguments by itself.
+    opts, extra = parser.parse_known_args()
+    for arg in extra:
+        if arg.startswith('-') and arg != '--':
+            parser.error('unrecognized arguments: %s' % (arg))
+    opts.parameters.extend([arg for arg in extra if arg != '--'])
+    return opts
+
+
+
+if __name__ == '__main__':
+    opts = parse_options()
+
+    machines = [SshMachine(m) for m in opts.machines.split(',') if m]
+    machines.extend([LocalMachine(d) for d in opts.local_machines.split(',') if d])
+
+    local_machine = None if opts.nolocal else LocalMachine('.', 'local')
+
+    barrier_host = None
+    if not opts.no_barrier:
+        barrier_host = opts.barrier_host or default_barrier_host(machines)
+
+    orchestrator = Orchestrator(machines, opts.target_path, opts.reports_dir, opts.remote_reports,
+        opts.parameters, local_machine, opts.script, opts.start_delay, barrier_host, opts.barrier_port)
+
+    success = orchestrator.run()
+
+    sys.exit(0 if success else 1)
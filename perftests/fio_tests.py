@@ -0,0 +1,453 @@
+'''
+Module to run fio benchmarks over the same file size, block size and process count
+matrix as iozone_tests.sh, with latency percentiles, queue depths and mixed read/write
+ratios that iozone's throughput mode can't measure.
+
+For every test and file mode, a fio job file is generated with one job per point of
+the matrix:
+    filesizes x blocksizes x numprocs x iodepths [x rwmixes, for mixed tests]
+Jobs are separated by stonewall, so they run one after another, each with 'numprocs'
+processes working on their own files in TARGET-PATH, like iozone's multi process mode.
+
+Tests:
+    write, read, randwrite, randread : Sequential and random, write-only or read-only.
+    randrw : Random mix of reads and writes, with 'rwmixes' percentages of reads.
+
+File modes, like in iozone_tests.sh:
+    reg   : Regular buffered I/O.
+    sync  : Files opened with O_SYNC.
+    dsync : fdatasync after every write, equivalent of iozone's O_DSYNC mode (-+D).
+    dir   : Direct I/O with O_DIRECT.
+
+With an iodepth greater than 1, jobs use the libaio engine, else psync. libaio is only
+asynchronous with direct I/O, so queue depths have an effect only in 'dir' mode.
+
+Reports are saved like iozone_tests.sh saves them, in <REPORTS-DIRECTORY>/<RUN-NUMBER>/:
+    fio-<TEST>-<MODE>-<TIMESTAMP>.fio  : The job file.
+    fio-<TEST>-<MODE>-<TIMESTAMP>.json : fio's JSON output.
+    fio-<TEST>-<MODE>-<TIMESTAMP>.conf : Target path, start and end times, and the matrix.
+
+'ingest' stores results in an iozone_store store, one run per report, with one row per
+job. Bandwidths are in KB/s and latencies are completion latency percentiles in
+microseconds. 'report' prints them as tables.
+
+Usage:
+-----
+$ python fio_tests.py run <TARGET-PATH> <REPORTS-DIRECTORY> [--tests randread,randrw] [--modes dir]
+        [--filesizes 1g] [--blocksizes 4k,1m] [--numprocs 1-4] [--iodepths 1,32] [--rwmixes 70,50]
+$ python fio_tests.py ingest <STORE-DIR> <REPORTS-DIRECTORY>
+$ python fio_tests.py report <STORE-DIR> [RUN-ID ...]
+'''
+
+from __future__ import print_function
+
+import os
+import re
+import sys
+import json
+import time
+import argparse
+import datetime
+import itertools
+import subprocess
+import collections
+
+# Storing results needs numpy through iozone_store, but running tests does not.
+try:
+    import iozone_store
+except ImportError:
+    iozone_store = None
+
+TESTS = ['write', 'read', 'randwrite', 'randread', 'randrw']
+
+# Tests that mix reads and writes, for which rwmixes are varied.
+MIXED_TESTS = ['randrw']
+
+# fio options of each file mode.
+MODE_OPTIONS = collections.OrderedDict([
+    ('reg', {}),
+    ('sync', {'sync' : '1'}),
+    ('dsync', {'fdatasync' : '1'}),
+    ('dir', {'direct' : '1'})
+])
+
+PERCENTILES = ['50', '99', '99.9']
+
+# Matches report file names written by run_fio, like 'fio-randrw-dir-2017-01-12-10-20-30.json'
+FIO_REPORT_RE = re.compile('^fio-(.+)-([0-9]{4}-[0-9]{2}-[0-9]{2}-[0-9]{2}-[0-9]{2}-[0-9]{2})\.json$')
+
+# Columns of a stored run, one row per job.
+COLUMNS = ['file_size', 'record_size', 'procs', 'iodepth', 'rwmix_read',
+    'read_bw', 'read_iops', 'read_lat_p50', 'read_lat_p99', 'read_lat_p99_9',
+    'write_bw', 'write_iops', 'write_lat_p50', 'write_lat_p99', 'write_lat_p99_9']
+
+SIZE_UNITS = {'k' : 1, 'm' : 1024, 'g' : 1024 * 1024, 't' : 1024 * 1024 * 1024}
+
+
+
+def parse_size_kb(size):
+    '''
+    Parses a size like iozone does. A number without units is in KB.
+
+    Args:
+        - size : A string like '64', '4k', '512m' or '1g'
+
+    Returns:
+        Size in KB, as an integer.
+    '''
+    m = re.match('^([0-9]+)([kKmMgGtT]?)[bB]?$', size.strip())
+    if not m:
+        raise ValueError('Invalid size: %s' % (size))
+    return int(m.group(1)) * SIZE_UNITS.get(m.group(2).lower(), 1)
+
+
+
+def parse_range(value):
+    '''
+    Returns:
+        list of integers in a 'MIN-MAX' range, or of a 'v1,v2,...' set.
+    '''
+    if '-' in value:
+        low, high = value.split('-')
+        return list(range(int(low), int(high) + 1))
+    return [int(v) for v in value.split(',')]
+
+
+
+def job_sections(test, mode, target_path, filesizes, blocksizes, numprocs, iodepths, rwmixes,
+        machine_index=''):
+    '''
+    Returns:
+        list of (job name, OrderedDict of fio options), one per point of the matrix.
+    '''
+    if test not in MIXED_TESTS:
+        # Read percentage is implied by the test.
+        rwmixes = [0 if 'write' in test else 100]
+
+    jobs = []
+    for filesize, blocksize, procs, iodepth, rwmix in itertools.product(filesizes, blocksizes,
+            numprocs, iodepths, rwmixes):
+        options = collections.OrderedDict()
+        options['stonewall'] = None
+        options['rw'] = test
+        options['directory'] = target_path
+        options['size'] = '%dk' % (parse_size_kb(filesize))
+        options['bs'] = '%dk' % (parse_size_kb(blocksize))
+        options['numjobs'] = str(procs)
+        options['iodepth'] = str(iodepth)
+        options['ioengine'] = 'libaio' if iodepth > 1 else 'psync'
+        if test in MIXED_TESTS:
+            options['rwmixread'] = str(rwmix)
+        options.update(MODE_OPTIONS[mode])
+
+        # Each process of each machine works on its own files, even on a shared mount.
+        name = 'fio%s-s%s-b%s-p%d-qd%d-mix%d' % (machine_index, filesize, blocksize, procs, iodepth, rwmix)
+        jobs.append((name, options))
+    return jobs
+
+
+
+def job_file(jobs):
+    '''
+    Returns:
+        Contents of a fio job file with the jobs.
+    '''
+    lines = ['[global]',
+        'group_reporting=1',
+        'percentile_list=%s' % (':'.join(PERCENTILES)),
+        '']
+    for name, options in jobs:
+        lines.append('[%s]' % (name))
+        for key, value in options.items():
+            lines.append(key if value is None else '%s=%s' % (key, value))
+        lines.append('')
+    return '\n'.join(lines)
+
+
+
+def run_fio(test, mode, target_path, reports_dir, matrix, dryrun=False):
+    '''
+    Generates the job file of a test in a file mode, runs it and saves its reports.
+
+    Args:
+        - matrix : dict with 'filesizes', 'blocksizes', 'numprocs', 'iodepths',
+            'rwmixes' and optional 'machine_index' keys, like the arguments of job_sections.
+
+    Returns:
+        Path of the JSON report, or None if it's a dry run or fio failed.
+    '''
+    label = '%s-%s' % (test, mode)
+    start_ts = datetime.datetime.now().strftime('%Y-%m-%d-%H-%M-%S')
+    prefix = os.path.join(reports_dir, 'fio-%s-%s' % (label, start_ts))
+
+    jobs = job_sections(test, mode, target_path, **matrix)
+    with open(prefix + '.fio', 'w') as f:
+        f.write(job_file(jobs))
+
+    cmdline = ['fio', '--output-format=json', '--output=%s.json' % (prefix), prefix + '.fio']
+    print('Start: %s test in %s mode, %d jobs' % (test, mode, len(jobs)))
+    if dryrun:
+        print('Dry run: %s' % (' '.join(cmdline)))
+        return None
+
+    returncode = subprocess.call(cmdline)
+
+    end_ts = datetime.datetime.now().strftime('%Y-%m-%d-%H-%M-%S')
+    with open(prefix + '.conf', 'w') as f:
+        f.write('path=%s\n' % (target_path))
+        f.write('start=%s\n' % (start_ts))
+        f.write('end=%s\n' % (end_ts))
+        for key in ('filesizes', 'blocksizes', 'numprocs', 'iodepths', 'rwmixes'):
+            f.write('%s=%s\n' % (key, ','.join(str(v) for v in matrix[key])))
+
+    print('End: %s test in %s mode' % (test, mode))
+    if returncode != 0:
+        print('fio failed with exit code %d' % (returncode))
+        return None
+    return prefix + '.json'
+
+
+
+def run_tests(opts):
+    matrix = {
+        'filesizes' : opts.filesizes.split(','),
+        'blocksizes' : opts.blocksizes.split(','),
+        'numprocs' : parse_range(opts.numprocs),
+        'iodepths' : parse_range(opts.iodepths),
+        'rwmixes' : parse_range(opts.rwmixes),
+        'machine_index' : opts.machine_index
+    }
+
+    for current_run in range(1, opts.numruns + 1):
+        print('\nRUN #%d ******\n' % (current_run))
+        run_dir = os.path.join(opts.reports_dir, str(current_run))
+        if not os.path.isdir(run_dir):
+            os.makedirs(run_dir)
+
+        for test in opts.tests.split(','):
+            for mode in opts.modes.split(','):
+                report = run_fio(test, mode, opts.target_path, run_dir, matrix, opts.dryrun)
+                if report and opts.store:
+                    run_id = ingest_fio_report(opts.store, opts.reports_dir, report)
+                    print_table(run_id, iozone_store.load_run(opts.store, run_id))
+
+        if current_run < opts.numruns:
+            print('Waiting for %d seconds before next run' % (opts.runwait))
+            time.sleep(opts.runwait)
+
+
+
+def _clat_percentiles(stats):
+    '''
+    Returns:
+        dict of percentile string like '99.9' -> completion latency in microseconds.
+    '''
+    # fio 3.x reports latencies in nanoseconds, and older versions in microseconds.
+    if 'clat_ns' in stats:
+        clat, scale = stats['clat_ns'], 1000.0
+    else:
+        clat, scale = stats.get('clat', {}), 1.0
+
+    percentiles = {}
+    for key, value in clat.get('percentile', {}).items():
+        # Keys are like '99.900000'
+        percentiles['%g' % (float(key))] = value / scale
+    return percentiles
+
+
+
+def parse_fio_json(report):
+    '''
+    Args:
+        - report : fio's JSON output, as a dict.
+
+    Returns:
+        OrderedDict of column name -> list of values, with a row per job.
+    '''
+    columns = collections.OrderedDict((name, []) for name in COLUMNS)
+
+    for job in report['jobs']:
+        options = job.get('job options', {})
+        columns['file_size'].append(parse_size_kb(options.get('size', '0')))
+        columns['record_size'].append(parse_size_kb(options.get('bs', '0')))
+        columns['procs'].append(int(options.get('numjobs', 1)))
+        columns['iodepth'].append(int(options.get('iodepth', 1)))
+
+        default_mix = 0 if options.get('rw') in ('write', 'randwrite') else 100
+        columns['rwmix_read'].append(int(options.get('rwmixread', default_mix)))
+
+        for direction in ('read', 'write'):
+            stats = job.get(direction, {})
+            columns[direction + '_bw'].append(float(stats.get('bw', 0)))
+            columns[direction + '_iops'].append(float(stats.get('iops', 0)))
+            percentiles = _clat_percentiles(stats)
+            for p in PERCENTILES:
+                column = '%s_lat_p%s' % (direction, p.replace('.', '_'))
+                columns[column].append(float(percentiles.get(p, 0)))
+    return columns
+
+
+
+def ingest_fio_report(store_dir, reports_dir, report_file, index=None):
+    '''
+    Parses a fio JSON report and its .conf file, and stores them.
+
+    Returns:
+        The run ID.
+    '''
+    if iozone_store is None:
+        raise RuntimeError('Storing results requires numpy')
+
+    with open(report_file, 'r') as f:
+        columns = parse_fio_json(json.load(f))
+
+    run_id = os.path.splitext(os.path.relpath(report_file, reports_dir))[0]
+
+    meta = collections.OrderedDict()
+    meta['type'] = 'fio'
+    meta['source'] = os.path.abspath(report_file)
+    meta['mtime'] = os.path.getmtime(report_file)
+
+    m = FIO_REPORT_RE.match(os.path.basename(report_file))
+    if m:
+        meta['label'] = m.group(1)
+
+    run_num = os.path.basename(os.path.dirname(os.path.abspath(report_file)))
+    if run_num.isdigit():
+        meta['run'] = int(run_num)
+
+    meta.update(iozone_store.read_conf(os.path.splitext(report_file)[0] + '.conf'))
+
+    iozone_store.write_run(store_dir, run_id, columns, meta, index)
+    return run_id
+
+
+
+def ingest_tree(store_dir, reports_dir):
+    '''
+    Stores all fio reports under reports_dir that are not already in the store,
+    or have changed since they were stored.
+
+    Returns:
+        list of IDs of runs that were stored.
+    '''
+    if iozone_store is None:
+        raise RuntimeError('Storing results requires numpy')
+
+    if not os.path.isdir(store_dir):
+        os.makedirs(store_dir)
+
+    index = iozone_store.load_index(store_dir)
+
+    ingested = []
+    for dirpath, dirnames, filenames in os.walk(reports_dir):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            if not FIO_REPORT_RE.match(filename):
+                continue
+
+            report_file = os.path.join(dirpath, filename)
+            run_id = os.path.splitext(os.path.relpath(report_file, reports_dir))[0]
+            if run_id in index and index[run_id].get('mtime') == os.path.getmtime(report_file):
+                continue
+
+            try:
+                ingest_fio_report(store_dir, reports_dir, report_file, index)
+            except ValueError as e:
+                # Incomplete JSON of an interrupted run.
+                print('Skipped %s: %s' % (run_id, e))
+                continue
+
+            print('Stored %s' % (run_id))
+            ingested.append(run_id)
+
+    iozone_store.save_index(store_dir, index)
+    return ingested
+
+
+
+def print_table(run_id, columns):
+    '''
+    Prints a run's results as a table, with bandwidth in MB/s and latencies in microseconds.
+    '''
+    print('\n%s' % (run_id))
+    print('%8s %8s %5s %5s %4s | %9s %9s %9s %9s %9s | %9s %9s %9s %9s %9s' % ('file', 'block',
+        'procs', 'qd', 'rd%', 'rd MB/s', 'rd IOPS', 'rd p50', 'rd p99', 'rd p99.9',
+        'wr MB/s', 'wr IOPS', 'wr p50', 'wr p99', 'wr p99.9'))
+
+    for i in range(len(columns['file_size'])):
+        row = [columns[name][i] for name in COLUMNS]
+        print('%7dK %7dK %5d %5d %4d | %9.1f %9.0f %9.0f %9.0f %9.0f | %9.1f %9.0f %9.0f %9.0f %9.0f' % (
+            row[0], row[1], row[2], row[3], row[4],
+            row[5] / 1024.0, row[6], row[7], row[8], row[9],
+            row[10] / 1024.0, row[11], row[12], row[13], row[14]))
+
+
+
+def parse_options():
+    parser = argparse.ArgumentParser(description='Run fio benchmarks and store their results')
+    subparsers = parser.add_subparsers(dest='command')
+
+    run_parser = subparsers.add_parser('run', help='Run fio tests over a matrix of parameters')
+    run_parser.add_argument('target_path', metavar='TARGET-PATH',
+        help='Directory on target device where test files are created')
+    run_parser.add_argument('reports_dir', metavar='REPORTS-DIRECTORY')
+    run_parser.add_argument('--tests', default=','.join(TESTS),
+        help='Comma separated tests. Default: %s' % (','.join(TESTS)))
+    run_parser.add_argument('--modes', default=','.join(MODE_OPTIONS),
+        help='Comma separated file modes. Default: %s' % (','.join(MODE_OPTIONS)))
+    run_parser.add_argument('--filesizes', default='1g', help='Comma separated file sizes per process. Default: 1g')
+    run_parser.add_argument('--blocksizes', default='4k,64k,1m', help='Comma separated block sizes. Default: 4k,64k,1m')
+    run_parser.add_argument('--numprocs', default='1', help='Process counts as MIN-MAX or a comma separated set. Default: 1')
+    run_parser.add_argument('--iodepths', default='1', help='Queue depths as MIN-MAX or a comma separated set. Default: 1')
+    run_parser.add_argument('--rwmixes', default='70',
+        help='Read percentages of mixed tests as a comma separated set. Default: 70')
+    run_parser.add_argument('--machine-index', default='',
+        help='Included in job names, so that multiple machines testing a shared mount use separate files')
+    run_parser.add_argument('--numruns', type=int, default=1, help='Repeat the tests # times. Default: 1')
+    run_parser.add_argument('--runwait', type=int, default=900,
+        help='Seconds between runs. Default: 900')
+    run_parser.add_argument('--store', metavar='STORE-DIR', help='Store results of each test in this store')
+    run_parser.add_argument('--dryrun', action='store_true',
+        help='Generate job files and print fio command lines without running them')
+
+    ingest_parser = subparsers.add_parser('ingest', help='Store all new fio reports in a reports directory')
+    ingest_parser.add_argument('store_dir', metavar='STORE-DIR')
+    ingest_parser.add_argument('reports_dir', metavar='REPORTS-DIRECTORY')
+
+    report_parser = subparsers.add_parser('report', help='Print tables of stored fio runs')
+    report_parser.add_argument('store_dir', metavar='STORE-DIR')
+    report_parser.add_argument('run_ids', metavar='RUN-ID', nargs='*', help='Runs to print. Default: all fio runs')
+
+    opts = parser.parse_args()
+
+    if opts.command == 'run':
+        for test in opts.tests.split(','):
+            if test not in TESTS:
+                parser.error('Invalid test: %s' % (test))
+        for mode in opts.modes.split(','):
+            if mode not in MODE_OPTIONS:
+                parser.error('Invalid mode: %s' % (mode))
+
+    return opts
+
+
+
+if __name__ == '__main__':
+    opts = parse_options()
+
+    if opts.command == 'run':
+        run_tests(opts)
+
+    elif opts.command == 'ingest':
+        ingest_tree(opts.store_dir, opts.reports_dir)
+
+    elif opts.command == 'report':
+        if iozone_store is None:
+            print('Reading stored results requires numpy')
+            sys.exit(1)
+
+        index = iozone_store.load_index(opts.store_dir)
+        run_ids = opts.run_ids or [run_id for run_id, meta in index.items() if meta.get('type') == 'fio']
+        for run_id in run_ids:
+            print_table(run_id, iozone_store.load_run(opts.store_dir, run_id))
@@ -1,53 +1,240 @@
 '''
 Module to create performance testing environment for Gluster clusters.
+
+Usage:
+-----
+$ python gluster_perf.py create <NAME> <DATACENTER-ID>
+$ python gluster_perf.py add <NAME> [--servers N] [--clients N] [--parallelism N]
+$ python gluster_perf.py sync-keys <NAME>
 '''
 
 import os
 import os.path
+import sys
+import time
+import argparse
+import threading
 import collections
+from multiprocessing.pool import ThreadPool
 
 from linode_core import Core, Linode
 from provisioners import AnsibleProvisioner
 
-import simplejson as json
-
 import logger
 
+# tracing is shared with the cluster management modules in parent directory.
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import tracing
+from state_store import StateStore
+
+# Default maximum number of machines created and provisioned at the same time.
+DEFAULT_ADD_PARALLELISM = 8
+
+# Protects changes to loaded clusters and saving them, since machines of a batch
+# are created and provisioned concurrently.
+cluster_lock = threading.RLock()
+
+# Cluster name -> StateStore
+cluster_stores = {}
+cluster_stores_lock = threading.Lock()
+
 
 def create_cluster(name, datacenter):
     
-    test_cluster = load_cluster(name)
-    if test_cluster is not None:
-        print('Cluster %s already exists. Use a different name or load this one instead of creating.' % (name))
-        return None
+    # Hold the lock so that two processes can't create the same cluster.
+    with cluster_store(name).lock():
+        test_cluster = load_cluster(name)
+        if test_cluster is not None:
+            print('Cluster %s already exists. Use a different name or load this one instead of creating.' % (name))
+            return None
+            
+        cluster = collections.OrderedDict()
+        cluster['name'] = name
+        cluster['dc'] = datacenter
+        cluster['servers'] = []
+        cluster['clients'] = []
         
-    cluster = collections.OrderedDict()
-    cluster['name'] = name
-    cluster['dc'] = datacenter
-    cluster['servers'] = []
-    cluster['clients'] = []
-    
-    save_cluster(cluster)
+        save_cluster(cluster)
         
     return cluster
     
 
 def add_client(name):
+    '''
+    Create a machine that acts as GlusterFS client
+    and runs perf tests.
+    '''
+    add_machines(name, num_clients = 1)
+    
+    
+    
+def add_clients(name, count, parallelism = DEFAULT_ADD_PARALLELISM):
+    add_machines(name, num_clients = count, parallelism = parallelism)
+    
     
+    
+def add_server(name):
+    '''
+    Create a machine that acts as GlusterFS server and has some perf testing tools
+    and scripts installed.
+    '''
+    add_machines(name, num_servers = 1)
+    
+    
+    
+def add_servers(name, count, parallelism = DEFAULT_ADD_PARALLELISM):
+    add_machines(name, num_servers = count, parallelism = parallelism)
+    
+    
+    
+def add_machines(name, num_servers = 0, num_clients = 0, parallelism = DEFAULT_ADD_PARALLELISM):
+    '''
+    Creates and provisions a batch of servers and clients together. Machines are 
+    created and provisioned concurrently, so a batch takes about as long as a single
+    machine. Public keys of all machines are collected first, and then the full set
+    of keys is distributed to all machines of the cluster in a single playbook run. 
+    
+    Adding N machines one at a time would instead take 2N extra playbook runs, 
+    transferring O(N^2) keys.
+    
+    Label numbers are reserved in the cluster file holding its lock, so batches added
+    concurrently, even by different processes, don't reuse them. A machine that fails
+    doesn't stop the batch, and keys are synced for all machines that were created.
+    
+    Args:
+        - name : Name of the cluster.
+        - num_servers : Number of servers to add.
+        - num_clients : Number of clients to add.
+        - parallelism : Maximum number of machines created and provisioned at the same time.
+    '''
     cluster = load_cluster(name)
+    if cluster is None:
+        print('Cluster %s does not exist' % (name))
+        return
     
+    tracer = tracing.start('%s add %d servers %d clients' % (name, num_servers, num_clients))
+    try:
+        # Labels are numbered up front, so that they don't depend on the order
+        # in which creations complete.
+        new_machines = []
+        for role, count in [('servers', num_servers), ('clients', num_clients)]:
+            for index in reserve_indexes(cluster, role, count):
+                new_machines.append((role, index))
+            
+        if not new_machines:
+            return
+            
+        pool = ThreadPool(min(parallelism, len(new_machines)))
+        try:
+            added = pool.map(lambda m: add_machine(cluster, m[0], m[1]), new_machines, chunksize = 1)
+        finally:
+            pool.close()
+            pool.join()
+            
+        if any(added):
+            # Reloaded to include machines added concurrently by other processes.
+            sync_authorized_keys(load_cluster(name))
+            
+    finally:
+        logger.msg(tracer.dump(os.path.join(conf_dir(), 'traces'), 
+            '%s-add-%s' % (name, time.strftime('%Y-%m-%d-%H-%M-%S'))))
+        
+        
+        
+def reserve_indexes(cluster, role, count):
     '''
-    Create a machine that acts as GlusterFS client
-    and runs perf tests.
+    Reserves numbers for the labels of new machines of a role. The last number
+    reserved is saved in the cluster's 'last_index', since machines whose creation
+    failed, or is still in progress in another process, are not in the cluster.
+    
+    Returns:
+        list of reserved numbers.
     '''
-    # Create a linode
-    app_ctx = {'conf-dir' : conf_dir()}
-    core = Core(app_ctx)
+    if count <= 0:
+        return []
+    
+    store = cluster_store(cluster['name'])
+    with store.lock():
+        current = store.load()
+        last = max(len(current[role]), current.get('last_index', {}).get(role, 0))
+        store.set(['last_index', role], last + count)
+        
+    with cluster_lock:
+        cluster.setdefault('last_index', collections.OrderedDict())[role] = last + count
+    return list(range(last + 1, last + count + 1))
+    
     
-    client_index = len(cluster['clients']) + 1
     
-    label = 'perfclient-%d' % (client_index)
-    client_linode_spec = {
+def add_machine(cluster, role, index):
+    '''
+    Creates and provisions a server or client, without distributing keys.
+    Called concurrently for machines of a batch, so errors are logged instead
+    of raised, to not abort the rest of the batch.
+    
+    Returns:
+        dict of machine details, or None if it could not be created. A machine
+        whose provisioning failed is still returned, since it's in the cluster.
+    '''
+    try:
+        # Each machine uses its own Core, since a Core is not known to be thread safe.
+        core = Core({'conf-dir' : conf_dir()})
+        machine = create_machine(cluster, core, role, index)
+    except Exception as e:
+        logger.error_msg('Could not create %s %d: %s' % (role, index, e))
+        return None
+    if not machine:
+        return None
+    
+    try:
+        if role == 'servers':
+            provision_server(cluster, machine, distribute_keys = False)
+        else:
+            provision_client(cluster, machine, distribute_keys = False)
+    except Exception as e:
+        logger.error_msg('Could not provision %s: %s' % (machine['public_ip'], e))
+    return machine
+    
+    
+    
+def create_machine(cluster, core, role, index):
+    '''
+    Creates a server or client linode and saves its details to cluster.
+    
+    Args:
+        - role : 'servers' or 'clients'
+        - index : Number of the machine in its role, used in its label.
+        
+    Returns:
+        dict of machine details, or None if it could not be created.
+    '''
+    if role == 'servers':
+        linode_spec = server_linode_spec(cluster, 'perfserver-%d' % (index))
+    else:
+        linode_spec = client_linode_spec(cluster, 'perfclient-%d' % (index))
+        
+    with tracing.span('create_linode', label = linode_spec['label']):
+        linode = core.create_linode(linode_spec)
+    if not linode:
+        logger.error_msg('Could not create %s' % (linode_spec['label']))
+        return None
+    
+    # Save machine details to cluster.
+    machine = collections.OrderedDict()
+    machine['id'] = linode.id
+    machine['public_ip'] = str(linode.public_ip[0])
+    machine['private_ip'] = linode.private_ip
+    
+    # Only the new machine is journaled, instead of rewriting the whole cluster.
+    with cluster_lock:
+        cluster[role].append(machine)
+    cluster_store(cluster['name']).append([role], machine)
+    
+    return machine
+    
+    
+    
+def client_linode_spec(cluster, label):
+    return {
             'plan_id' : 1,
             'datacenter' : cluster['dc'],
             'distribution' : 'Ubuntu 14.04 LTS',
@@ -71,37 +258,51 @@ def add_client(name):
                         }
 
     }
-        
-    linode = core.create_linode(client_linode_spec)
-    if not linode:
-        logger.error_msg('Could not create perf client')
-        return
     
-    # Save client details to cluster.
-    client = collections.OrderedDict()
-    client['id'] = linode.id
-    client['public_ip'] = str(linode.public_ip[0])
-    client['private_ip'] = linode.private_ip
     
-    cluster['clients'].append(client)
-    save_cluster(cluster)
     
-    provision_client(cluster, client)
+def server_linode_spec(cluster, label):
+    return {
+            'plan_id' : 9,
+            'datacenter' : cluster['dc'],
+            'distribution' : 'Ubuntu 14.04 LTS',
+            'kernel' : 'Latest 64 bit',
+            'label' : label,
+            'group' : 'perftests',
+            # Plan 9 servers have 1152 GB of storage and 64 GB of RAM.
+            # Allocate 10 GB for boot, 32 GB for swap, remaining 1110 GB for brick.
+            'disks' :   {
+                            'boot' : {'disk_size' : 10 * 1024},
+                            'swap' : {'disk_size' : 32 * 1024},
+                            'others' :  [
+                                        {
+                                            'label' : 'brick',
+                                            'disk_size' : 1100 * 1024,
+                                            'type' : 'xfs'
+                                        }
+                                        ]
+                        }
 
+    }
 
 
 
-def provision_client(cluster, client):    
-    print(cluster)
-    print(client)
-    
+def provision_client(cluster, client, distribute_keys = True):
+    '''
+    Args:
+        - distribute_keys : If True, keys of all machines are synced to all machines
+            after provisioning. Set to False when provisioning a batch, and call
+            sync_authorized_keys once after the whole batch is provisioned.
+    '''
     # Provision it with glusterfs client, perf tools and monitoring tools.
     prov = AnsibleProvisioner()
     
     # Wait for SSH service on linode to come up.
     temp = Linode()
     temp.public_ip = [ client['public_ip'] ]
-    if not prov.wait_for_ping(temp, 60, 10):
+    with tracing.span('wait_for_ping', host = client['public_ip']):
+        reachable = prov.wait_for_ping(temp, 60, 10)
+    if not reachable:
         print("Unable to reach %s over SSH" % (client['public_ip']))
         return
     
@@ -109,7 +310,7 @@ def provision_client(cluster, client):
     if not os.path.exists(pubkey_dir):
         os.makedirs(pubkey_dir)
     
-    print('Provisioning client')
+    print('Provisioning client %s' % (client['public_ip']))
     
     # Provision client's public key. Configure it to allow only key based
     # SSH. Provision cluster and perf tools on client.
@@ -117,7 +318,7 @@ def provision_client(cluster, client):
     # While sending paths to ansible, always send absolute paths, because ansible's working 
     # directory is the directory in which the playbook resides, not the directory from which
     # the ansible-playbook is executed.
-    prov.exec_playbook(client['public_ip'], 'ansible/perf_client.yaml',
+    exec_playbook(prov, client['public_ip'], 'ansible/perf_client.yaml',
         variables = {
             # If path does not end with a /, this becomes the name of the downloaded file
             # instead of the directory under which it should be saved.
@@ -129,113 +330,46 @@ def provision_client(cluster, client):
         with open(pubkey_file, 'r') as f:
             pubkey = f.read().strip('\n')
             
-        client['pubkey'] = pubkey
-        save_cluster(cluster)
+        with cluster_lock:
+            client['pubkey'] = pubkey
+        cluster_store(cluster['name']).update(['clients'], {'id' : client['id']}, {'pubkey' : pubkey})
         
     else:
         print('Error: public key %s not found' % (pubkey_file))
     
     # Authorize client to access all other machines in cluster, and
     # vice versa.
-    other_keys = [ c['pubkey'] for c in cluster['clients'][:-1] ]
-    server_keys = [ s['pubkey'] for s in cluster['servers'] ]
-    other_keys.extend(server_keys)
-    
-    if other_keys:
-        add_auth_keys_to_client = '\n\n' + '\n'.join(other_keys) + '\n'
-        
-        print('Adding authorized keys')
-        prov.exec_playbook(client['public_ip'], 'ansible/add_authorized_keys.yaml',
-            variables = {
-                'keys' : add_auth_keys_to_client
-            })
-        
-        # Now add this client's key to all other machines.
-        targets = [ c['public_ip'] for c in cluster['clients'][:-1] ]
-        targets.extend( [ s['public_ip'] for s in cluster['servers'] ] )
-        prov.exec_playbook(targets, 'ansible/add_authorized_keys.yaml',
-            variables = {
-                'keys' : client['pubkey'] + '\n'
-            })
+    if distribute_keys:
+        sync_authorized_keys(cluster, prov)
     
     
     
-def add_server(name):
-    
-    cluster = load_cluster(name)
-    
+def provision_server(cluster, server, distribute_keys = True):    
     '''
-    Create a machine that acts as GlusterFS server and has some perf testing tools
-    and scripts installed.
+    Args:
+        - distribute_keys : If True, keys of all machines are synced to all machines
+            after provisioning. Set to False when provisioning a batch, and call
+            sync_authorized_keys once after the whole batch is provisioned.
     '''
-    # Create a linode
-    app_ctx = {'conf-dir' : conf_dir()}
-    core = Core(app_ctx)
-    
-    server_index = len(cluster['servers']) + 1
-    
-    label = 'perfserver-%d' % (server_index)
-    server_linode_spec = {
-            'plan_id' : 9,
-            'datacenter' : cluster['dc'],
-            'distribution' : 'Ubuntu 14.04 LTS',
-            'kernel' : 'Latest 64 bit',
-            'label' : label,
-            'group' : 'perftests',
-            # Plan 9 servers have 1152 GB of storage and 64 GB of RAM.
-            # Allocate 10 GB for boot, 32 GB for swap, remaining 1110 GB for brick.
-            'disks' :   {
-                            'boot' : {'disk_size' : 10 * 1024},
-                            'swap' : {'disk_size' : 32 * 1024},
-                            'others' :  [
-                                        {
-                                            'label' : 'brick',
-                                            'disk_size' : 1100 * 1024,
-                                            'type' : 'xfs'
-                                        }
-                                        ]
-                        }
-
-    }
-        
-    linode = core.create_linode(server_linode_spec)
-    if not linode:
-        logger.error_msg('Could not create perf server')
-        return
-    
-    # Save client details to cluster.
-    server = collections.OrderedDict()
-    server['id'] = linode.id
-    server['public_ip'] = linode.public_ip[0]
-    server['private_ip'] = linode.private_ip
-    
-    cluster['servers'].append(server)
-    save_cluster(cluster)
-    
-    provision_server(cluster, server)
-
-
-
-def provision_server(cluster, server):    
-    
     # Provision it with glusterfs server, perf tools and monitoring tools.
     prov = AnsibleProvisioner()
     
     # Wait for SSH service on linode to come up.
     temp = Linode()
     temp.public_ip = [ server['public_ip'] ]
-    prov.wait_for_ping(temp, 60, 10)
+    with tracing.span('wait_for_ping', host = server['public_ip']):
+        prov.wait_for_ping(temp, 60, 10)
     
     pubkey_dir = os.path.join(conf_dir(), str(server['id'])) 
     if not os.path.exists(pubkey_dir):
         os.makedirs(pubkey_dir)
     
-    print('Provisioning server')
+    print('Provisioning server %s' % (server['public_ip']))
     
     # Provision server's public key. Configure it to allow only key based
     # SSH. Provision cluster and perf tools on server.
     # This playbook also fetches client's public key and saves it in conf_dir/<LINODE_ID>/id_rsa.pub
-    prov.exec_playbook(server['public_ip'], 'ansible/perf_server.yaml',
+    exec_playbook(prov, server['public_ip'], 'ansible/perf_server.yaml',
         variables = {
             # If path does not end with a /, this becomes the name of the downloaded file
             # instead of the directory under which it should be saved.
@@ -247,8 +381,9 @@ def provision_server(cluster, server):
         with open(pubkey_file, 'r') as f:
             pubkey = f.read().strip('\n')
             
-        server['pubkey'] = pubkey
-        save_cluster(cluster)
+        with cluster_lock:
+            server['pubkey'] = pubkey
+        cluster_store(cluster['name']).update(['servers'], {'id' : server['id']}, {'pubkey' : pubkey})
         
     else:
         print('Error: publc key %s not found' % (pubkey_file))
@@ -256,61 +391,81 @@ def provision_server(cluster, server):
     # When a new server is created, all existing clients should be able
     # to ssh to it. Other servers probably don't need to, but adding them
     # anyway.
-    other_keys = [ s['pubkey'] for s in cluster['servers'][:-1] ]
-    client_keys = [ c['pubkey'] for c in cluster['clients'] ]
-    other_keys.extend(client_keys)
+    if distribute_keys:
+        sync_authorized_keys(cluster, prov)
     
-    if other_keys:
-        
-        print('Adding authorized keys')
-        
-        add_auth_keys_to_server = '\n\n' + '\n'.join(other_keys) + '\n'
-        
-        prov.exec_playbook(server['public_ip'], 'ansible/add_authorized_keys.yaml',
-            variables = {
-                'keys' : add_auth_keys_to_server
-            })
-        
-        # Now add this client's key to all other machines.
-        targets = [ s['public_ip'] for s in cluster['servers'][:-1] ]
-        targets.extend( [ c['public_ip'] for c in cluster['clients'] ] )
-        prov.exec_playbook(targets, 'ansible/add_authorized_keys.yaml',
+    
+    
+def sync_authorized_keys(cluster, prov = None):
+    '''
+    Authorizes every machine in the cluster to SSH to every other machine, with
+    a single playbook run across all machines.
+    
+    The playbook replaces the block of keys it manages in authorized_keys
+    with the full set of keys, so running it again is harmless, and it also 
+    repairs machines whose keys have drifted.
+    '''
+    with cluster_lock:
+        machines = [ m for m in cluster['servers'] + cluster['clients'] if m.get('pubkey') ]
+    if not machines:
+        return
+    
+    keys = '\n'.join([ m['pubkey'] for m in machines ]) + '\n'
+    targets = [ m['public_ip'] for m in machines ]
+    
+    print('Syncing authorized keys of %d machines' % (len(machines)))
+    
+    with tracing.span('distribute_keys', keys = len(machines)):
+        exec_playbook(prov or AnsibleProvisioner(), targets, 'ansible/add_authorized_keys.yaml',
             variables = {
-                'keys' : server['pubkey'] + '\n'
+                'keys' : keys
             })
     
     
-    
 
 
     
     
-def load_cluster(name):
+def exec_playbook(prov, targets, playbook, variables = None):
+    with tracing.span('exec_playbook', playbook = playbook):
+        return prov.exec_playbook(targets, playbook, variables = variables)
+        
+        
+        
+def cluster_store(name):
+    '''
+    Returns:
+        The StateStore of the cluster's <name>.json. The same store is returned for
+        a name, so that its lock is reentrant within a thread.
+    '''
+    with cluster_stores_lock:
+        store = cluster_stores.get(name)
+        if store is None:
+            store = cluster_stores[name] = StateStore(os.path.join(conf_dir(), name + '.json'))
+        return store
     
-    the_conf_dir = conf_dir()
-    cluster_file = os.path.join(the_conf_dir, name + '.json')
-    if not os.path.isfile(cluster_file):
-        return None
-
-    with open(cluster_file, 'r') as f:
-        cluster = json.load(f, object_pairs_hook=collections.OrderedDict)
     
-    return cluster
+    
+def load_cluster(name):
+    '''
+    Returns:
+        The cluster, including changes journaled by workers, or None if it does not exist.
+    '''
+    return cluster_store(name).load()
     
 
 
 
 
+@tracing.traced('write_cluster_json')
 def save_cluster(cluster):
-    
-    the_conf_dir = conf_dir()
-    
-    if not os.path.exists(the_conf_dir):
-        os.makedirs(the_conf_dir)
-    
-    cluster_file = os.path.join(the_conf_dir, cluster['name'] + '.json')
-    with open(cluster_file, 'w') as f:
-        json.dump(cluster, f, indent = 4 * ' ')        
+    '''
+    Atomically rewrites the whole cluster. Prefer journaling changes to individual
+    machines with cluster_store(name).append() or update(), since concurrent workers 
+    don't then overwrite each other's changes.
+    '''
+    with cluster_lock:
+        cluster_store(cluster['name']).commit(cluster)
     
         
         
@@ -319,15 +474,42 @@ def conf_dir() :
     
     
     
-if __name__ == '__main__':
+def parse_options():
+    parser = argparse.ArgumentParser(description='Create performance testing environment for Gluster clusters')
+    subparsers = parser.add_subparsers(dest='command')
     
-    name = 'perfcluster'
-    #cluster = create_cluster(name, 6)
-    cluster = load_cluster(name)
-    #add_client(name)
-    provision_client(cluster, cluster['clients'][-1])
+    create_parser = subparsers.add_parser('create', help='Create a new perf cluster')
+    create_parser.add_argument('name')
+    create_parser.add_argument('datacenter', type=int, help='Datacenter ID')
+    
+    add_parser = subparsers.add_parser('add', help='Add a batch of servers and clients to a cluster')
+    add_parser.add_argument('name')
+    add_parser.add_argument('--servers', type=int, default=0, help='Number of servers to add')
+    add_parser.add_argument('--clients', type=int, default=0, help='Number of clients to add')
+    add_parser.add_argument('--parallelism', type=int, default=DEFAULT_ADD_PARALLELISM,
+        help='Maximum number of machines created and provisioned at the same time. Default: %d' % (
+            DEFAULT_ADD_PARALLELISM))
+    
+    sync_parser = subparsers.add_parser('sync-keys', 
+        help='Authorize every machine of a cluster to SSH to every other machine')
+    sync_parser.add_argument('name')
     
-    #add_server(name)
-    #provision_server(cluster, cluster['servers'][-1])
+    return parser.parse_args()
     
     
+    
+if __name__ == '__main__':
+    opts = parse_options()
+    
+    if opts.command == 'create':
+        create_cluster(opts.name, opts.datacenter)
+        
+    elif opts.command == 'add':
+        add_machines(opts.name, opts.servers, opts.clients, opts.parallelism)
+        
+    elif opts.command == 'sync-keys':
+        cluster = load_cluster(opts.name)
+        if cluster is None:
+            print('Cluster %s does not exist' % (opts.name))
+        else:
+            sync_authorized_keys(cluster)
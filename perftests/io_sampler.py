@@ -0,0 +1,296 @@
+'''
+Module to sample I/O throughput every second while a test runs, so that stalls,
+throughput collapse and warm up effects that whole run averages hide can be seen.
+
+iozone_tests.sh starts it in background for every test when 'sample' flag is given,
+and stops it when the test ends. It records these series:
+    - disk  : Every block device in /proc/diskstats. Bytes and I/O operations completed.
+    - mount : The mount containing TARGET-PATH, from /proc/self/mountstats. Only network
+              filesystems like NFS report byte counters there. FUSE mounts like Gluster
+              native client don't, so this series is not recorded for them.
+    - proc  : Every iozone process descended from the script, from /proc/<PID>/io.
+              Bytes and calls of read and write syscalls. On a FUSE mount, these are
+              the bytes each iozone child transfers to the mount. Sum of all 'proc'
+              series is available as 'procs' series. Bytes a process transfers in the
+              interval in which it exits are not recorded.
+
+Output is a CSV in long format, with one row per series per sample:
+    time,elapsed,source,name,read_bytes_ps,write_bytes_ps,read_ops_ps,write_ops_ps
+
+'time' is epoch seconds and 'elapsed' is seconds since sampling started, which is
+just before the test started. So rows can be aligned with start and end times in the
+test's .conf file.
+
+Linux only.
+
+Usage:
+-----
+$ python io_sampler.py --pid <PID> --output <SAMPLES-CSV> [--target TARGET-PATH] [--interval SECONDS]
+'''
+
+from __future__ import print_function
+
+import os
+import csv
+import time
+import signal
+import argparse
+import collections
+
+SECTOR_SIZE = 512
+
+CSV_HEADER = ['time', 'elapsed', 'source', 'name', 'read_bytes_ps', 'write_bytes_ps',
+    'read_ops_ps', 'write_ops_ps']
+
+# Counters of a series at a point in time.
+Counters = collections.namedtuple('Counters', ['read_bytes', 'write_bytes', 'read_ops', 'write_ops'])
+
+
+
+def read_diskstats(devices=None):
+    '''
+    Args:
+        - devices : Names of devices to read. If not given, all devices except
+            loop and ram devices.
+
+    Returns:
+        dict of device name -> Counters
+    '''
+    stats = {}
+    with open('/proc/diskstats', 'r') as f:
+        for line in f:
+            fields = line.split()
+            name = fields[2]
+            if devices:
+                if name not in devices:
+                    continue
+            elif name.startswith('loop') or name.startswith('ram'):
+                continue
+
+            stats[name] = Counters(int(fields[5]) * SECTOR_SIZE, int(fields[9]) * SECTOR_SIZE,
+                int(fields[3]), int(fields[7]))
+    return stats
+
+
+
+def find_mount_point(path):
+    path = os.path.realpath(path)
+    while not os.path.ismount(path):
+        path = os.path.dirname(path)
+    return path
+
+
+
+def read_mountstats(mount_point):
+    '''
+    Returns:
+        Counters of the mount, or None if its stats don't report bytes.
+    '''
+    in_mount = False
+    with open('/proc/self/mountstats', 'r') as f:
+        for line in f:
+            if line.startswith('device '):
+                in_mount = (' mounted on %s with ' % (mount_point)) in line
+                continue
+
+            if in_mount:
+                fields = line.split()
+                # NFS bytes: normal read, normal write, direct read, direct write, ...
+                if fields and fields[0] == 'bytes:':
+                    counts = [int(v) for v in fields[1:5]]
+                    return Counters(counts[0] + counts[2], counts[1] + counts[3], 0, 0)
+    return None
+
+
+
+def process_tree(root_pid):
+    '''
+    Returns:
+        dict of PID -> command name of all descendants of root_pid.
+    '''
+    parents = {}
+    names = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open('/proc/%s/stat' % (entry), 'r') as f:
+                stat = f.read()
+        except IOError:
+            # Process exited while listing.
+            continue
+
+        # Command name is in parentheses and can contain spaces, so parse around it.
+        pid = int(entry)
+        names[pid] = stat[stat.index('(') + 1 : stat.rindex(')')]
+        parents[pid] = int(stat[stat.rindex(')') + 2:].split()[1])
+
+    descendants = {}
+    for pid in parents:
+        ancestor = parents[pid]
+        while ancestor > 1:
+            if ancestor == root_pid:
+                descendants[pid] = names[pid]
+                break
+            ancestor = parents.get(ancestor, 0)
+    return descendants
+
+
+
+def read_process_io(pid):
+    '''
+    Returns:
+        Counters of the process, or None if it has exited.
+    '''
+    io = {}
+    try:
+        with open('/proc/%d/io' % (pid), 'r') as f:
+            for line in f:
+                key, sep, value = line.partition(':')
+                io[key] = int(value)
+    except (IOError, ValueError):
+        return None
+
+    return Counters(io['rchar'], io['wchar'], io['syscr'], io['syscw'])
+
+
+
+class IOSampler(object):
+
+    def __init__(self, root_pid, output_file, target_path=None, interval=1.0,
+            devices=None, process_name='iozone'):
+        '''
+        Args:
+            - root_pid : PID of the test script. Its descendant processes are sampled,
+                and sampling stops when it exits.
+            - output_file : Path of the samples CSV file.
+            - target_path : Path on the mount under test.
+            - interval : Seconds between samples.
+            - devices : Names of block devices to sample. All devices by default.
+            - process_name : Command name of processes to sample. If empty,
+                all descendants are sampled.
+        '''
+        self.root_pid = root_pid
+        self.output_file = output_file
+        self.interval = interval
+        self.devices = devices
+        self.process_name = process_name
+        self.mount_point = find_mount_point(target_path) if target_path else None
+
+        self.stopped = False
+
+
+    def snapshot(self):
+        '''
+        Returns:
+            dict of (source, name) -> Counters
+        '''
+        counters = {}
+        for name, c in read_diskstats(self.devices).items():
+            counters[('disk', name)] = c
+
+        if self.mount_point:
+            c = read_mountstats(self.mount_point)
+            if c:
+                counters[('mount', self.mount_point)] = c
+
+        for pid, name in process_tree(self.root_pid).items():
+            if self.process_name and name != self.process_name:
+                continue
+            c = read_process_io(pid)
+            if c:
+                counters[('proc', '%s:%d' % (name, pid))] = c
+        return counters
+
+
+    def is_running(self):
+        # A process that has exited but is not yet reaped by its parent still has a
+        # /proc entry, in zombie state Z.
+        try:
+            with open('/proc/%d/stat' % (self.root_pid), 'r') as f:
+                stat = f.read()
+        except IOError:
+            return False
+        return stat[stat.rindex(')') + 2] != 'Z'
+
+
+    def stop(self, *args):
+        self.stopped = True
+
+
+    def run(self):
+        '''
+        Samples till the root process exits or the sampler is stopped.
+        '''
+        with open(self.output_file, 'w') as f:
+            writer = csv.writer(f)
+            writer.writerow(CSV_HEADER)
+
+            start = time.time()
+            prev_time = start
+            prev = self.snapshot()
+            next_time = start + self.interval
+
+            while not self.stopped and self.is_running():
+                # Sleep till the next sample is due, so that samples don't drift.
+                delay = next_time - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+                next_time += self.interval
+
+                now = time.time()
+                current = self.snapshot()
+                elapsed = now - prev_time
+
+                rates = collections.OrderedDict()
+                for key in sorted(current):
+                    # Series that appeared since previous sample, like a newly started
+                    # process, are counted from zero.
+                    before = prev.get(key)
+                    if before is None:
+                        before = Counters(0, 0, 0, 0) if key[0] == 'proc' else current[key]
+                    rates[key] = [(c - b) / elapsed for c, b in zip(current[key], before)]
+
+                # Sum rates instead of counters, since counters of processes that have
+                # exited disappear.
+                proc_rates = [r for key, r in rates.items() if key[0] == 'proc']
+                if proc_rates:
+                    rates[('procs', self.process_name or 'all')] = [sum(r) for r in zip(*proc_rates)]
+
+                for key, r in rates.items():
+                    writer.writerow(['%.3f' % (now), '%.3f' % (now - start), key[0], key[1]] +
+                        ['%.1f' % (v) for v in r])
+
+                # Flush every sample, so that the series is usable even if we're killed.
+                f.flush()
+
+                prev = current
+                prev_time = now
+
+
+
+def parse_options():
+    parser = argparse.ArgumentParser(description='Sample I/O throughput every interval while a test runs')
+    parser.add_argument('--pid', type=int, required=True,
+        help='PID of the test script. Sampling stops when it exits.')
+    parser.add_argument('--output', required=True, help='Samples CSV file')
+    parser.add_argument('--target', help='Path on the mount under test')
+    parser.add_argument('--interval', type=float, default=1.0, help='Seconds between samples. Default: 1')
+    parser.add_argument('--devices', help='Comma separated block devices to sample. Default: all')
+    parser.add_argument('--process-name', default='iozone',
+        help='Command name of processes to sample. Empty for all. Default: iozone')
+    return parser.parse_args()
+
+
+
+if __name__ == '__main__':
+    opts = parse_options()
+
+    sampler = IOSampler(opts.pid, opts.output, opts.target, opts.interval,
+        opts.devices.split(',') if opts.devices else None, opts.process_name)
+
+    # iozone_tests.sh stops the sampler with a SIGTERM when the test ends.
+    signal.signal(signal.SIGTERM, sampler.stop)
+    signal.signal(signal.SIGINT, sampler.stop)
+
+    sampler.run()
@@ -25,14 +25,20 @@ Usage:
 $ python iozone_parser.py <iozone output file> <report name> <csv output file>
 example:
 $ python iozone_parser.py iozone.txt Writer iozone_write_tests.csv
+
+To convert all reports in a single pass, give ALL as report name and a directory
+instead of the CSV file. One CSV file per report, like 'random-read.csv', is generated there.
+$ python iozone_parser.py iozone.txt ALL iozone_csvs
 '''
 
 from __future__ import print_function
 
+import os
 import sys
 import re
 import argparse
 import csv
+import collections
 
 # Generated from curl "http://www.iozone.org/src/current/iozone.c" | grep -E '"\\n%c(.+) report%c\\n"' 
 report_types = ['Writer', 'Re-writer', 'Reader', 'Re-Reader', 
@@ -42,88 +48,174 @@ report_types = ['Writer', 'Re-writer', 'Reader', 'Re-Reader',
                 'Pwrite', 'Re-Pwrite', 'Pread', 'Re-Pread', 
                 'Pwritev', 'Re-Pwritev', 'Preadv', 'Re-Preadv']
 
+# Special report type to convert all reports found in the iozone output.
+ALL_REPORTS = 'ALL'
+
 def generate_csv(opts):
-    # Read iozone report
-    iozone_report = read_iozone_report(opts.iozone_report_file)
-    
-    # print(iozone_report)
-    
-    # Extract requested report data if available.
-    report_data = find_report(iozone_report, opts.report_type)
-    if not report_data:
-        print("Error: %s report not found in %s" % (opts.report_type, opts.iozone_report_file))
-        return False
-    
-    #print(report_data)
+    '''
+    Converts the requested report, or all reports if report type is ALL, to CSV.
     
-    # Extract other information like units.
-    units = extract_units(iozone_report)
-    if not units:
-        print("Error: Unable to find units of reported values")
-        return False
+    The iozone output is read just once, line by line, and every report is written out
+    as its rows are read. So memory usage stays flat regardless of report size.
+    '''
+    if opts.report_type == ALL_REPORTS:
+        wanted_types = report_types
+        csv_dir = opts.csv_file
+        if not os.path.isdir(csv_dir):
+            os.makedirs(csv_dir)
+        csv_file_for = lambda report_type: os.path.join(csv_dir, report_csv_filename(report_type))
+    else:
+        wanted_types = [opts.report_type]
+        csv_file_for = lambda report_type: opts.csv_file
         
-    #print(units)
-   
-    # Transform report data to CSV.
-    csv_output = transform(report_data, units)
-    if not csv_output:
-        print("Error: Unable to transform data to CSV. Possibly empty data")
+    try:
+        with open(opts.iozone_report_file, 'r') as f:
+            generated = write_report_csvs(f, wanted_types, csv_file_for)
+    except ValueError as e:
+        print("Error: %s" % (e))
         return False
         
-    #print(csv_output)
-    
-    # Write CSV
-    with open(opts.csv_file, 'w') as f:
-        f.write(csv_output)
-        
-    # Verify CSV.
-    try:
-        with open(opts.csv_file, 'rb') as f:
-            reader = csv.reader(f)
-            for row in reader:
-                pass
-    except csv.Error:
-        print("Error: Something wrong in output CSV. Possibly iozone output format has changed.")
+    if not generated:
+        print("Error: %s report not found in %s" % (opts.report_type, opts.iozone_report_file))
         return False
     
-    print("Generated %s" % (opts.csv_file))
+    for csv_file in generated.values():
+        # Verify CSV.
+        try:
+            with open(csv_file, 'rb') as f:
+                reader = csv.reader(f)
+                for row in reader:
+                    pass
+        except csv.Error:
+            print("Error: Something wrong in output CSV. Possibly iozone output format has changed.")
+            return False
+    
+        print("Generated %s" % (csv_file))
+        
     return True
 
 
-def read_iozone_report(iozone_report_file):
-    
-    with open(iozone_report_file, 'r') as f:
-        iozone_report = f.read()
-        
-    return iozone_report
 
+def report_csv_filename(report_type):
+    '''
+    Name of the CSV file for a report type, like 'random-read.csv' for 'Random read'.
+    '''
+    return report_type.lower().replace(' ', '-') + '.csv'
+    
 
 
-def find_report(iozone_report, report_type):
-    # Find sections which look like this:
-    # ...
-    # "Writer report"
-    #    "4"
-    # ...
-    # The report data spans from this point to either start of next report,
-    # of if there is no next report to EOF.
+def write_report_csvs(lines, wanted_types, csv_file_for):
+    '''
+    Writes a CSV file for each of the wanted report types found in iozone output.
     
-    pattern = '^\"%s report\"$' % (report_type)
-    m = re.search(pattern, iozone_report, re.MULTILINE)
-    if not m:
-        return None
-    report_start = m.end()
+    Args:
+        - lines : iterable of iozone output lines, like an open file.
+        - wanted_types : list of report types to convert.
+        - csv_file_for : function that returns CSV file path for a report type.
+        
+    Returns:
+        dict of report type -> generated CSV file path, for reports that were found.
+    '''
+    generated = collections.OrderedDict()
+    
+    out = None
+    for event in parse_reports(lines):
+        if event[0] == 'start':
+            report_type = event[1]
+            if out:
+                out.close()
+                out = None
+            if report_type in wanted_types:
+                csv_file = csv_file_for(report_type)
+                out = open(csv_file, 'w')
+                generated[report_type] = csv_file
+                
+        elif event[0] == 'header':
+            if out:
+                out.write(event[2] + '\n')
+                
+        elif event[0] == 'row':
+            if out:
+                out.write(event[2] + '\n')
+                
+        elif event[0] == 'end':
+            if out:
+                out.close()
+                out = None
+                
+    if out:
+        out.close()
+    
+    return generated
     
-    next_report = re.search('^\".+ report\"$', iozone_report[report_start:], re.MULTILINE)
-    #print(iozone_report[report_start + next_report.start() : report_start + next_report.end()])
-    report_end = report_start + next_report.start() if next_report else -1
     
-    return iozone_report[report_start:report_end]
-
-
 
-def extract_units(iozone_report):
+def parse_reports(lines):
+    '''
+    Single pass state machine over iozone output lines. Yields these events:
+        ('units', units)
+        ('start', report_type)
+        ('header', report_type, csv_header_row)
+        ('row', report_type, csv_values_row)
+        ('end', report_type)
+    
+    A report ends at start of next report, at a line that is not part of a table, or at EOF.
+    
+    Raises:
+        ValueError if a report is found before units of reported values are known.
+    '''
+    units = None
+    report_type = None
+    num_columns = 0
+    
+    for line in lines:
+        if units is None:
+            line_units = parse_units(line.rstrip('\r\n'))
+            if line_units:
+                units = line_units
+                yield ('units', units)
+                continue
+        
+        line = line.strip()
+        
+        m = REPORT_START_RE.match(line)
+        if m:
+            if report_type:
+                yield ('end', report_type)
+            
+            report_type = m.group(1)
+            num_columns = 0
+            if units is None:
+                raise ValueError("Unable to find units of reported values")
+            yield ('start', report_type)
+            continue
+            
+        if not report_type or not line:
+            continue
+        
+        if not line.startswith('"'):
+            # Some other output after the table.
+            yield ('end', report_type)
+            report_type = None
+            continue
+        
+        if num_columns == 0:
+            header_row, num_columns = transform_header(line)
+            yield ('header', report_type, header_row)
+        else:
+            yield ('row', report_type, transform_row(line, units, num_columns))
     
+    if report_type:
+        yield ('end', report_type)
+        
+        
+# Matches first line of a report like '"Writer report"'
+REPORT_START_RE = re.compile('^\"(.+) report\"$')
+
+def parse_units(line):
+    '''
+    Returns units of reported values if line is the one that describes them, else None.
+    '''
     # We need the units of reported values, so we can convert correctly.
     # iozone reports units in a line like this:
     #   Output is in Kbytes/sec
@@ -133,7 +225,7 @@ def extract_units(iozone_report):
     #   Output is in microseconds/op
     # This parser searches for lines with "Output is in" and then searches (case insensitive)
     # for kbytes, operations|ops, microseconds
-    m = re.search('.+Output is in (.+)$', iozone_report, re.MULTILINE)
+    m = re.search('.+Output is in (.+)$', line)
     if not m:
         return None
         
@@ -162,52 +254,73 @@ def transform(report_data, units):
         ..
     
     '''
+    lines = [line.strip() for line in report_data.splitlines() if line.strip()]
+    if not lines:
+        return None
+        
+    header_row, num_columns = transform_header(lines[0])
+    
+    csv_output = header_row + '\n'        
+    
+    for dataline in lines[1:]:
+        csv_output += transform_row(dataline, units, num_columns) + '\n'
+    
+    return csv_output
+    
+
+
+def transform_header(line):
+    '''
+    Converts the header line of a report to a CSV header row.
+    
+    Returns:
+        (header_row, num_columns) - num_columns includes the filesize column.
+    '''
     # First line tells us how many data columns there are.
     # Subsequent lines will be "<Filesize>" followed by max that many data columns.
     # But if file size is less than record length, there won't be any values. So number of columns
     # need not be same in every row.
     # Columns can be split on whitespaces.
-    lines = [line.strip() for line in report_data.splitlines() if line.strip()]
-    if not lines:
-        return None
-        
+    
     # Get header row, and modify column headers to strip out double quotes
     # and append a KB or MB depending on value < or >= 1024
-    header = lines[0].split()
+    header = line.split()
     header_values = [int(col.strip('"')) for col in header]
     header = ['%d KB'%(col) if col<1024 else '%d MB'%(col/1024) for col in header_values]
     header.insert(0, 'filesize')
-    header_row = ','.join(header)
     
-    csv_output = header_row + '\n'        
+    return ','.join(header), len(header)
     
-    for dataline in lines[1:]:
-        values = dataline.split()
-        filesize = int(values[0].strip('"'))
-        if filesize < 1024:
-            filesize = '%d KB'%(filesize)
-            
-        elif filesize < 1024 * 1024:
-            filesize = '%d MB'%(filesize/1024)
-            
-        else:
-            filesize = '%d GB'%(filesize/(1024*1024))
-        values[0] = filesize
-        
-        if units == 'kb':
-            # Convert to MB
-            values[1:] = [float(int(v)/1024.0) for v in values[1:]]
+
+
+def transform_row(dataline, units, num_columns):
+    '''
+    Converts a data line of a report to a CSV row with num_columns columns.
+    '''
+    values = dataline.split()
+    filesize = int(values[0].strip('"'))
+    if filesize < 1024:
+        filesize = '%d KB'%(filesize)
         
-        values_row = ','.join([str(v) for v in values])
+    elif filesize < 1024 * 1024:
+        filesize = '%d MB'%(filesize/1024)
         
-        # Rows which have file size less than record lengths won't have 
-        # any columns above file size.
-        # So add as many commas as required to match header row.
-        values_row += ',' * (len(header) - len(values))
+    else:
+        filesize = '%d GB'%(filesize/(1024*1024))
+    values[0] = filesize
     
-        csv_output += values_row + '\n'
+    if units == 'kb':
+        # Convert to MB
+        values[1:] = [float(int(v)/1024.0) for v in values[1:]]
     
-    return csv_output
+    values_row = ','.join([str(v) for v in values])
+    
+    # Rows which have file size less than record lengths won't have 
+    # any columns above file size.
+    # So add as many commas as required to match header row.
+    values_row += ',' * (num_columns - len(values))
+
+    return values_row
     
     
 
@@ -218,11 +331,13 @@ def parse_options():
                         help='Iozone report file generated with -R option')
                         
 
-    parser.add_argument('report_type', metavar=" 'REPORT-TYPE' ", choices = report_types,
-                        help='Name of the report.\n'  + str(report_types))
+    parser.add_argument('report_type', metavar=" 'REPORT-TYPE' ", choices = report_types + [ALL_REPORTS],
+                        help='Name of the report, or %s to convert all reports in a single pass.\n' % (ALL_REPORTS) 
+                            + str(report_types))
 
     parser.add_argument('csv_file', metavar=' CSV-FILE ', 
-                        help='CSV file to generate')
+                        help='CSV file to generate. If REPORT-TYPE is %s, directory where a CSV file '
+                            'is generated for each report' % (ALL_REPORTS))
                         
     args = parser.parse_args()
     return args
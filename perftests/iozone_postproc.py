@@ -10,7 +10,15 @@ is not present, functionality degrates gracefully.
 
 @copyright: Red Hat 2010
 """
-import os, sys, optparse, math, time
+import os, sys, optparse, math, time, random, glob, fnmatch
+import multiprocessing
+
+# numpy is optional. If present, results are aggregated with vectorized
+# operations, else with the pure python implementation.
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 _LABELS = ['file_size', 'record_size', 'write', 'rewrite', 'read', 'reread',
            'randread', 'randwrite', 'bkwdread', 'recordrewrite', 'strideread',
@@ -56,6 +64,171 @@ def geometric_mean(values):
     return math.exp(sum([math.log(x) for x in values])/n)
 
 
+def parse_results(file):
+    """
+    Parse IOzone auto mode results from lines of an IOzone output.
+
+    @param file: File object or any iterable of lines.
+    @return: Matrix containing IOzone results extracted from the lines.
+    """
+    lines = []
+    for line in file:
+        fields = line.split()
+        if len(fields) != 15:
+            continue
+        try:
+            lines.append([int(i) for i in fields])
+        except ValueError:
+            continue
+    return lines
+
+
+def grouped_geometric_means(matrix, index=None):
+    """
+    Evaluates geometric means of all 13 throughput columns at once, using numpy.
+
+    @param matrix: numpy 2D array with IOzone results, one row per result line.
+    @param index: Column to group the rows by, or None to average all rows.
+    @return: List of lines in the same format as
+            IOzoneAnalyzer.average_performance(): [size,] followed by 13 averages
+            in MB/s. One line per unique value of the column, in sorted order.
+    """
+    with numpy.errstate(divide='ignore'):
+        logs = numpy.log(matrix[:, 2:15])
+
+    if index is None:
+        means = numpy.exp(logs.mean(axis=0)) / 1024.0
+        return [[int(value) for value in means]]
+
+    # Sort once by the grouping column, then reduce each run of equal keys.
+    order = numpy.argsort(matrix[:, index], kind='mergesort')
+    keys = matrix[order, index]
+    logs = logs[order]
+    starts = numpy.flatnonzero(numpy.concatenate(([True], keys[1:] != keys[:-1])))
+    counts = numpy.diff(numpy.append(starts, len(keys)))
+    means = numpy.exp(numpy.add.reduceat(logs, starts, axis=0) / counts[:, None]) / 1024.0
+
+    return [[int(key)] + [int(value) for value in line]
+            for key, line in zip(keys[starts], means)]
+
+
+def mean_stddev(values):
+    """
+    Evaluates mean and sample standard deviation of a list of values.
+
+    @param values: List with at least 1 value.
+    @return: Tuple (mean, stddev). stddev is 0 if there is only 1 value.
+    """
+    n = len(values)
+    mean = sum(values) / float(n)
+    if n < 2:
+        return (mean, 0.0)
+    variance = sum([(x - mean) ** 2 for x in values]) / (n - 1)
+    return (mean, math.sqrt(variance))
+
+
+def _betacf(a, b, x):
+    """
+    Continued fraction for the incomplete beta function, by modified Lentz's
+    method. See Numerical Recipes, section 6.4.
+    """
+    tiny = 1e-300
+    qab = a + b
+    qap = a + 1.0
+    qam = a - 1.0
+    c = 1.0
+    d = 1.0 - qab * x / qap
+    if abs(d) < tiny:
+        d = tiny
+    d = 1.0 / d
+    h = d
+    for m in range(1, 201):
+        m2 = 2 * m
+        aa = m * (b - m) * x / ((qam + m2) * (a + m2))
+        d = 1.0 + aa * d
+        if abs(d) < tiny:
+            d = tiny
+        c = 1.0 + aa / c
+        if abs(c) < tiny:
+            c = tiny
+        d = 1.0 / d
+        h *= d * c
+        aa = -(a + m) * (qab + m) * x / ((a + m2) * (qap + m2))
+        d = 1.0 + aa * d
+        if abs(d) < tiny:
+            d = tiny
+        c = 1.0 + aa / c
+        if abs(c) < tiny:
+            c = tiny
+        d = 1.0 / d
+        delta = d * c
+        h *= delta
+        if abs(delta - 1.0) < 3e-12:
+            break
+    return h
+
+
+def incomplete_beta(a, b, x):
+    """
+    Regularized incomplete beta function I_x(a, b).
+    """
+    if x <= 0.0:
+        return 0.0
+    if x >= 1.0:
+        return 1.0
+    front = math.exp(math.lgamma(a + b) - math.lgamma(a) - math.lgamma(b) +
+                     a * math.log(x) + b * math.log(1.0 - x))
+    if x < (a + 1.0) / (a + b + 2.0):
+        return front * _betacf(a, b, x) / a
+    return 1.0 - front * _betacf(b, a, 1.0 - x) / b
+
+
+def welch_t_test(mean1, stddev1, n1, mean2, stddev2, n2):
+    """
+    Welch's t-test for the difference of means of 2 samples with possibly
+    unequal variances.
+
+    @return: Two sided p-value, the probability of seeing a difference at
+            least this large if both samples came from the same distribution.
+            None if either sample has less than 2 values.
+    @see: http://en.wikipedia.org/wiki/Welch%27s_t-test
+    """
+    if n1 < 2 or n2 < 2:
+        return None
+    se1 = stddev1 ** 2 / n1
+    se2 = stddev2 ** 2 / n2
+    if se1 + se2 == 0:
+        return 1.0 if mean1 == mean2 else 0.0
+    t = (mean2 - mean1) / math.sqrt(se1 + se2)
+    df = (se1 + se2) ** 2 / ((se1 ** 2 / (n1 - 1) if se1 else 0.0) +
+                             (se2 ** 2 / (n2 - 1) if se2 else 0.0))
+    return incomplete_beta(df / 2.0, 0.5, df / (df + t * t))
+
+
+def cell_statistics(result_sets):
+    """
+    Aligns repeated IOzone runs by (file_size, record_size) and evaluates
+    mean and standard deviation of every throughput value.
+
+    @param result_sets: List of result matrices, one per repeated run.
+    @return: Dict of (file_size, record_size) -> list of 13 (mean, stddev, n)
+            tuples, one per throughput column.
+    """
+    samples = {}
+    for results in result_sets:
+        for line in results:
+            key = (int(line[0]), int(line[1]))
+            columns = samples.setdefault(key, [[] for i in range(2, 15)])
+            for i in range(2, 15):
+                columns[i - 2].append(float(line[i]))
+
+    statistics = {}
+    for key, columns in samples.items():
+        statistics[key] = [mean_stddev(values) + (len(values),)
+                           for values in columns]
+    return statistics
+
+
 def compare_matrices(matrix1, matrix2, treshold=0.05):
     """
     Compare 2 matrices nxm and return a matrix nxm with comparison data
@@ -82,7 +255,7 @@ def compare_matrices(matrix1, matrix2, treshold=0.05):
                 improvements += 1
                 new_line.append("+" + str((100 * ratio - 1) - 100))
             else:
-                same + 1
+                same += 1
                 if line1.index(element1) == 0:
                     new_line.append(element1)
                 else:
@@ -105,13 +278,18 @@ class IOzoneAnalyzer(object):
 
     If more than one file is provided to the analyzer object, a comparison
     between the two runs is made, searching for regressions in performance.
+
+    Without an output directory, the analyzer can load and aggregate results,
+    but not write reports.
     """
-    def __init__(self, list_files, output_dir):
+    def __init__(self, list_files, output_dir=None, store_dir=None):
         self.list_files = list_files
-        if not os.path.isdir(output_dir):
-            os.makedirs(output_dir)
+        self.store_dir = store_dir
         self.output_dir = output_dir
-        print "Results will be stored in %s" % output_dir
+        if output_dir is not None:
+            if not os.path.isdir(output_dir):
+                os.makedirs(output_dir)
+            print "Results will be stored in %s" % output_dir
 
 
     def average_performance(self, results, size=None):
@@ -159,6 +337,29 @@ class IOzoneAnalyzer(object):
         return performance
 
 
+    def process_all_results(self, results):
+        """
+        Process a list of IOzone results for all files and records, for each
+        record size and for each file size.
+
+        Uses numpy if available, which is much faster for large result sets.
+
+        @result: A list of n x m columns, or a numpy array, with original
+                iozone results.
+        @return: Tuple (overall, per record size, per file size) of geometric
+                averages, in the same format as process_results().
+        """
+        if numpy is None or len(results) == 0:
+            return (self.process_results(results),
+                    self.process_results(results, 'record_size'),
+                    self.process_results(results, 'file_size'))
+
+        matrix = numpy.array(results, dtype=numpy.float64)
+        return (grouped_geometric_means(matrix),
+                grouped_geometric_means(matrix, _LABELS.index('record_size')),
+                grouped_geometric_means(matrix, _LABELS.index('file_size')))
+
+
     def parse_file(self, file):
         """
         Parse an IOzone results file.
@@ -166,16 +367,26 @@ class IOzoneAnalyzer(object):
         @param file: File object that will be parsed.
         @return: Matrix containing IOzone results extracted from the file.
         """
-        lines = []
-        for line in file.readlines():
-            fields = line.split()
-            if len(fields) != 15:
-                continue
-            try:
-                lines.append([int(i) for i in fields])
-            except ValueError:
-                continue
-        return lines
+        return parse_results(file)
+
+
+    def load_results(self, path):
+        """
+        Load results of an IOzone run, either by parsing its results file or,
+        if a result store was given, from the store.
+
+        @param path: Results file path, or run ID if a result store was given.
+        @return: Matrix containing IOzone results.
+        """
+        if self.store_dir:
+            import iozone_store
+            return iozone_store.load_iozone_matrix(self.store_dir, path)
+
+        file = open(path, 'r')
+        try:
+            return self.parse_file(file)
+        finally:
+            file.close()
 
 
     def report(self, overall_results, record_size_results, file_size_results):
@@ -299,14 +510,12 @@ class IOzoneAnalyzer(object):
         record_size = []
         file_size = []
         for path in self.list_files:
-            file = open(path, 'r')
             print 'FILE: %s' % path
 
-            results = self.parse_file(file)
+            results = self.load_results(path)
 
-            overall_results = self.process_results(results)
-            record_size_results = self.process_results(results, 'record_size')
-            file_size_results = self.process_results(results, 'file_size')
+            (overall_results, record_size_results,
+             file_size_results) = self.process_all_results(results)
             self.report(overall_results, record_size_results, file_size_results)
 
             if len(self.list_files) == 2:
@@ -320,6 +529,121 @@ class IOzoneAnalyzer(object):
             self.report_comparison(record_comparison, file_comparison)
 
 
+class IOzoneComparator(object):
+    """
+    Compares any number of sets of IOzone runs against a baseline set.
+
+    Each set is a group of repeated runs of the same test, say from
+    numruns=5, before and after a tuning change. Results are aligned by
+    (file_size, record_size), so runs need not have identical rows. For
+    every throughput value, the mean of a set is compared with the
+    baseline's mean using Welch's t-test, and the difference is reported
+    only if it's statistically significant. This separates real changes from
+    the run to run noise of cloud machines.
+
+    If a set or the baseline has only one run for a value, no test is
+    possible and a fixed ratio threshold is used instead.
+    """
+    def __init__(self, groups, alpha=0.05, treshold=0.05):
+        """
+        @param groups: List of (name, list of result matrices) tuples. First
+                one is the baseline.
+        @param alpha: Significance level of the test.
+        @param treshold: Ratio treshold used when there are too few runs to test.
+        """
+        assert len(groups) >= 2
+        self.groups = groups
+        self.alpha = alpha
+        self.treshold = treshold
+
+
+    def compare(self):
+        """
+        @return: List of (name, findings) tuples for every non-baseline set.
+                findings is a list of dicts, one per aligned value, sorted by
+                file size, record size and column.
+        """
+        baseline = cell_statistics(self.groups[0][1])
+        comparisons = []
+        for name, result_sets in self.groups[1:]:
+            statistics = cell_statistics(result_sets)
+            findings = []
+            for key in sorted(set(baseline.keys()) & set(statistics.keys())):
+                for i in range(13):
+                    findings.append(self.compare_cell(key, i, baseline[key][i],
+                                                      statistics[key][i]))
+            comparisons.append((name, findings))
+        return comparisons
+
+
+    def compare_cell(self, key, column, base, other):
+        """
+        Compares one aligned value of a set with the baseline.
+
+        @return: Dict describing the comparison. 'verdict' is one of
+                'regression', 'improvement' or 'same'.
+        """
+        (base_mean, base_stddev, base_n) = base
+        (mean, stddev, n) = other
+
+        change = 100.0 * (mean - base_mean) / base_mean if base_mean else 0.0
+
+        p = welch_t_test(base_mean, base_stddev, base_n, mean, stddev, n)
+        if p is not None:
+            changed = p < self.alpha
+        else:
+            changed = abs(change) > 100.0 * self.treshold
+
+        if not changed:
+            verdict = 'same'
+        elif mean < base_mean:
+            verdict = 'regression'
+        else:
+            verdict = 'improvement'
+
+        return {'file_size': key[0], 'record_size': key[1],
+                'column': _LABELS[column + 2],
+                'base_mean': base_mean, 'base_stddev': base_stddev,
+                'base_n': base_n, 'mean': mean, 'stddev': stddev, 'n': n,
+                'change': change, 'p': p, 'verdict': verdict}
+
+
+    def report(self):
+        """
+        Prints regressions and improvements of every set against the baseline.
+
+        @return: Total number of regressions found.
+        """
+        total_regressions = 0
+        print "BASELINE: %s (%d runs)" % (self.groups[0][0], len(self.groups[0][1]))
+        for name, findings in self.compare():
+            regressions = [f for f in findings if f['verdict'] == 'regression']
+            improvements = [f for f in findings if f['verdict'] == 'improvement']
+            total_regressions += len(regressions)
+            total = len(findings)
+
+            print ""
+            print "COMPARISON: %s (%d runs) against baseline" % (name, len(dict(self.groups)[name]))
+            print ""
+            print "FILE SIZE  RECORD    TEST            BASELINE (KB/s)        THIS RUN (KB/s)       % DIFF     P"
+            print "(KB)       (KB)                      MEAN      STDDEV       MEAN      STDDEV"
+            print "---------------------------------------------------------------------------------------------------"
+            for f in regressions + improvements:
+                print "%-11s%-10s%-16s%-10d%-13d%-10d%-13d%-+11.2f%s" % (
+                    f['file_size'], f['record_size'], f['column'],
+                    f['base_mean'], f['base_stddev'], f['mean'], f['stddev'],
+                    f['change'], '%.4f' % f['p'] if f['p'] is not None else 'n/a')
+            if total:
+                print "REGRESSIONS: %d (%.2f%%)    Improvements: %d (%.2f%%)    Aligned values: %d" % (
+                    len(regressions), 100 * len(regressions) / float(total),
+                    len(improvements), 100 * len(improvements) / float(total),
+                    total)
+            else:
+                print "No (file size, record size) values in common with baseline"
+        print ""
+        return total_regressions
+
+
 class IOzonePlotter(object):
     """
     Plots graphs based on the results of an IOzone run.
@@ -327,7 +651,7 @@ class IOzonePlotter(object):
     Plots graphs based on the results of an IOzone run. Uses gnuplot to
     generate the graphs.
     """
-    def __init__(self, results_file, output_dir):
+    def __init__(self, results_file, output_dir, store_dir=None):
         self.active = True
 
         self.gnuplot = "/usr/bin/gnuplot"
@@ -335,8 +659,12 @@ class IOzonePlotter(object):
         if not os.path.isdir(output_dir):
             os.makedirs(output_dir)
         self.output_dir = output_dir
+        self.store_dir = store_dir
 
-        if not os.path.isfile(results_file):
+        if store_dir:
+            self.results_file = results_file
+            self.generate_data_source_from_store()
+        elif not os.path.isfile(results_file):
             print "Invalid file %s provided, disabling graph generation", results_file
             self.active = False
             self.results_file = None
@@ -364,6 +692,20 @@ class IOzonePlotter(object):
         datasource.close()
 
 
+    def generate_data_source_from_store(self):
+        """
+        Creates data file without headers for gnuplot consumption, from a run
+        in the result store.
+        """
+        import iozone_store
+        matrix = iozone_store.load_iozone_matrix(self.store_dir, self.results_file)
+        self.datasource = os.path.join(self.output_dir, '3d-datasource')
+        datasource = open(self.datasource, 'w')
+        for values in matrix:
+            datasource.write(" ".join([str(value) for value in values]) + "\n")
+        datasource.close()
+
+
     def plot_2d_graphs(self):
         """
         For each one of the throughput parameters, generate a set of gnuplot
@@ -432,16 +774,290 @@ class IOzonePlotter(object):
             self.plot_3d_graphs()
 
 
+def log_sums(results, index=None):
+    """
+    Sums logarithms of all 13 throughput columns, grouped by a column. Sums
+    of separate result sets can be added up and then turned into geometric
+    means, which is how results of many files are combined.
+
+    @param results: List of n x m columns with original iozone results.
+    @param index: Column to group the rows by, or None to sum all rows.
+    @return: Dict of size -> (list of 13 log sums, row count). The only key
+            is None if index is None.
+    """
+    sums = {}
+    for line in results:
+        key = line[index] if index is not None else None
+        if key not in sums:
+            sums[key] = ([0.0] * 13, 0)
+        (line_sums, count) = sums[key]
+        for i in range(2, 15):
+            value = float(line[i])
+            line_sums[i - 2] += math.log(value) if value > 0 else float('-inf')
+        sums[key] = (line_sums, count + 1)
+    return sums
+
+
+def merge_log_sums(merged, sums):
+    """
+    Adds log sums of one result set to merged log sums, in place.
+    """
+    for key, (line_sums, count) in sums.items():
+        if key not in merged:
+            merged[key] = ([0.0] * 13, 0)
+        (merged_sums, merged_count) = merged[key]
+        merged[key] = ([a + b for a, b in zip(merged_sums, line_sums)],
+                       merged_count + count)
+
+
+def log_sums_to_performance(sums):
+    """
+    Converts log sums to lines of geometric means, in the same format as
+    IOzoneAnalyzer.process_results().
+    """
+    performance = []
+    for key in sorted(sums.keys()):
+        (line_sums, count) = sums[key]
+        line = [key] if key is not None else []
+        line.extend([int(math.exp(x / count) / 1024.0) for x in line_sums])
+        performance.append(line)
+    return performance
+
+
+def analyze_file_worker(path):
+    """
+    Parses and aggregates one IOzone results file. Runs in a worker process
+    of the batch mode pool.
+
+    @return: Tuple (path, row count, overall results, log sums for all rows,
+            log sums by record size, log sums by file size)
+    """
+    file = open(path, 'r')
+    try:
+        results = parse_results(file)
+    finally:
+        file.close()
+
+    if not results:
+        return (path, 0, None, {}, {}, {})
+
+    overall_sums = log_sums(results)
+    return (path, len(results), log_sums_to_performance(overall_sums),
+            overall_sums,
+            log_sums(results, _LABELS.index('record_size')),
+            log_sums(results, _LABELS.index('file_size')))
+
+
+def find_result_files(top_dir, pattern='*.out'):
+    """
+    @return: Sorted list of paths of all files under top_dir matching pattern.
+    """
+    paths = []
+    for dirpath, dirnames, filenames in os.walk(top_dir):
+        for filename in fnmatch.filter(filenames, pattern):
+            paths.append(os.path.join(dirpath, filename))
+    return sorted(paths)
+
+
+def analyze_batch(top_dir, output_dir, processes=None, pattern='*.out'):
+    """
+    Parses and aggregates all IOzone results files under a directory tree,
+    one file per worker process, and reports them together: one summary line
+    per file, followed by the combined results of all files.
+
+    @param top_dir: Directory tree to search, like a DIST mode reports directory.
+    @param output_dir: Where the combined 2D data sources are written.
+    @param processes: Number of worker processes. Default is number of CPUs.
+    @param pattern: Glob pattern of results file names.
+    @return: Number of files with results.
+    """
+    paths = find_result_files(top_dir, pattern)
+    if not paths:
+        print "No files matching %s found under %s" % (pattern, top_dir)
+        return 0
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        file_results = pool.map(analyze_file_worker, paths, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+    overall_sums = {}
+    record_size_sums = {}
+    file_size_sums = {}
+
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    summary_path = os.path.join(output_dir, 'batch-summary')
+    summary = open(summary_path, 'w')
+
+    print ""
+    print "TABLE:  SUMMARY of EACH FILE                                        Results in MB/sec"
+    print ""
+    print "INIT    RE              RE    RANDOM  RANDOM  BACKWD   RECRE  STRIDE    F       FRE     F       FRE"
+    print "WRITE   WRITE   READ    READ    READ   WRITE    READ   WRITE    READ    WRITE   WRITE   READ    READ    FILE"
+    print "-------------------------------------------------------------------------------------------------------------------"
+    num_files = 0
+    for (path, rows, overall, file_overall_sums, file_record_size_sums,
+         file_file_size_sums) in file_results:
+        if not rows:
+            print "%-104s%s (no results)" % ("", path)
+            continue
+
+        num_files += 1
+        line = "%-8s%-8s%-8s%-8s%-8s%-8s%-8s%-8s%-8s%-8s%-8s%-8s%-8s%s" % (
+            tuple(overall[0]) + (path,))
+        print line
+        summary.write(line + "\n")
+
+        merge_log_sums(overall_sums, file_overall_sums)
+        merge_log_sums(record_size_sums, file_record_size_sums)
+        merge_log_sums(file_size_sums, file_file_size_sums)
+    summary.close()
+    print ""
+
+    if num_files:
+        print "COMBINED RESULTS of %d FILES:" % num_files
+        analyzer = IOzoneAnalyzer([], output_dir)
+        analyzer.report(log_sums_to_performance(overall_sums),
+                        log_sums_to_performance(record_size_sums),
+                        log_sums_to_performance(file_size_sums))
+    return num_files
+
+
+def compare_run_sets(set_specs, alpha, store_dir=None):
+    """
+    Compares sets of repeated runs against the first set.
+
+    @param set_specs: List of comma separated paths or glob patterns, or run
+            IDs or patterns of run IDs if store_dir is given.
+    @return: Number of regressions found.
+    @raise ValueError: If a path, run ID or pattern matches nothing.
+    """
+    analyzer = IOzoneAnalyzer([], store_dir=store_dir)
+    if store_dir:
+        import iozone_store
+        run_ids = list(iozone_store.load_index(store_dir).keys())
+
+    groups = []
+    for spec in set_specs:
+        paths = []
+        for pattern in spec.split(','):
+            if store_dir:
+                matches = fnmatch.filter(run_ids, pattern)
+            else:
+                matches = sorted(glob.glob(pattern))
+            if not matches:
+                raise ValueError("%s matches no %s" % (
+                    pattern, "run in store %s" % store_dir if store_dir else "file"))
+            paths.extend(matches)
+        print "SET %s: %s" % (spec, " ".join(paths))
+        groups.append((spec, [analyzer.load_results(path) for path in paths]))
+    print ""
+
+    return IOzoneComparator(groups, alpha).report()
+
+
+def benchmark(num_rows):
+    """
+    Compares the pure python and numpy aggregation of synthetic IOzone results.
+
+    @param num_rows: Number of result lines to generate.
+    """
+    if numpy is None:
+        print "numpy is not installed, nothing to compare"
+        return
+
+    # Sizes are powers of 2 like in iozone auto mode, and values are in KB/s.
+    file_sizes = [2 ** i for i in range(6, 25)]
+    record_sizes = [2 ** i for i in range(2, 15)]
+    results = []
+    for i in range(num_rows):
+        line = [random.choice(file_sizes), random.choice(record_sizes)]
+        line.extend([random.randint(10000, 5000000) for j in range(13)])
+        results.append(line)
+
+    analyzer = IOzoneAnalyzer([])
+
+    start = time.time()
+    python_results = (analyzer.process_results(results),
+                      analyzer.process_results(results, 'record_size'),
+                      analyzer.process_results(results, 'file_size'))
+    python_time = time.time() - start
+
+    start = time.time()
+    numpy_results = analyzer.process_all_results(results)
+    numpy_time = time.time() - start
+
+    # Truncation to integer MB/s can differ by 1 due to floating point
+    # summation order.
+    max_diff = 0
+    for python_table, numpy_table in zip(python_results, numpy_results):
+        for python_line, numpy_line in zip(python_table, numpy_table):
+            for python_value, numpy_value in zip(python_line, numpy_line):
+                max_diff = max(max_diff, abs(python_value - numpy_value))
+
+    print "Rows: %d" % num_rows
+    print "Python: %.3f secs" % python_time
+    print "Numpy:  %.3f secs (%.1fx faster)" % (numpy_time, python_time / numpy_time)
+    print "Max difference in results: %d MB/s" % max_diff
+
+
 if __name__ == "__main__":
     parser = optparse.OptionParser("usage: %prog [options] [filenames]")
+    parser.add_option("--benchmark", type="int", metavar="ROWS",
+                      help="compare python and numpy aggregation on ROWS "
+                           "synthetic result lines, and exit")
+    parser.add_option("--compare", action="store_true",
+                      help="compare sets of repeated runs. Every argument is "
+                           "a set, given as comma separated files or glob "
+                           "patterns, or run IDs or patterns of them with "
+                           "--store. The first set is the baseline. Exits "
+                           "with status 1 if any regression is found")
+    parser.add_option("--alpha", type="float", default=0.05,
+                      help="significance level for --compare [default: %default]")
+    parser.add_option("--batch", metavar="DIR",
+                      help="analyze all results files under DIR in parallel, "
+                           "and report them together")
+    parser.add_option("--pattern", default="*.out",
+                      help="file name pattern of results files for --batch "
+                           "[default: %default]")
+    parser.add_option("--processes", type="int",
+                      help="number of worker processes for --batch "
+                           "[default: number of CPUs]")
+    parser.add_option("--store", metavar="STORE-DIR",
+                      help="read results from this result store (see "
+                           "iozone_store.py). Filenames are run IDs in the store")
     options, args = parser.parse_args()
 
+    if options.benchmark:
+        benchmark(options.benchmark)
+        sys.exit(0)
+
+    if options.batch:
+        o = os.path.join(os.getcwd(),
+                         "iozone-batch-%s" % time.strftime('%Y-%m-%d-%H.%M.%S'))
+        num_files = analyze_batch(options.batch, o, options.processes,
+                                  options.pattern)
+        sys.exit(0 if num_files else 1)
+
     if args:
         filenames = args
     else:
         parser.print_help()
         sys.exit(1)
 
+    if options.compare:
+        if len(args) < 2:
+            parser.print_help()
+            sys.exit(1)
+        try:
+            regressions = compare_run_sets(args, options.alpha, options.store)
+        except ValueError as e:
+            parser.error(str(e))
+        sys.exit(1 if regressions else 0)
+
     if len(args) > 2:
         parser.print_help()
         sys.exit(1)
@@ -451,7 +1067,7 @@ if __name__ == "__main__":
     if not os.path.isdir(o):
         os.makedirs(o)
 
-    a = IOzoneAnalyzer(list_files=filenames, output_dir=o)
+    a = IOzoneAnalyzer(list_files=filenames, output_dir=o, store_dir=options.store)
     a.analyze()
-    p = IOzonePlotter(results_file=filenames[0], output_dir=o)
+    p = IOzonePlotter(results_file=filenames[0], output_dir=o, store_dir=options.store)
     p.plot_all()
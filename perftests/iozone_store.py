@@ -0,0 +1,361 @@
+'''
+Module to store parsed benchmark results in a compact columnar format, so that
+analyses over many runs don't have to re-parse the text reports every time.
+
+Every run is stored as a directory of numpy .npy files, one per column, which are
+memory mapped when loaded. An index.json at the root of the store lists all runs
+with their metadata:
+
+    <STORE-DIR>/index.json
+    <STORE-DIR>/<RUN-ID>/file_size.npy
+    <STORE-DIR>/<RUN-ID>/record_size.npy
+    <STORE-DIR>/<RUN-ID>/write.npy
+    ...
+
+For iozone runs, RUN-ID is the path of the .out file relative to the reports
+directory, without the extension. Example: '1/ioz-s-w-thru-reg-2017-01-12-10-20-30'.
+Its metadata includes the test label, the run number and all values from its .conf file.
+
+Only auto mode results (the 15 column tables produced by iozone -a) are stored
+for iozone runs. Multi process throughput reports don't have them and are skipped.
+Skipped reports are listed with their modification times in <STORE-DIR>/skipped.json,
+so that they're not parsed again till they change.
+
+CSV reports of dd_tests.sh are stored too, one run per dd-<FLAG>-<TIMESTAMP>.csv, with
+columns named like iozone's: file_size and record_size in KB, write and read in KB/s,
+and write_latency and read_latency in microseconds per block. So sets of dd runs can
+be compared with 'iozone_postproc.py --compare --store'.
+
+Requires numpy.
+
+Usage:
+-----
+$ python iozone_store.py ingest <STORE-DIR> <REPORTS-DIRECTORY>
+$ python iozone_store.py list <STORE-DIR>
+'''
+
+from __future__ import print_function
+
+import os
+import re
+import csv
+import json
+import argparse
+import collections
+
+import numpy
+
+from iozone_postproc import _LABELS, parse_results
+
+INDEX_FILENAME = 'index.json'
+
+SKIPPED_FILENAME = 'skipped.json'
+
+# Matches report file names written by run_test in iozone_tests.sh, like
+# 'ioz-s-w-thru-reg-2017-01-12-10-20-30.out'
+IOZONE_REPORT_RE = re.compile('^ioz-(.+)-([0-9]{4}-[0-9]{2}-[0-9]{2}-[0-9]{2}-[0-9]{2}-[0-9]{2})\.out$')
+
+# Matches report file names written by dd_tests.sh, like 'dd-direct-2017-01-12-10-20-30.csv'
+DD_REPORT_RE = re.compile('^dd-(.+)-([0-9]{4}-[0-9]{2}-[0-9]{2}-[0-9]{2}-[0-9]{2}-[0-9]{2})\.csv$')
+
+
+def load_index(store_dir):
+    '''
+    Returns:
+        OrderedDict of run ID -> metadata dict of all runs in the store.
+    '''
+    index_file = os.path.join(store_dir, INDEX_FILENAME)
+    if not os.path.isfile(index_file):
+        return collections.OrderedDict()
+
+    with open(index_file, 'r') as f:
+        return json.load(f, object_pairs_hook=collections.OrderedDict)
+
+
+
+def save_index(store_dir, index, filename=INDEX_FILENAME):
+    # Write to a temporary file and rename it, so that readers never see
+    # a partially written index.
+    index_file = os.path.join(store_dir, filename)
+    temp_file = '%s.%d.tmp' % (index_file, os.getpid())
+    with open(temp_file, 'w') as f:
+        json.dump(index, f, indent = 4)
+    os.rename(temp_file, index_file)
+
+
+
+def load_skipped(store_dir):
+    '''
+    Returns:
+        dict of run ID -> modification time of reports that were skipped since
+        they have no results.
+    '''
+    skipped_file = os.path.join(store_dir, SKIPPED_FILENAME)
+    if not os.path.isfile(skipped_file):
+        return {}
+
+    with open(skipped_file, 'r') as f:
+        return json.load(f)
+
+
+
+def write_run(store_dir, run_id, columns, meta, index=None):
+    '''
+    Stores the columns of a run.
+
+    Args:
+        - store_dir : Store directory. Created if it does not exist.
+        - run_id : Unique ID of the run in this store.
+        - columns : OrderedDict of column name -> list or array of values. All columns
+            should have same length.
+        - meta : dict of metadata about the run.
+        - index : If given, the run is added to this index instead of the one on disk,
+            and the caller is responsible for saving it. Useful when ingesting many runs.
+    '''
+    run_dir = os.path.join(store_dir, run_id)
+    if not os.path.isdir(run_dir):
+        os.makedirs(run_dir)
+
+    num_rows = None
+    for name, values in columns.items():
+        values = numpy.asarray(values)
+        if num_rows is None:
+            num_rows = len(values)
+        assert len(values) == num_rows
+
+        numpy.save(os.path.join(run_dir, name + '.npy'), values)
+
+    meta = collections.OrderedDict(meta)
+    meta['columns'] = list(columns.keys())
+    meta['rows'] = num_rows or 0
+
+    if index is None:
+        the_index = load_index(store_dir)
+        the_index[run_id] = meta
+        save_index(store_dir, the_index)
+    else:
+        index[run_id] = meta
+
+
+
+def load_run(store_dir, run_id, columns=None):
+    '''
+    Loads columns of a run as read-only memory mapped arrays.
+
+    Args:
+        - columns : Names of columns to load. All columns of the run if not specified.
+
+    Returns:
+        OrderedDict of column name -> numpy array
+    '''
+    if columns is None:
+        columns = load_index(store_dir)[run_id]['columns']
+
+    run_dir = os.path.join(store_dir, run_id)
+    arrays = collections.OrderedDict()
+    for name in columns:
+        arrays[name] = numpy.load(os.path.join(run_dir, name + '.npy'), mmap_mode='r')
+    return arrays
+
+
+
+def load_iozone_matrix(store_dir, run_id):
+    '''
+    Loads an iozone run as a 2D array with columns in the same order as
+    iozone's auto mode output, ready for IOzoneAnalyzer.
+
+    Runs of other tests, like dd, have only some of the columns. The columns they
+    don't have are zeros.
+    '''
+    meta = load_index(store_dir)[run_id]
+    arrays = load_run(store_dir, run_id, [c for c in _LABELS if c in meta['columns']])
+    return numpy.column_stack([arrays[c] if c in arrays else numpy.zeros(meta['rows'], dtype=numpy.int64)
+        for c in _LABELS])
+
+
+
+def ingest_iozone_report(store_dir, reports_dir, report_file, index=None):
+    '''
+    Parses an iozone .out report and its .conf file and stores them.
+
+    Returns:
+        The run ID, or None if the report has no auto mode results.
+    '''
+    with open(report_file, 'r') as f:
+        results = parse_results(f)
+
+    if not results:
+        return None
+
+    matrix = numpy.array(results, dtype=numpy.int64)
+    columns = collections.OrderedDict()
+    for i, label in enumerate(_LABELS):
+        columns[label] = matrix[:, i]
+
+    run_id = os.path.splitext(os.path.relpath(report_file, reports_dir))[0]
+
+    meta = collections.OrderedDict()
+    meta['type'] = 'iozone'
+    meta['source'] = os.path.abspath(report_file)
+    meta['mtime'] = os.path.getmtime(report_file)
+
+    m = IOZONE_REPORT_RE.match(os.path.basename(report_file))
+    if m:
+        meta['label'] = m.group(1)
+
+    # Reports of each run are saved under a directory named by run number.
+    run_num = os.path.basename(os.path.dirname(os.path.abspath(report_file)))
+    if run_num.isdigit():
+        meta['run'] = int(run_num)
+
+    meta.update(read_conf(os.path.splitext(report_file)[0] + '.conf'))
+
+    write_run(store_dir, run_id, columns, meta, index)
+    return run_id
+
+
+
+def ingest_dd_report(store_dir, reports_dir, report_file, index=None):
+    '''
+    Parses a dd_tests.sh CSV report and its .conf file and stores them, with a row
+    per (file size, block size) that has both write and read results.
+
+    Returns:
+        The run ID, or None if the report has no results.
+    '''
+    rows = collections.OrderedDict()
+    with open(report_file, 'r') as f:
+        for record in csv.DictReader(f):
+            block_size = int(record['block_size'])
+            key = (block_size * int(record['count']), block_size)
+            row = rows.setdefault(key, {})
+            row[record['test']] = float(record['kb_per_sec'])
+            row[record['test'] + '_latency'] = float(record['usec_per_block'])
+
+    # A test that failed or was interrupted has only one of write and read.
+    rows = collections.OrderedDict((key, row) for key, row in rows.items() if 'write' in row and 'read' in row)
+    if not rows:
+        return None
+
+    columns = collections.OrderedDict()
+    columns['file_size'] = numpy.array([key[0] for key in rows], dtype=numpy.int64)
+    columns['record_size'] = numpy.array([key[1] for key in rows], dtype=numpy.int64)
+    for name in ('write', 'read'):
+        columns[name] = numpy.array([row[name] for row in rows.values()], dtype=numpy.int64)
+    for name in ('write_latency', 'read_latency'):
+        columns[name] = numpy.array([row[name] for row in rows.values()])
+
+    run_id = os.path.splitext(os.path.relpath(report_file, reports_dir))[0]
+
+    meta = collections.OrderedDict()
+    meta['type'] = 'dd'
+    meta['source'] = os.path.abspath(report_file)
+    meta['mtime'] = os.path.getmtime(report_file)
+
+    m = DD_REPORT_RE.match(os.path.basename(report_file))
+    if m:
+        meta['label'] = m.group(1)
+
+    run_num = os.path.basename(os.path.dirname(os.path.abspath(report_file)))
+    if run_num.isdigit():
+        meta['run'] = int(run_num)
+
+    meta.update(read_conf(os.path.splitext(report_file)[0] + '.conf'))
+
+    write_run(store_dir, run_id, columns, meta, index)
+    return run_id
+
+
+
+def read_conf(conf_file):
+    '''
+    Reads a key=value file like the .conf file written for every iozone test.
+
+    Returns:
+        OrderedDict of keys and values. Empty if the file does not exist.
+    '''
+    conf = collections.OrderedDict()
+    if not os.path.isfile(conf_file):
+        return conf
+
+    with open(conf_file, 'r') as f:
+        for line in f:
+            key, sep, value = line.strip().partition('=')
+            if sep:
+                conf[key] = value
+    return conf
+
+
+
+def ingest_tree(store_dir, reports_dir):
+    '''
+    Stores all iozone and dd reports under reports_dir that are not already in
+    the store, or have changed since they were stored.
+
+    Returns:
+        list of IDs of runs that were stored.
+    '''
+    if not os.path.isdir(store_dir):
+        os.makedirs(store_dir)
+
+    index = load_index(store_dir)
+    skipped = load_skipped(store_dir)
+
+    ingested = []
+    for dirpath, dirnames, filenames in os.walk(reports_dir):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            if IOZONE_REPORT_RE.match(filename):
+                ingest = ingest_iozone_report
+            elif DD_REPORT_RE.match(filename):
+                ingest = ingest_dd_report
+            else:
+                continue
+
+            report_file = os.path.join(dirpath, filename)
+            run_id = os.path.splitext(os.path.relpath(report_file, reports_dir))[0]
+            mtime = os.path.getmtime(report_file)
+            if run_id in index and index[run_id].get('mtime') == mtime:
+                continue
+            if skipped.get(run_id) == mtime:
+                continue
+
+            if ingest(store_dir, reports_dir, report_file, index):
+                print('Stored %s' % (run_id))
+                ingested.append(run_id)
+                skipped.pop(run_id, None)
+            else:
+                print('Skipped %s: no results' % (run_id))
+                skipped[run_id] = mtime
+
+    save_index(store_dir, index)
+    save_index(store_dir, skipped, SKIPPED_FILENAME)
+    return ingested
+
+
+
+def parse_options():
+    parser = argparse.ArgumentParser(description='Store benchmark results in a columnar format')
+    subparsers = parser.add_subparsers(dest='command')
+
+    ingest_parser = subparsers.add_parser('ingest', help='Store all new iozone and dd reports in a reports directory')
+    ingest_parser.add_argument('store_dir', metavar='STORE-DIR')
+    ingest_parser.add_argument('reports_dir', metavar='REPORTS-DIRECTORY')
+
+    list_parser = subparsers.add_parser('list', help='List all runs in the store')
+    list_parser.add_argument('store_dir', metavar='STORE-DIR')
+
+    return parser.parse_args()
+
+
+
+if __name__ == '__main__':
+    opts = parse_options()
+
+    if opts.command == 'ingest':
+        ingest_tree(opts.store_dir, opts.reports_dir)
+
+    elif opts.command == 'list':
+        for run_id, meta in load_index(opts.store_dir).items():
+            print('%-60s %-8s %6d rows  %s' % (run_id, meta.get('type', ''), meta['rows'],
+                meta.get('start', '')))
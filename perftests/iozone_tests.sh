@@ -54,6 +54,8 @@ print_usage() {
     echo '      MULTI runs multi process tests on local machine.'
     echo '      DIST runs MULTI tests on multiple machines, including optionally on local machine,'
     echo '           and downloads their reports.'
+    echo '           dist_orchestrator.py does the same, but launches all machines concurrently and'
+    echo '           downloads reports of each machine as soon as it completes.'
     echo
     echo 'OPTIONAL FLAGS:'
     echo '  numruns=NUMBER-OF-RUNS -> Repeat specified type of tests # times'
@@ -83,6 +85,22 @@ print_usage() {
     echo '  checkperiod=SECONDS -> In DIST mode, time to wait between checking if tests have completed on all machines.'
     echo '      Set to small value for short tests and large value for long tests.'
     echo
+    echo '  sample -> Record I/O throughput every second during each test, with io_sampler.py. Written to'
+    echo '      a .samples.csv file next to the test report. io_sampler.py should be in same directory as this script.'
+    echo '  sampleinterval=SECONDS -> Interval between samples when sampling. Default: 1'
+    echo
+    echo '  cacheservers=[user1@]IP1,[user2@]IP2,... -> Drop caches on these Gluster servers over SSH before'
+    echo '      tests that read, with cache_control.py. It should be in same directory as this script.'
+    echo '  remount=MOUNT-POINT -> Unmount and mount the Gluster volume again before tests that read, to empty'
+    echo '      the caches of its FUSE client, with cache_control.py.'
+    echo '  mountsource=SERVER:/VOLUME -> Volume to mount at remount MOUNT-POINT. Default: mounted by its /etc/fstab entry'
+    echo '  verifycache -> Verify that caches are cold after dropping them, by timing reads of a probe file.'
+    echo '      With any of these cache flags, caches are reset before every test, before the start barrier.'
+    echo '      In DIST mode, only the first machine drops caches of cacheservers.'
+    echo
+    echo '  labels=LABEL1,LABEL2,... -> Run only tests with these labels, like m-thru-reg,m-ops-dir.'
+    echo '      Labels are the names of report files without ioz- prefix and timestamp. Default: all tests'
+    echo
     echo '  nolocal -> Do not run tests on local machine.'
     echo
     echo '  noconfirm -> Do not ask for user confirmation to start the tests.'
@@ -248,6 +266,17 @@ parse_args() {
                 startat=$argval
                 ;;
                 
+            barrier )
+                # Internal flag sent to workers by dist_orchestrator.py. HOST:PORT of a start 
+                # barrier that all workers wait at before every test, so that they start together.
+                barrier=$argval
+                ;;
+                
+            barriertimeout )
+                # Seconds to wait at the start barrier for other workers before starting anyway.
+                barrier_timeout=$argval
+                ;;
+                
             machineindex )
                 # Internal flag sent to remote workers in distributed mode.
                 # This value is included in tmp file paths so that each process on each machine
@@ -255,6 +284,37 @@ parse_args() {
                 machineindex=$argval
                 ;;
                 
+            sample )
+                sample=true
+                ;;
+                
+            sampleinterval )
+                sample_interval=$argval
+                ;;
+                
+            labels )
+                labels=($(echo "$argval"|tr ',' ' '))
+                ;;
+                
+            cacheservers )
+                cache_servers="$argval"
+                cache_control=true
+                ;;
+                
+            remount )
+                remount_path="$argval"
+                cache_control=true
+                ;;
+                
+            mountsource )
+                mount_source="$argval"
+                ;;
+                
+            verifycache )
+                verify_cache=true
+                cache_control=true
+                ;;
+                
             nolocal )
                 nolocal=true
                 ;;
@@ -321,6 +381,14 @@ parse_args() {
     if [ -z $checkperiod ]; then
         checkperiod=60
     fi
+    
+    if [ -z $barrier_timeout ]; then
+        barrier_timeout=3600
+    fi
+    
+    if [ -z $sample_interval ]; then
+        sample_interval=1
+    fi
 }
 
 
@@ -900,6 +968,13 @@ distributed_tests() {
         
             echo "Copying script to $machine"
             scp $fast_ssh_options "${BASH_SOURCE[0]}"  "$machine:."
+            if [ ! -z "$sample" ]; then
+                scp $fast_ssh_options "$(dirname "${BASH_SOURCE[0]}")/io_sampler.py"  "$machine:."
+            fi
+            if [ ! -z "$cache_control" ]; then
+                scp $fast_ssh_options "$(dirname "${BASH_SOURCE[0]}")/cache_control.py" \
+                    "$(dirname "${BASH_SOURCE[0]}")/fio_tests.py"  "$machine:."
+            fi
         done
     fi
     
@@ -911,8 +986,19 @@ distributed_tests() {
     # "iozone<PROCESS#>.tmp", but require an additional field - perhaps the machine index
     # so it becomes "iozone<MACHINE#>-<PROCESS#>.tmp"
     
+    # Only the first machine drops caches of cacheservers, so that every test starts after
+    # a single drop, instead of one per machine.
+    local follower_parameters=
+    local arg
+    for arg in $parameters; do
+        if [[ "$arg" != cacheservers=* ]]; then
+            follower_parameters="$follower_parameters $arg"
+        fi
+    done
+    
     local local_cmdline="./iozone_tests.sh $target_path $reports_dir MULTI noconfirm $parameters"
     local remote_cmdline="./iozone_tests.sh $target_path $remote_reports_dir MULTI noconfirm $parameters"
+    local follower_cmdline="./iozone_tests.sh $target_path $remote_reports_dir MULTI noconfirm $follower_parameters"
 
 
     # If we assume connecting and launching process takes 8 secs per remote machine,
@@ -922,6 +1008,7 @@ distributed_tests() {
         local startat=$(( $current_epoch + 8 * $num_remote ))
         local_cmdline="$local_cmdline startat=$startat"
         remote_cmdline="$remote_cmdline startat=$startat"
+        follower_cmdline="$follower_cmdline startat=$startat"
     fi
     
     if is_terminated; then
@@ -963,7 +1050,11 @@ distributed_tests() {
             # On each machine
             # Give each machine a unique index so that tmp file names of processes 
             # running on different machines don't collide.
-            temp_cmdline="$remote_cmdline machineindex=$machine_index"
+            if [ -z "$nolocal" -o $machine_index -gt 1 ]; then
+                temp_cmdline="$follower_cmdline machineindex=$machine_index"
+            else
+                temp_cmdline="$remote_cmdline machineindex=$machine_index"
+            fi
             
             # Start iotests.sh in multi mode with same process count, file sizes and block size parameters,
             # and store PID. 
@@ -1107,19 +1198,43 @@ run_test() {
         return
     fi 
     
+    if ! is_selected "$1"; then
+        return
+    fi
+    
+    # Caches are reset before the start barrier, so that the reset is not part of the test's
+    # time or report. With a barrier, all workers first wait for each other to complete the
+    # previous test, so that server caches are not dropped under a running test.
+    if [ ! -z "$cache_control" ]; then
+        wait_at_barrier "$1-cache"
+        reset_caches
+    fi
+    
+    wait_at_barrier "$1"
     
     echo "Start: $2"
     local start_ts=$(date +%Y-%m-%d-%H-%M-%S)
     local report_file="$reports_dir/$current_run/ioz-$1-$start_ts.out"
     local test_info_file="$reports_dir/$current_run/ioz-$1-$start_ts.conf"
+    local samples_file="$reports_dir/$current_run/ioz-$1-$start_ts.samples.csv"
+    
+    start_sampler "$samples_file"
     
     # Run the test by calling specified function
     $3 "$4" | tee "$report_file"
     
+    stop_sampler
+    
     local end_ts=$(date +%Y-%m-%d-%H-%M-%S)
     echo "path=$target_path" > "$test_info_file"
     echo "start=$start_ts" >> "$test_info_file"
     echo "end=$end_ts" >> "$test_info_file"
+    if [ ! -z "$barrier" ]; then
+        echo "start_skew=$start_skew" >> "$test_info_file"
+    fi
+    if [ ! -z "$sampler_pid" ]; then
+        echo "samples=$(basename "$samples_file")" >> "$test_info_file"
+    fi
     
     echo "End: $2"
     echo
@@ -1192,11 +1307,135 @@ run_iozone_multi() {
     fi
 }
 
+# Checks if a test is selected by the labels flag. All tests are selected if it's not given.
+# $1: label for test
+is_selected() {
+    if [ -z "$labels" ]; then
+        return 0
+    fi
+    
+    local label
+    for label in "${labels[@]}"; do
+        if [ "$label" == "$1" ]; then
+            return 0
+        fi
+    done
+    return 1
+}
+
+
 drop_cache() {
+    # With cache_control.py, run_test has already reset caches.
+    if [ ! -z "$cache_control" ]; then
+        return
+    fi
     echo 3 > /proc/sys/vm/drop_caches
 }
 
 
+# Resets caches with cache_control.py, which also drops caches of Gluster servers and the FUSE
+# client, for cacheservers, remount or verifycache flags.
+reset_caches() {
+    local cache_control_script="$(dirname "${BASH_SOURCE[0]}")/cache_control.py"
+    if [ ! -f "$cache_control_script" ]; then
+        echo "Not resetting caches: $cache_control_script not found"
+        return
+    fi
+    
+    local options=
+    if [ ! -z "$cache_servers" ]; then
+        options="$options --servers $cache_servers"
+    fi
+    if [ ! -z "$remount_path" ]; then
+        options="$options --remount $remount_path"
+    fi
+    if [ ! -z "$mount_source" ]; then
+        options="$options --mount-source $mount_source"
+    fi
+    if [ -z "$verify_cache" ]; then
+        options="$options --noverify"
+    fi
+    
+    if [ ! -z "$dryrun" ]; then
+        echo "Dry run: Resetting caches with options:$options"
+        return
+    fi
+    
+    # WARN: Don't put $options in double quotes, so that it's sent as separate arguments.
+    python "$cache_control_script" "$target_path" $options
+    case $? in
+        1 ) echo "WARNING: Could not reset all caches" ;;
+        2 ) echo "WARNING: Caches are still warm. Read results may be from memory" ;;
+    esac
+}
+
+
+# Starts io_sampler.py in background if sampling is enabled. It samples iozone
+# processes started by this script, so it's given this script's PID.
+# $1: samples CSV file
+start_sampler() {
+    sampler_pid=
+    if [ -z "$sample" ]; then
+        return
+    fi
+    
+    local sampler="$(dirname "${BASH_SOURCE[0]}")/io_sampler.py"
+    if [ ! -f "$sampler" ]; then
+        echo "Not sampling: $sampler not found"
+        return
+    fi
+    
+    python "$sampler" --pid $$ --output "$1" --target "$target_path" --interval $sample_interval &
+    sampler_pid=$!
+}
+
+
+stop_sampler() {
+    if [ ! -z "$sampler_pid" ]; then
+        # The sampler records a last sample and exits on SIGTERM.
+        kill -TERM $sampler_pid 2> /dev/null
+        wait $sampler_pid
+    fi
+}
+
+
+# Waits at the start barrier, if there is one, till all workers are ready to start
+# the same test. Sets start_skew to seconds between the barrier's release and this worker 
+# being released. It includes clock difference between this machine and the barrier host.
+# $1: label for test
+wait_at_barrier() {
+    start_skew=
+    if [ -z "$barrier" ]; then
+        return
+    fi
+    
+    local host=${barrier%:*}
+    local port=${barrier##*:}
+    local reply
+    
+    # Bash opens a TCP connection when redirecting to /dev/tcp/HOST/PORT.
+    if exec 3<>"/dev/tcp/$host/$port"; then
+        echo "READY $machineindex $1" >&3
+        read -r -t $barrier_timeout reply <&3
+        exec 3<&- 3>&-
+    fi
+    
+    local now=$(date +%s.%N)
+    
+    case "$reply" in
+      GO\ * )
+        start_skew=$(awk "BEGIN{printf \"%.6f\", $now - ${reply#GO }}")
+        echo "Released by start barrier. Start skew: $start_skew secs"
+        ;;
+        
+      * )
+        echo "Start barrier not reached by all workers. Starting anyway."
+        start_skew=unknown
+        ;;
+    esac
+}
+
+
 sleep_till_startat_time() {
     if [ ! -z "$startat" ]; then
 
@@ -0,0 +1,324 @@
+'''
+Module to benchmark small file and metadata operations, which are Gluster's weak spot
+compared to large file streaming that iozone_tests.sh and dd_tests.sh measure. On a
+distributed volume, every create, stat, readdir and unlink is a network round trip
+to one or more bricks.
+
+Every worker process builds its own directory tree in TARGET-PATH:
+    smallfile-<MACHINE-INDEX>-<WORKER>/d00/d00/.../f00000
+The tree is 'depth' levels of 'fanout' subdirectories each, and every leaf directory
+has 'files' files of 'filesize' bytes.
+
+The benchmark runs these operations as phases, in order. All workers start a phase
+together and the next phase starts after all of them complete it:
+    mkdir   : Create all directories of the tree.
+    create  : Create and write every file.
+    stat    : stat every file.
+    readdir : List every directory.
+    read    : Read every file.
+    unlink  : Delete every file.
+    rmdir   : Delete all directories.
+
+For each phase, it reports operations per second over all workers, and a histogram
+of per operation latency in power of 2 microsecond buckets, with percentiles.
+
+Since it only uses file system calls, it runs the same way on a Gluster mount and
+on a local directory.
+
+Usage:
+-----
+$ python smallfile_tests.py <TARGET-PATH> [--workers 4] [--depth 2] [--fanout 10] [--files 100]
+        [--filesize 4096] [--phases mkdir,create,stat] [--output REPORT.json]
+'''
+
+from __future__ import print_function
+
+import os
+import json
+import errno
+import timeit
+import argparse
+import itertools
+import collections
+import multiprocessing
+
+PHASES = ['mkdir', 'create', 'stat', 'readdir', 'read', 'unlink', 'rmdir']
+
+# Latencies are counted in buckets of [2^i, 2^(i+1)) microseconds. The last bucket
+# has all latencies of 2^(NUM_BUCKETS-1) microseconds (~17 minutes) and more.
+NUM_BUCKETS = 31
+
+PERCENTILES = [50, 95, 99, 99.9]
+
+# Like time.time on python 2 and time.perf_counter on python 3.
+timer = timeit.default_timer
+
+# Settings of a benchmark, sent to every worker process.
+Config = collections.namedtuple('Config', ['target_path', 'machine_index', 'depth', 'fanout',
+    'files', 'filesize', 'fsync'])
+
+
+
+def bucket_of(latency):
+    '''
+    Returns:
+        Histogram bucket of a latency in seconds.
+    '''
+    micros = int(latency * 1000000)
+    if micros < 1:
+        return 0
+    return min(micros.bit_length() - 1, NUM_BUCKETS - 1)
+
+
+
+def histogram_percentile(histogram, percentile):
+    '''
+    Returns:
+        Upper bound in microseconds of the bucket that has the percentile, or 0
+        if the histogram is empty.
+    '''
+    total = sum(histogram)
+    if total == 0:
+        return 0
+
+    rank = total * percentile / 100.0
+    count = 0
+    for i, n in enumerate(histogram):
+        count += n
+        if count >= rank:
+            return 2 ** (i + 1)
+    return 2 ** NUM_BUCKETS
+
+
+
+def worker_root(config, worker):
+    return os.path.join(config.target_path, 'smallfile-%s-%d' % (config.machine_index, worker))
+
+
+
+def tree_dirs(root, config):
+    '''
+    Returns:
+        list of all directories of a tree, parents before their children.
+    '''
+    dirs = [root]
+    for level in range(1, config.depth + 1):
+        for path in itertools.product(range(config.fanout), repeat=level):
+            dirs.append(os.path.join(root, *['d%02d' % (i) for i in path]))
+    return dirs
+
+
+
+def tree_files(root, config):
+    '''
+    Returns:
+        list of all files of a tree.
+    '''
+    if config.depth == 0:
+        leaf_dirs = [root]
+    else:
+        leaf_dirs = [os.path.join(root, *['d%02d' % (i) for i in path])
+            for path in itertools.product(range(config.fanout), repeat=config.depth)]
+    return [os.path.join(d, 'f%05d' % (i)) for d in leaf_dirs for i in range(config.files)]
+
+
+
+def _create(path, data, fsync):
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        if data:
+            os.write(fd, data)
+        if fsync:
+            os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+
+def _read(path):
+    with open(path, 'rb') as f:
+        while f.read(65536):
+            pass
+
+
+
+def run_phase(args):
+    '''
+    Runs a phase on the tree of one worker. Runs in a worker process.
+
+    Args:
+        - args : Tuple of (phase, worker index, Config)
+
+    Returns:
+        dict with 'ops', 'errors', 'elapsed' seconds, 'latency' total seconds and
+        'histogram' list of counts.
+    '''
+    phase, worker, config = args
+    root = worker_root(config, worker)
+
+    data = b'x' * config.filesize
+    if phase == 'mkdir':
+        targets = tree_dirs(root, config)
+        op = os.mkdir
+    elif phase == 'create':
+        targets = tree_files(root, config)
+        op = lambda path: _create(path, data, config.fsync)
+    elif phase == 'stat':
+        targets = tree_files(root, config)
+        op = os.stat
+    elif phase == 'readdir':
+        targets = tree_dirs(root, config)
+        op = os.listdir
+    elif phase == 'read':
+        targets = tree_files(root, config)
+        op = _read
+    elif phase == 'unlink':
+        targets = tree_files(root, config)
+        op = os.unlink
+    elif phase == 'rmdir':
+        # Children have to be deleted before their parents.
+        targets = list(reversed(tree_dirs(root, config)))
+        op = os.rmdir
+    else:
+        raise ValueError('Unknown phase: %s' % (phase))
+
+    histogram = [0] * NUM_BUCKETS
+    errors = 0
+    latency = 0.0
+
+    start = timer()
+    for path in targets:
+        op_start = timer()
+        try:
+            op(path)
+        except (OSError, IOError) as e:
+            # A leftover tree of an interrupted run already has its directories.
+            if not (phase == 'mkdir' and e.errno == errno.EEXIST):
+                errors += 1
+                continue
+        op_latency = timer() - op_start
+        latency += op_latency
+        histogram[bucket_of(op_latency)] += 1
+    elapsed = timer() - start
+
+    return {'ops' : sum(histogram), 'errors' : errors, 'elapsed' : elapsed,
+        'latency' : latency, 'histogram' : histogram}
+
+
+
+def merge_results(phase, wall_time, worker_results):
+    '''
+    Returns:
+        OrderedDict of results of a phase over all workers.
+    '''
+    histogram = [sum(h) for h in zip(*[r['histogram'] for r in worker_results])]
+    ops = sum(r['ops'] for r in worker_results)
+    latency = sum(r['latency'] for r in worker_results)
+
+    result = collections.OrderedDict()
+    result['phase'] = phase
+    result['ops'] = ops
+    result['errors'] = sum(r['errors'] for r in worker_results)
+    result['elapsed'] = wall_time
+    result['ops_per_sec'] = ops / wall_time if wall_time > 0 else 0.0
+    result['mean_us'] = 1000000.0 * latency / ops if ops else 0.0
+    for p in PERCENTILES:
+        result['p%g_us' % (p)] = histogram_percentile(histogram, p)
+    result['histogram'] = histogram
+    return result
+
+
+
+def run_benchmark(config, workers, phases=PHASES):
+    '''
+    Runs phases in order, each with all workers in parallel.
+
+    Returns:
+        list of results of each phase, as returned by merge_results.
+    '''
+    pool = multiprocessing.Pool(workers)
+    results = []
+    try:
+        for phase in phases:
+            start = timer()
+            worker_results = pool.map(run_phase, [(phase, w, config) for w in range(workers)], chunksize=1)
+            results.append(merge_results(phase, timer() - start, worker_results))
+            print_result(results[-1])
+    finally:
+        pool.close()
+        pool.join()
+    return results
+
+
+
+def print_header():
+    print('%-8s %10s %7s %9s %10s %9s' % ('phase', 'ops', 'errors', 'secs', 'ops/sec', 'mean us') +
+        ''.join(' %9s' % ('p%g us' % (p)) for p in PERCENTILES))
+
+
+
+def print_result(result):
+    print('%-8s %10d %7d %9.2f %10.1f %9.1f' % (result['phase'], result['ops'], result['errors'],
+        result['elapsed'], result['ops_per_sec'], result['mean_us']) +
+        ''.join(' %9d' % (result['p%g_us' % (p)]) for p in PERCENTILES))
+
+
+
+def print_histogram(result):
+    '''
+    Prints non-empty latency buckets of a phase.
+    '''
+    print('\n%s latency histogram:' % (result['phase']))
+    total = float(sum(result['histogram'])) or 1.0
+    for i, n in enumerate(result['histogram']):
+        if n:
+            print('  %9d - %9d us : %9d (%5.1f%%)' % (2 ** i, 2 ** (i + 1), n, 100 * n / total))
+
+
+
+def parse_options():
+    parser = argparse.ArgumentParser(description='Benchmark small file and metadata operations')
+    parser.add_argument('target_path', metavar='TARGET-PATH',
+        help='Directory on the mount under test where trees are created')
+    parser.add_argument('--workers', type=int, default=4, help='Number of worker processes. Default: 4')
+    parser.add_argument('--depth', type=int, default=2, help='Levels of subdirectories in a tree. Default: 2')
+    parser.add_argument('--fanout', type=int, default=10,
+        help='Subdirectories in each directory of a tree. Default: 10')
+    parser.add_argument('--files', type=int, default=100, help='Files in each leaf directory. Default: 100')
+    parser.add_argument('--filesize', type=int, default=4096, help='Size of each file in bytes. Default: 4096')
+    parser.add_argument('--fsync', action='store_true', help='fsync every file after writing it')
+    parser.add_argument('--phases', default=','.join(PHASES),
+        help='Comma separated phases to run, in order. Default: %s' % (','.join(PHASES)))
+    parser.add_argument('--machine-index', default='',
+        help='Included in tree names, so that multiple machines testing a shared mount use separate trees')
+    parser.add_argument('--histogram', action='store_true', help='Print latency histogram of every phase')
+    parser.add_argument('--output', help='Save results with histograms to this JSON file')
+
+    opts = parser.parse_args()
+    for phase in opts.phases.split(','):
+        if phase not in PHASES:
+            parser.error('Invalid phase: %s' % (phase))
+    return opts
+
+
+
+if __name__ == '__main__':
+    opts = parse_options()
+
+    config = Config(os.path.abspath(opts.target_path), opts.machine_index, opts.depth, opts.fanout,
+        opts.files, opts.filesize, opts.fsync)
+
+    files_per_worker = len(tree_files('', config))
+    print('%d workers, %d files of %d bytes and %d directories per worker' % (opts.workers,
+        files_per_worker, opts.filesize, len(tree_dirs('', config))))
+
+    print_header()
+    results = run_benchmark(config, opts.workers, opts.phases.split(','))
+
+    if opts.histogram:
+        for result in results:
+            print_histogram(result)
+
+    if opts.output:
+        with open(opts.output, 'w') as f:
+            json.dump({'config' : dict(config._asdict(), workers=opts.workers), 'results' : results}, f, indent=4)
@@ -0,0 +1,302 @@
+'''
+Small store for JSON state documents like cluster details, which are updated by
+multiple provisioning workers, possibly in multiple processes.
+
+A document at <path> is stored as:
+    <path>          : Snapshot of the document. Committed by writing to a temporary
+                      file and renaming it, so it's never seen partially written.
+    <path>.journal  : Append-only journal of changes made since the snapshot, one JSON
+                      record per line. Workers record a change, like a node being added,
+                      by appending a line instead of rewriting the whole document.
+    <path>.lock     : Lock file. All reads and writes are done holding an exclusive
+                      flock on it, and a thread lock for threads of the same process.
+
+Loading a document reads the snapshot and replays the journal on it. The journal is
+folded into the snapshot on every commit, and when it grows beyond 'compact_after' records.
+
+Every journal record has a sequence number 'seq', one more than the record before it.
+The snapshot saves the sequence number of the last record folded into it, under the
+'_journal_seq' key of the document, and records up to it are skipped when replaying the
+journal. So if a commit is interrupted after renaming the snapshot but before clearing
+the journal, records already in the snapshot are not applied again. Documents must be dicts,
+and the key is removed from documents returned by load().
+
+Journal records are dicts with these operations:
+    {'op' : 'set', 'path' : [k1, k2, ...], 'value' : v}
+        Sets doc[k1][k2]... to v. Missing dicts along the path are created.
+    {'op' : 'append', 'path' : [k1, ...], 'value' : v}
+        Appends v to the list at path. The list is created if missing.
+    {'op' : 'update', 'path' : [k1, ...], 'match' : {...}, 'value' : {...}}
+        Updates every dict in the list at path whose items include all items of
+        'match', with items of 'value'.
+
+Linux only, since it uses fcntl.
+'''
+
+import os
+import json
+import fcntl
+import threading
+import contextlib
+import collections
+
+
+DEFAULT_COMPACT_AFTER = 100
+
+# Key of the snapshot under which the sequence number of its last journal record is saved.
+SEQ_KEY = '_journal_seq'
+
+
+
+class FileLock(object):
+    '''
+    An exclusive lock on a file, held with flock. Reentrant for the thread holding it.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.thread_lock = threading.RLock()
+        self.depth = 0
+        self.fd = None
+
+
+    def acquire(self, blocking = True):
+        '''
+        Returns:
+            True if the lock was acquired. False if not blocking and it's held by
+            another thread or process.
+        '''
+        if not self.thread_lock.acquire(blocking):
+            return False
+
+        if self.depth == 0:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                os.close(fd)
+                self.thread_lock.release()
+                return False
+            self.fd = fd
+
+        self.depth += 1
+        return True
+
+
+    def release(self):
+        self.depth -= 1
+        if self.depth == 0:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+            os.close(self.fd)
+            self.fd = None
+        self.thread_lock.release()
+
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.release()
+        return False
+
+
+
+class StateStore(object):
+
+    def __init__(self, path, compact_after = DEFAULT_COMPACT_AFTER, json_default = None):
+        '''
+        Args:
+            - path : Path of the document. Its directory is created if it does not exist.
+            - compact_after : Number of journal records after which they're folded
+                into the snapshot.
+            - json_default : Function that returns a serializable version of objects
+                that are not JSON serializable, passed to json.dump.
+        '''
+        self.path = path
+        self.journal_path = path + '.journal'
+        self.compact_after = compact_after
+        self.json_default = json_default
+
+        dir_name = os.path.dirname(os.path.abspath(path))
+        if not os.path.isdir(dir_name):
+            os.makedirs(dir_name)
+
+        self.file_lock = FileLock(path + '.lock')
+
+
+    def lock(self):
+        '''
+        Returns:
+            Context manager holding the store's lock, to make a read-modify-write
+            sequence atomic.
+        '''
+        return self.file_lock
+
+
+    def exists(self):
+        return os.path.isfile(self.path) or os.path.isfile(self.journal_path)
+
+
+    def load(self, default = None):
+        '''
+        Returns:
+            The document with all journaled changes applied, or default if
+            the document does not exist.
+        '''
+        with self.file_lock:
+            if not self.exists():
+                return default
+
+            doc = self._read_snapshot()
+            seq = doc.pop(SEQ_KEY, 0)
+            for record in self._read_journal():
+                # Records without a sequence number were written before there were any.
+                if record.get('seq', seq + 1) <= seq:
+                    continue
+                apply_record(doc, record)
+            return doc
+
+
+    def commit(self, doc):
+        '''
+        Atomically replaces the document, and clears the journal.
+        '''
+        with self.file_lock:
+            snapshot = collections.OrderedDict(doc)
+            snapshot[SEQ_KEY] = self._last_seq()
+
+            temp_file = '%s.%d.tmp' % (self.path, os.getpid())
+            with open(temp_file, 'w') as f:
+                json.dump(snapshot, f, indent = 4, default = self.json_default)
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(temp_file, self.path)
+
+            # If we crash here, the journal is replayed on the new snapshot, but all its
+            # records are skipped, since their sequence numbers are in the snapshot.
+            if os.path.isfile(self.journal_path):
+                os.remove(self.journal_path)
+
+
+    @contextlib.contextmanager
+    def transaction(self, default = None):
+        '''
+        Context manager that loads the document holding the lock, yields it for
+        changes, and commits it at the end of the block, unless there's an exception.
+        '''
+        with self.file_lock:
+            doc = self.load(default)
+            yield doc
+            self.commit(doc)
+
+
+    def set(self, path, value):
+        self._append_record({'op' : 'set', 'path' : list(path), 'value' : value})
+
+
+    def append(self, path, value):
+        self._append_record({'op' : 'append', 'path' : list(path), 'value' : value})
+
+
+    def update(self, path, match, value):
+        self._append_record({'op' : 'update', 'path' : list(path), 'match' : match, 'value' : value})
+
+
+    def _append_record(self, record):
+        with self.file_lock:
+            record['seq'] = self._last_seq() + 1
+
+            # Start on a new line if the last record was cut short by a crash.
+            prefix = ''
+            if os.path.isfile(self.journal_path) and os.path.getsize(self.journal_path) > 0:
+                with open(self.journal_path, 'rb') as f:
+                    f.seek(-1, os.SEEK_END)
+                    if f.read(1) != b'\n':
+                        prefix = '\n'
+
+            with open(self.journal_path, 'a') as f:
+                f.write(prefix + json.dumps(record, default = self.json_default) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+
+            if self._journal_length() >= self.compact_after:
+                self.commit(self.load())
+
+
+    def _read_snapshot(self):
+        if not os.path.isfile(self.path):
+            return collections.OrderedDict()
+        with open(self.path, 'r') as f:
+            return json.load(f, object_pairs_hook = collections.OrderedDict)
+
+
+    def _read_journal(self):
+        records = []
+        if not os.path.isfile(self.journal_path):
+            return records
+
+        with open(self.journal_path, 'r') as f:
+            for line in f:
+                # A record cut short by a crash while appending is ignored.
+                try:
+                    records.append(json.loads(line, object_pairs_hook = collections.OrderedDict))
+                except ValueError:
+                    continue
+        return records
+
+
+    def _last_seq(self):
+        '''
+        Returns:
+            Sequence number of the last journal record, or of the snapshot if the
+            journal is empty.
+        '''
+        seqs = [r['seq'] for r in self._read_journal() if 'seq' in r]
+        if seqs:
+            return seqs[-1]
+        return self._read_snapshot().get(SEQ_KEY, 0)
+
+
+    def _journal_length(self):
+        with open(self.journal_path, 'r') as f:
+            return sum(1 for line in f)
+
+
+
+def apply_record(doc, record):
+    '''
+    Applies a journal record to doc in place.
+    '''
+    op = record['op']
+    path = record['path']
+
+    if op == 'set':
+        parent = _walk(doc, path[:-1])
+        parent[path[-1]] = record['value']
+
+    elif op == 'append':
+        _walk(doc, path, []).append(record['value'])
+
+    elif op == 'update':
+        for item in _walk(doc, path, []):
+            if all(item.get(k) == v for k, v in record['match'].items()):
+                item.update(record['value'])
+
+    else:
+        raise ValueError('Unknown journal operation: %s' % (op))
+
+
+
+def _walk(doc, path, leaf_default = None):
+    node = doc
+    for i, key in enumerate(path):
+        if isinstance(node, list):
+            node = node[key]
+        else:
+            if key not in node:
+                is_leaf = i == len(path) - 1
+                node[key] = leaf_default if (is_leaf and leaf_default is not None) else collections.OrderedDict()
+            node = node[key]
+    return node
@@ -0,0 +1,240 @@
+'''
+Lightweight tracing of how long each phase of a build takes, like creating nodes,
+waiting for SSH, and running playbooks.
+
+A phase is traced as a span, either with a context manager:
+
+    with tracing.span('exec_playbook', playbook = 'ansible/perf_client.yaml'):
+        prov.exec_playbook(...)
+
+or a decorator:
+
+    @tracing.traced('create_linode')
+    def create(...):
+
+Spans can be nested, and are tracked per thread, so spans in worker threads of a
+thread pool show up as separate lanes. At the end of a build, the spans can be dumped
+as a Chrome trace event JSON, which can be opened in chrome://tracing or
+https://ui.perfetto.dev, and as a summary table of total, self and max time per span name.
+
+Spans go to the current tracer, which is replaced by calling start() at the
+beginning of each build.
+'''
+
+import os
+import json
+import time
+import functools
+import threading
+import collections
+
+
+class Tracer(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.start_time = time.time()
+
+        self.events = []
+        self.lock = threading.Lock()
+
+        # Each thread has its own stack of open spans.
+        self.local = threading.local()
+
+
+    def span(self, name, **args):
+        '''
+        Returns:
+            A context manager that records the time spent in its block as a span.
+            Keyword arguments are saved with the span.
+        '''
+        return _Span(self, name, args)
+
+
+    def _stack(self):
+        stack = getattr(self.local, 'stack', None)
+        if stack is None:
+            stack = self.local.stack = []
+        return stack
+
+
+    def _record(self, name, args, start, end, child_time, error):
+        event = {
+            'name' : name,
+            'start' : start,
+            'duration' : end - start,
+            'self' : end - start - child_time,
+            'thread' : threading.current_thread().name,
+            'tid' : threading.current_thread().ident,
+            'args' : args
+        }
+        if error:
+            event['error'] = error
+
+        with self.lock:
+            self.events.append(event)
+
+
+    def chrome_trace(self):
+        '''
+        Returns:
+            dict in Chrome trace event format, with spans as complete ('X') events.
+        '''
+        pid = os.getpid()
+        trace_events = []
+        thread_names = {}
+
+        with self.lock:
+            events = list(self.events)
+
+        for e in events:
+            args = dict((k, str(v)) for k, v in e['args'].items())
+            if 'error' in e:
+                args['error'] = e['error']
+            trace_events.append({
+                'name' : e['name'],
+                'ph' : 'X',
+                'ts' : int((e['start'] - self.start_time) * 1000000),
+                'dur' : int(e['duration'] * 1000000),
+                'pid' : pid,
+                'tid' : e['tid'],
+                'args' : args
+            })
+            thread_names[e['tid']] = e['thread']
+
+        # Metadata events name the lanes.
+        trace_events.append({'name' : 'process_name', 'ph' : 'M', 'pid' : pid,
+            'args' : {'name' : self.name}})
+        for tid, thread_name in thread_names.items():
+            trace_events.append({'name' : 'thread_name', 'ph' : 'M', 'pid' : pid, 'tid' : tid,
+                'args' : {'name' : thread_name}})
+
+        return {'traceEvents' : trace_events, 'displayTimeUnit' : 'ms'}
+
+
+    def summary(self):
+        '''
+        Returns:
+            Summary table as a string, with a row per span name ordered by total time.
+            Self time excludes time spent in nested spans of the same thread. Since
+            spans in different threads overlap, totals can add up to more than wall time.
+        '''
+        with self.lock:
+            events = list(self.events)
+
+        stats = collections.OrderedDict()
+        for e in events:
+            s = stats.setdefault(e['name'], {'count' : 0, 'total' : 0.0, 'self' : 0.0, 'max' : 0.0, 'errors' : 0})
+            s['count'] += 1
+            s['total'] += e['duration']
+            s['self'] += e['self']
+            s['max'] = max(s['max'], e['duration'])
+            if 'error' in e:
+                s['errors'] += 1
+
+        wall = time.time() - self.start_time
+
+        lines = ['Trace summary: %s (wall time %.1f s)' % (self.name, wall),
+            '%-40s %6s %10s %10s %10s %10s %7s %6s' % ('span', 'count', 'total(s)', 'self(s)',
+                'mean(s)', 'max(s)', '%wall', 'errors')]
+        for name, s in sorted(stats.items(), key = lambda item: -item[1]['total']):
+            lines.append('%-40s %6d %10.2f %10.2f %10.2f %10.2f %7.1f %6d' % (name, s['count'],
+                s['total'], s['self'], s['total'] / s['count'], s['max'],
+                100.0 * s['total'] / wall if wall > 0 else 0.0, s['errors']))
+        return '\n'.join(lines)
+
+
+    def dump(self, output_dir, prefix = 'trace'):
+        '''
+        Writes the Chrome trace JSON and summary table to output_dir.
+
+        Returns:
+            The summary table.
+        '''
+        if not os.path.isdir(output_dir):
+            os.makedirs(output_dir)
+
+        with open(os.path.join(output_dir, prefix + '.json'), 'w') as f:
+            json.dump(self.chrome_trace(), f)
+
+        summary = self.summary()
+        with open(os.path.join(output_dir, prefix + '-summary.txt'), 'w') as f:
+            f.write(summary + '\n')
+
+        return summary
+
+
+
+class _Span(object):
+
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+
+
+    def __enter__(self):
+        self.child_time = 0.0
+        self.tracer._stack().append(self)
+        self.start = time.time()
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, tb):
+        end = time.time()
+
+        stack = self.tracer._stack()
+        stack.pop()
+        if stack:
+            stack[-1].child_time += end - self.start
+
+        error = '%s: %s' % (exc_type.__name__, exc_value) if exc_type else None
+        self.tracer._record(self.name, self.args, self.start, end, self.child_time, error)
+
+        # Don't suppress exceptions.
+        return False
+
+
+
+_current = Tracer('default')
+
+
+def start(name):
+    '''
+    Replaces the current tracer with a new one, so that spans from here on are
+    recorded separately from earlier ones.
+
+    Returns:
+        The new Tracer.
+    '''
+    global _current
+    _current = Tracer(name)
+    return _current
+
+
+
+def current():
+    return _current
+
+
+
+def span(name, **args):
+    return _current.span(name, **args)
+
+
+
+def traced(name = None):
+    '''
+    Decorator that records every call of the function as a span.
+    Span name is the function name if not specified.
+    '''
+    def decorator(func):
+        span_name = name or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with _current.span(span_name):
+                return func(*args, **kwargs)
+        return wrapper
+
+    return decorator
@@ -0,0 +1,375 @@
+'''
+Warm pool of pre-created Gluster nodes, so that cluster builds don't have to wait
+for Linodes to be created and booted, and for SSH to come up on them.
+
+A pool keeps a configured number of idle nodes for each node spec, which is the
+datacenter, plan, image, kernel and disk layout of a node. Nodes of a cluster plan
+are claimed from the pool of their spec, and created fresh only if the pool is empty.
+
+Pools are tracked in a StateStore at <conf-dir>/warm_pool.json, so multiple processes
+can claim from and refill them safely:
+
+    {
+        'pools' : {
+            <SPEC-KEY> : {'spec' : <node spec>, 'size' : <number of idle nodes to keep>}
+        },
+        'nodes' : {
+            <SPEC-KEY> : [<idle node>, ...]
+        },
+        'pending' : {
+            <SPEC-KEY> : [{'id' : <unique ID>, 'started' : <epoch time>, 'node' : <node once created>}, ...]
+        },
+        'failed' : [{'key' : <SPEC-KEY>, 'id' : ..., 'started' : ..., 'error' : <error message>}, ...]
+    }
+
+A refill reserves the nodes it's going to create as 'pending' entries, holding the store's
+lock, and nodes being created by other refills are counted as already in the pool. So
+concurrent refills, even in different processes, don't create the same missing nodes.
+An entry is removed when its node is added to the pool or could not be created. Entries
+older than PENDING_TIMEOUT, like those of a killed process, are not counted anymore.
+
+A node is saved in its pending entry as soon as it's created, so that it's not lost if it
+does not become reachable over SSH, or the process exits before it does. The next refill
+adopts such nodes, and adds them to the pool once they're reachable. If creation fails
+with an error, the node may still have been created by the API, so the entry is moved to
+'failed' to be checked in the Linode manager, under group 'warm-pool'. Failed entries are
+listed by the list command, and removed by clear-failed.
+
+Pool nodes are created in Linode group 'warm-pool', and keep their label and
+group after they're claimed by a cluster.
+
+Usage:
+-----
+$ python warm_pool.py configure <CLUSTER-PLAN-FILE> <SIZE>
+$ python warm_pool.py refill
+$ python warm_pool.py daemon [<INTERVAL-SECONDS>]
+$ python warm_pool.py list
+$ python warm_pool.py clear-failed
+'''
+
+import os
+import sys
+import json
+import time
+import uuid
+import threading
+import collections
+from multiprocessing.pool import ThreadPool
+
+import linode_core
+from provisioners import AnsibleProvisioner
+
+import logger
+import tracing
+from state_store import StateStore
+
+# Default number of idle nodes kept for each spec.
+DEFAULT_POOL_SIZE = 2
+
+# Default maximum number of pool nodes created at the same time.
+DEFAULT_REFILL_PARALLELISM = 4
+
+# Default seconds between background refills. A claim also triggers a refill.
+DEFAULT_REFILL_INTERVAL = 600
+
+# Seconds after which a pending node creation is taken to have been abandoned.
+PENDING_TIMEOUT = 1800
+
+POOL_GROUP = 'warm-pool'
+
+
+def spec_key(linode_spec):
+    '''
+    Returns:
+        Key of the pool for nodes of linode_spec. Label and group don't affect what
+        the node is, so they're not part of the key.
+    '''
+    spec = dict((k, v) for k, v in linode_spec.items() if k not in ('label', 'group'))
+    return json.dumps(spec, sort_keys = True)
+
+
+
+class WarmPool(object):
+
+    def __init__(self, app_ctx, parallelism = DEFAULT_REFILL_PARALLELISM):
+        '''
+        Args:
+            - app_ctx : Application context passed to linode_core.Core
+            - parallelism : Maximum number of pool nodes created at the same time.
+        '''
+        self.app_ctx = app_ctx
+        self.parallelism = parallelism
+
+        # Since Linode objects are not JSON serializable, their __dict__ attributes are serialized.
+        self.store = StateStore(os.path.join(app_ctx['conf-dir'], 'warm_pool.json'),
+            json_default = lambda o:o.__dict__)
+
+        self.refill_event = threading.Event()
+        self.stop_event = threading.Event()
+        self.refill_thread = None
+
+
+    def configure(self, linode_spec, size = DEFAULT_POOL_SIZE):
+        '''
+        Sets number of idle nodes to keep for linode_spec. A size of 0 stops refilling
+        the pool, but does not delete its idle nodes.
+        '''
+        key = spec_key(linode_spec)
+        spec = dict(linode_spec)
+        spec['group'] = POOL_GROUP
+        self.store.set(['pools', key], {'spec' : spec, 'size' : size})
+
+
+    def configure_from_plan(self, cluster_plan, size = DEFAULT_POOL_SIZE):
+        '''
+        Configures a pool for every distinct node spec in a GlusterClusterPlan.
+        '''
+        node_requests, brick_mounts = cluster_plan.plan_nodes()
+        for key, request in collections.OrderedDict((spec_key(r.linode_spec), r) for r in node_requests).items():
+            self.configure(request.linode_spec, size)
+
+
+    def claim(self, linode_spec):
+        '''
+        Takes an idle node of linode_spec out of the pool.
+
+        Returns:
+            The Linode object of the node, or None if the pool is empty.
+        '''
+        key = spec_key(linode_spec)
+        with self.store.transaction(collections.OrderedDict()) as state:
+            idle = state.get('nodes', {}).get(key)
+            node_dict = idle.pop(0) if idle else None
+
+        if node_dict is None:
+            return None
+
+        # Replace the claimed node in background.
+        self.refill_event.set()
+
+        node_info = linode_core.Linode()
+        node_info.__dict__.update(node_dict)
+        logger.msg('Claimed node %s from warm pool' % (node_info.id))
+        return node_info
+
+
+    def status(self):
+        '''
+        Returns:
+            list of (spec, size, number of idle nodes) of all pools.
+        '''
+        state = self.store.load(collections.OrderedDict())
+        idle = state.get('nodes', {})
+        return [(pool['spec'], pool['size'], len(idle.get(key, [])))
+            for key, pool in state.get('pools', {}).items()]
+
+
+    def refill(self):
+        '''
+        Creates nodes of all pools that have fewer idle nodes than their size, and
+        waits till they're created and reachable over SSH.
+
+        Returns:
+            Number of nodes added to pools.
+        '''
+        now = time.time()
+        wanted = []
+        with self.store.transaction(collections.OrderedDict()) as state:
+            idle = state.get('nodes', {})
+            pending = state.setdefault('pending', collections.OrderedDict())
+
+            for key, pool in state.get('pools', {}).items():
+                creating = []
+                for p in pending.get(key, []):
+                    # Nodes that were created but not added to the pool by an earlier refill
+                    # are adopted by this one.
+                    if p.get('node') and (p.get('unreachable') or now - p['started'] >= PENDING_TIMEOUT):
+                        p['started'] = now
+                        p.pop('unreachable', None)
+                        wanted.append((key, pool['spec'], p['id'], p['node']))
+                        creating.append(p)
+                    elif now - p['started'] < PENDING_TIMEOUT:
+                        creating.append(p)
+
+                missing = pool['size'] - len(idle.get(key, [])) - len(creating)
+                reserved = [{'id' : uuid.uuid4().hex, 'started' : now} for i in range(max(missing, 0))]
+                pending[key] = creating + reserved
+                wanted.extend([(key, pool['spec'], r['id'], None) for r in reserved])
+
+        if not wanted:
+            return 0
+
+        logger.msg('Refilling warm pool with %d nodes' % (len(wanted)))
+        pool = ThreadPool(min(self.parallelism, len(wanted)))
+        try:
+            added = pool.map(lambda w: self._add_node(*w), wanted, chunksize = 1)
+        finally:
+            pool.close()
+            pool.join()
+
+        return sum(1 for a in added if a)
+
+
+    def _add_node(self, key, linode_spec, pending_id, node_dict = None):
+        '''
+        Creates the node reserved by the pending entry pending_id, or adopts node_dict
+        created by an earlier refill, and adds it to the pool once it's reachable over SSH.
+
+        The pending entry is removed if the node is added or could not be created. It's
+        kept with the node if the node is not reachable, and moved to 'failed' if creation
+        failed with an error.
+        '''
+        node_info = None
+        ready = False
+        error = None
+        try:
+            if node_dict is None:
+                node_info = self._create_node(linode_spec)
+                if node_info:
+                    self.store.update(['pending', key], {'id' : pending_id}, {'node' : node_info})
+            else:
+                node_info = linode_core.Linode()
+                node_info.__dict__.update(node_dict)
+
+            ready = node_info is not None and self._wait_ready(node_info)
+
+        except Exception as e:
+            logger.error_msg('Error creating warm pool node: %s' % (e))
+            error = str(e)
+
+        finally:
+            with self.store.transaction(collections.OrderedDict()) as state:
+                pending = state.get('pending', {}).get(key, [])
+                entries = [p for p in pending if p['id'] == pending_id]
+                pending[:] = [p for p in pending if p['id'] != pending_id]
+
+                if ready:
+                    state.setdefault('nodes', collections.OrderedDict()).setdefault(key, []).append(node_info)
+                elif node_info is not None:
+                    for entry in entries:
+                        entry['unreachable'] = True
+                    pending.extend(entries)
+                elif error is not None:
+                    for entry in entries:
+                        entry['key'] = key
+                        entry['error'] = error
+                    state.setdefault('failed', []).extend(entries)
+        return ready
+
+
+    def _create_node(self, linode_spec):
+        '''
+        Returns:
+            Linode object of the created node, or None if it could not be created.
+        '''
+        # Each worker uses its own Core, since a Core is not known to be thread safe.
+        core = linode_core.Core(self.app_ctx)
+
+        with tracing.span('create_linode', pool = True):
+            node_info = core.create_linode(dict(linode_spec))
+        if not node_info:
+            logger.error_msg('Could not create warm pool node')
+            return None
+        return node_info
+
+
+    def _wait_ready(self, node_info):
+        '''
+        Returns:
+            True if the node is reachable over SSH. Nodes are added only once they're ready,
+            so that claimed nodes can be provisioned right away.
+        '''
+        with tracing.span('wait_for_ping', host = node_info.public_ip[0]):
+            reachable = AnsibleProvisioner().wait_for_ping(node_info, 60, 10)
+        if not reachable:
+            logger.error_msg('Warm pool node %s is not reachable over SSH' % (node_info.id))
+        return reachable
+
+
+    def failed(self):
+        '''
+        Returns:
+            list of pending entries whose creation failed with an error, and whose
+            nodes may have been created anyway.
+        '''
+        return self.store.load(collections.OrderedDict()).get('failed', [])
+
+
+    def clear_failed(self):
+        self.store.set(['failed'], [])
+
+
+    def start_background_refill(self, interval = DEFAULT_REFILL_INTERVAL):
+        '''
+        Starts a daemon thread that refills the pools every interval seconds, and
+        soon after every claim.
+        '''
+        if self.refill_thread:
+            return
+
+        def run():
+            while not self.stop_event.is_set():
+                try:
+                    self.refill()
+                except Exception as e:
+                    logger.error_msg('Error refilling warm pool: %s' % (e))
+
+                self.refill_event.wait(interval)
+                self.refill_event.clear()
+
+        self.stop_event.clear()
+        self.refill_thread = threading.Thread(target = run, name = 'warm-pool-refill')
+        self.refill_thread.daemon = True
+        self.refill_thread.start()
+
+
+    def stop_background_refill(self):
+        '''
+        Stops the background refill thread, after any refill in progress completes.
+        '''
+        if not self.refill_thread:
+            return
+        self.stop_event.set()
+        self.refill_event.set()
+        self.refill_thread.join()
+        self.refill_thread = None
+
+
+
+if __name__ == '__main__':
+    from cluster_plan import GlusterClusterPlan, LinodeStaticInfo
+
+    app_ctx = {'conf-dir' : 'glusterdata'}
+    LinodeStaticInfo.load()
+    warm_pool = WarmPool(app_ctx)
+
+    command = sys.argv[1] if len(sys.argv) > 1 else 'list'
+
+    if command == 'configure':
+        plan = GlusterClusterPlan(app_ctx, 'warm-pool')
+        plan.load_from_json(sys.argv[2])
+        plan.validate()
+        warm_pool.configure_from_plan(plan, int(sys.argv[3]))
+
+    elif command == 'refill':
+        print('Added %d nodes' % (warm_pool.refill()))
+
+    elif command == 'daemon':
+        # Keeps pools full till interrupted.
+        interval = int(sys.argv[2]) if len(sys.argv) > 2 else DEFAULT_REFILL_INTERVAL
+        warm_pool.start_background_refill(interval)
+        try:
+            while warm_pool.refill_thread.is_alive():
+                warm_pool.refill_thread.join(1)
+        except KeyboardInterrupt:
+            print('Stopping after refill in progress completes')
+            warm_pool.stop_background_refill()
+
+    elif command == 'clear-failed':
+        warm_pool.clear_failed()
+
+    for spec, size, num_idle in warm_pool.status():
+        print('%d/%d idle: %s' % (num_idle, size, spec_key(spec)))
+    for entry in warm_pool.failed():
+        print('Creation failed at %s, check for its node in group %s: %s' % (
+            time.ctime(entry['started']), POOL_GROUP, entry['error']))